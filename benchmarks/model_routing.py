@@ -0,0 +1,174 @@
+"""
+Latency and ranking agreement of the model tiers used by the model router.
+
+Every screen (sample dumps plus optional synthetic ones) is ranked by the model of each tier in the routing
+config. Latency is reported per tier, and each tier's ranking is compared with the reference tier's:
+top-1 match, overlap of the top 3 and pairwise order agreement. The tier the router would pick is listed
+for each screen.
+
+By default the local LLM stub (loadtest/stubs.py) answers, with per-model latency and disagreement:
+
+    python -m benchmarks.model_routing --llm-model-latency gpt-4o-mini=lognormal:250:0.3 --llm-model-disagreement gpt-4o-mini=0.1
+    python -m benchmarks.model_routing --base-url https://api.openai.com/v1   # real models, needs OPENAI_API_KEY
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# Keep the run offline and uncached: every call must reach the model
+os.environ["LANGSMITH_TRACING"] = "false"
+os.environ["LANGCHAIN_TRACING_V2"] = "false"
+os.environ["LLM_CACHE_ENABLED"] = "false"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate_hierarchy, generate_screenshot
+from loadtest.stubs import add_stub_arguments, create_stub_app_from_arguments
+from model_router import ModelRouter, load_routing_config, get_screen_features, get_llm_for_model
+
+DUMPS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dumps")
+DEFAULT_STUB_MODEL_LATENCY = ["gpt-4o=lognormal:900:0.3", "gpt-4o-mini=lognormal:300:0.3"]
+DEFAULT_STUB_MODEL_DISAGREEMENT = ["gpt-4o-mini=0.15"]
+
+
+def start_stub_server(args):
+    import uvicorn
+    config = uvicorn.Config(create_stub_app_from_arguments(args), host="127.0.0.1", port=args.stub_port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError("LLM stub did not start")
+        time.sleep(0.05)
+
+def load_screens(args):
+    screens = []
+    for dump_path in sorted(glob.glob(os.path.join(DUMPS_DIRECTORY, "*.xml"))):
+        with open(dump_path, "r") as dump_file:
+            screens.append((f"dump_{os.path.splitext(os.path.basename(dump_path))[0]}", dump_file.read()))
+    for size in args.synthetic_sizes:
+        screens.append((f"synthetic_{size}", generate_hierarchy(node_count=size, seed=size)))
+    return screens
+
+def parse_ranking(llm_response):
+    if llm_response is None:
+        return None
+    content = llm_response.content.replace('```json\n', '').replace('\n```', '').replace('\n', '')
+    return [element["node_id"] for element in json.loads(content).get("ranked_actions", [])]
+
+def compare_rankings(ranking, reference):
+    """Top-1 match, top-3 overlap and the fraction of element pairs ordered the same way as the reference."""
+    if not ranking or not reference:
+        return None
+    positions = {node_id: position for position, node_id in enumerate(ranking)}
+    common = [node_id for node_id in reference if node_id in positions]
+    pairs = [(first, second) for index, first in enumerate(common) for second in common[index + 1:]]
+    return {
+        "top1": float(ranking[0] == reference[0]),
+        "top3_overlap": len(set(ranking[:3]) & set(reference[:3])) / min(3, len(reference)),
+        "pairwise_agreement": sum(positions[first] < positions[second] for first, second in pairs) / len(pairs) if pairs else 1.0
+    }
+
+def rank_screen(name, xml, image, tiers, llm, repeat):
+    from ui_tree import UITree
+    from utils import filter_elements, trim_element_jsons, annotate_image, get_annotation_targets
+    from llm_utils import llm_prioritize_actions
+
+    uitree = UITree(request_id=name, xml=xml)
+    candidates = filter_elements(name, uitree, list(uitree.ui_element_dict_processed.values()))
+    trimmed_elements = trim_element_jsons(name, candidates)
+    annotated_image = annotate_image(image, get_annotation_targets(candidates)) if image else None
+    results = {"candidates": len(candidates), "tiers": dict()}
+    for tier_name, tier in tiers.items():
+        tier_llm = get_llm_for_model(llm, tier["model"])
+        latencies, ranking = [], None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            llm_response = llm_prioritize_actions(request_id=name, screen_context="", base64_image=annotated_image if tier.get("include_image", True) else None,
+                                                  actions=trimmed_elements, history=[], user_prompt="", phase="explore-user-journeys", llm=tier_llm)
+            latencies.append((time.perf_counter() - start) * 1000)
+            ranking = ranking or parse_ranking(llm_response)
+        results["tiers"][tier_name] = {"model": tier["model"], "latencies_ms": latencies, "ranking": ranking}
+    return results
+
+def summarise(screens, reference_tier):
+    summary = dict()
+    for screen in screens.values():
+        reference = screen["tiers"][reference_tier]["ranking"]
+        for tier_name, tier_result in screen["tiers"].items():
+            tier_summary = summary.setdefault(tier_name, {"model": tier_result["model"], "latencies_ms": [], "agreements": []})
+            tier_summary["latencies_ms"].extend(tier_result["latencies_ms"])
+            agreement = compare_rankings(tier_result["ranking"], reference)
+            if agreement:
+                tier_summary["agreements"].append(agreement)
+    report = dict()
+    for tier_name, tier_summary in summary.items():
+        latencies = sorted(tier_summary["latencies_ms"])
+        agreements = tier_summary["agreements"]
+        report[tier_name] = {
+            "model": tier_summary["model"],
+            "calls": len(latencies),
+            "median_ms": round(statistics.median(latencies), 3),
+            "p90_ms": round(latencies[min(len(latencies) - 1, int(0.9 * len(latencies)))], 3),
+            **{metric: round(statistics.mean(agreement[metric] for agreement in agreements), 3) if agreements else None for metric in ["top1", "top3_overlap", "pairwise_agreement"]}
+        }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare latency and ranking agreement across model tiers")
+    parser.add_argument("--base-url", help="OpenAI compatible endpoint to benchmark; the local LLM stub is started when omitted")
+    parser.add_argument("--stub-port", type=int, default=9101)
+    parser.add_argument("--repeat", type=int, default=3, help="Calls per screen and tier")
+    parser.add_argument("--synthetic-sizes", type=int, nargs="*", default=[200, 1000], help="Add synthetic screens of these node counts")
+    parser.add_argument("--with-image", action="store_true", help="Send an annotated synthetic screenshot to tiers that include images")
+    parser.add_argument("--reference-tier", default="large", help="Tier whose ranking the others are compared with")
+    parser.add_argument("--output", help="Write the full results as JSON to this file")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.base_url:
+        args.llm_model_latency = args.llm_model_latency or DEFAULT_STUB_MODEL_LATENCY
+        args.llm_model_disagreement = args.llm_model_disagreement or DEFAULT_STUB_MODEL_DISAGREEMENT
+        start_stub_server(args)
+        os.environ["OPENAI_API_KEY"] = "stub-key"
+    os.environ["OPENAI_BASE_URL"] = args.base_url or f"http://127.0.0.1:{args.stub_port}/v1"
+
+    from llm import initialize_llm
+    # The tiers are compared whether or not routing is enabled for the service
+    router = ModelRouter(load_routing_config())
+    if args.reference_tier not in router.tiers:
+        parser.error(f"Unknown reference tier {args.reference_tier}; tiers are {sorted(router.tiers)}")
+    llm = initialize_llm(os.getenv("OPENAI_API_KEY"))
+    image = generate_screenshot() if args.with_image else None
+
+    screens = dict()
+    # annotate_image writes a debug copy of every annotated screenshot to the working directory
+    with tempfile.TemporaryDirectory() as scratch_directory:
+        working_directory = os.getcwd()
+        os.chdir(scratch_directory)
+        try:
+            for name, xml in load_screens(args):
+                print(f"Ranking {name}", file=sys.stderr)
+                screens[name] = rank_screen(name, xml, image, router.tiers, llm, args.repeat)
+                route = router.route(get_screen_features(range(screens[name]["candidates"]), "explore-user-journeys", [], image))
+                screens[name]["routed_tier"] = route["tier"] if route else None
+        finally:
+            os.chdir(working_directory)
+
+    report = {"tiers": summarise(screens, args.reference_tier),
+              "routing": {name: {"candidates": screen["candidates"], "routed_tier": screen["routed_tier"]} for name, screen in screens.items()}}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(dict(report, screens=screens), output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
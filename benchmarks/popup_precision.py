@@ -0,0 +1,78 @@
+"""
+Precision of the local popup pre-detector on recorded screens.
+
+Recordings are read like replay.py reads them (a directory of <name>.xml files with optional <name>.json
+metadata, or a JSONL manifest). Each recording needs a boolean label, by default the "popup" field of its
+metadata, saying whether the screen really shows a popup; unlabelled recordings are skipped.
+
+    python -m benchmarks.popup_precision --input recordings/ --output popup_precision.json
+
+The important numbers are
+- no_popup_precision: share of screens the detector skips (no_popup) that really have no popup; every miss
+  is a popup the remote agent never sees
+- skip_rate: share of screens that no longer need a popup handler call
+- likely_popup_precision: share of likely_popup screens that really have a popup
+"""
+import argparse
+import json
+import os
+import sys
+
+os.environ["LANGSMITH_TRACING"] = "false"
+os.environ["LANGCHAIN_TRACING_V2"] = "false"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from replay import iterate_recordings, read_recording_inputs
+from ui_tree import UITree
+from popup_detector import detect_popup, NO_POPUP, LIKELY_POPUP, UNSURE
+
+
+def ratio(numerator, denominator):
+    return round(numerator / denominator, 4) if denominator else None
+
+def evaluate(args):
+    counts = {verdict: {"popup": 0, "no_popup": 0} for verdict in [NO_POPUP, UNSURE, LIKELY_POPUP]}
+    missed_popups, false_alarms, skipped = [], [], 0
+    for recording in iterate_recordings(args.input):
+        label = recording.get(args.label_field)
+        if not isinstance(label, bool):
+            skipped += 1
+            continue
+        xml, _ = read_recording_inputs(recording)
+        verdict, reasons = detect_popup(UITree(request_id=str(recording["id"]), xml=xml))
+        counts[verdict]["popup" if label else "no_popup"] += 1
+        if verdict == NO_POPUP and label:
+            missed_popups.append(recording["id"])
+        elif verdict == LIKELY_POPUP and not label:
+            false_alarms.append({"id": recording["id"], "reasons": reasons})
+
+    total = sum(sum(verdict_counts.values()) for verdict_counts in counts.values())
+    return {
+        "screens": total,
+        "unlabelled_skipped": skipped,
+        "counts": counts,
+        "no_popup_precision": ratio(counts[NO_POPUP]["no_popup"], sum(counts[NO_POPUP].values())),
+        "skip_rate": ratio(sum(counts[NO_POPUP].values()), total),
+        "likely_popup_precision": ratio(counts[LIKELY_POPUP]["popup"], sum(counts[LIKELY_POPUP].values())),
+        "popup_recall": ratio(counts[LIKELY_POPUP]["popup"] + counts[UNSURE]["popup"], sum(verdict_counts["popup"] for verdict_counts in counts.values())),
+        "missed_popups": missed_popups,
+        "false_alarms": false_alarms
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the local popup pre-detector against labelled recordings")
+    parser.add_argument("--input", required=True, help="Directory of recordings or a JSONL manifest")
+    parser.add_argument("--label-field", default="popup", help="Boolean field of a recording saying whether it shows a popup")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    report = evaluate(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
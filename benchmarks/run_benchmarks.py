@@ -0,0 +1,174 @@
+"""
+Micro-benchmarks for the CPU-bound stages of the guidance pipeline.
+
+Runs offline against synthetic hierarchies and the sample dumps in benchmarks/dumps; no API keys or
+network access are needed. Results are written as JSON so runs from two commits can be compared:
+
+    python -m benchmarks.run_benchmarks --output bench_before.json
+    python -m benchmarks.run_benchmarks --output bench_after.json
+    python -m benchmarks.run_benchmarks --compare bench_before.json bench_after.json
+"""
+import argparse
+import gc
+import glob
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+# Keep the run offline: LangSmith traceable wrappers become no-ops
+os.environ["LANGSMITH_TRACING"] = "false"
+os.environ["LANGCHAIN_TRACING_V2"] = "false"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate_hierarchy, generate_screenshot
+from ui_tree import UITree, StreamedUITree
+from utils import filter_elements, trim_element_jsons, annotate_image, map_data_fields_to_ranked_actions
+from ingest import project_ranked_actions, serialize_response
+
+DUMPS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dumps")
+DEFAULT_SIZES = [100, 1000, 10000, 50000]
+PROJECTED_FIELDS = ["node_id", "llm_rank", "action_description", "bounds", "xpath"]
+
+
+def measure(fn, repeat):
+    """Returns wall time statistics over repeat runs and the peak traced memory of one extra run."""
+    durations = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - start) * 1000)
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "min_ms": round(min(durations), 3),
+        "median_ms": round(statistics.median(durations), 3),
+        "max_ms": round(max(durations), 3),
+        "peak_memory_bytes": peak_bytes
+    }
+
+def benchmark_screen(name, xml, image, repeat):
+    results = dict()
+    uitree = UITree(request_id=name, xml=xml)
+    ui_elements = list(uitree.ui_element_dict_processed.values())
+    candidates = filter_elements(name, uitree, ui_elements)
+    ranked_actions = [dict(element, llm_rank=rank + 1, action_description="") for rank, element in enumerate(candidates)]
+    data_fields = [{"metadata": {"bounds": element["attributes"].get("bounds")}, "value": "generated"} for element in candidates[::2]]
+    node_ids = list(uitree.graph.nodes)[:: max(1, len(uitree.graph) // 1000)]
+
+    results["UITree"] = measure(lambda: UITree(request_id=name, xml=xml), repeat)
+    results["StreamedUITree"] = measure(lambda: StreamedUITree(request_id=name, xml=xml), repeat)
+    results["update_processed_ui_element_dict"] = measure(uitree.update_processed_ui_element_dict, repeat)
+    results["get_xpath"] = measure(lambda: [uitree.get_xpath(node_id) for node_id in node_ids], repeat)
+    results["get_xpath"]["calls"] = len(node_ids)
+    results["filter_elements"] = measure(lambda: filter_elements(name, uitree, ui_elements), repeat)
+    results["trim_element_jsons"] = measure(lambda: trim_element_jsons(name, candidates), repeat)
+    if image:
+        results["annotate_image"] = measure(lambda: annotate_image(image, candidates), repeat)
+    results["map_data_fields_to_ranked_actions"] = measure(lambda: map_data_fields_to_ranked_actions(name, [dict(action) for action in ranked_actions], list(data_fields)), repeat)
+    results["serialize_response"] = measure(lambda: serialize_response({"ranked_actions": ranked_actions}), repeat)
+    results["serialize_response"]["bytes"] = len(serialize_response({"ranked_actions": ranked_actions}))
+    results["serialize_response_projected"] = measure(lambda: serialize_response({"ranked_actions": project_ranked_actions(ranked_actions, PROJECTED_FIELDS)}), repeat)
+    results["serialize_response_projected"]["bytes"] = len(serialize_response({"ranked_actions": project_ranked_actions(ranked_actions, PROJECTED_FIELDS)}))
+    return {
+        "nodes": len(uitree.graph),
+        "candidates": len(candidates),
+        "xml_bytes": len(xml.encode("utf-8")),
+        "functions": results
+    }
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def run(args):
+    image = None if args.no_image else generate_screenshot()
+    screens = []
+    for size in args.sizes:
+        xml = generate_hierarchy(node_count=size, max_depth=args.depth, fan_out=args.fan_out, clickable_ratio=args.clickable_ratio, text_length=args.text_length, seed=args.seed)
+        screens.append((f"synthetic_{size}", xml))
+    for dump_path in sorted(glob.glob(os.path.join(DUMPS_DIRECTORY, "*.xml"))):
+        with open(dump_path, "r") as dump_file:
+            screens.append((f"dump_{os.path.splitext(os.path.basename(dump_path))[0]}", dump_file.read()))
+
+    results = {
+        "commit": get_git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ["output", "compare"]},
+        "screens": dict()
+    }
+    # annotate_image writes a debug copy of every annotated screenshot to the working directory
+    with tempfile.TemporaryDirectory() as scratch_directory:
+        working_directory = os.getcwd()
+        os.chdir(scratch_directory)
+        try:
+            for name, xml in screens:
+                print(f"Benchmarking {name}", file=sys.stderr)
+                results["screens"][name] = benchmark_screen(name, xml, image, args.repeat)
+        finally:
+            os.chdir(working_directory)
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print_table(results)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+def print_table(results):
+    print(f"{'screen':<24}{'function':<36}{'median ms':>12}{'peak KiB':>12}")
+    for screen_name, screen in results["screens"].items():
+        for function_name, stats in screen["functions"].items():
+            print(f"{screen_name:<24}{function_name:<36}{stats['median_ms']:>12.3f}{stats['peak_memory_bytes'] / 1024:>12.1f}")
+
+def compare(baseline_path, current_path, threshold_percent):
+    """Print per function median changes; exits with 1 when any function regressed beyond the threshold."""
+    with open(baseline_path) as baseline_file, open(current_path) as current_file:
+        baseline, current = json.load(baseline_file), json.load(current_file)
+    regressions = 0
+    print(f"{'screen':<24}{'function':<36}{'before ms':>12}{'after ms':>12}{'change':>10}")
+    for screen_name, screen in current["screens"].items():
+        for function_name, stats in screen["functions"].items():
+            before = baseline.get("screens", {}).get(screen_name, {}).get("functions", {}).get(function_name)
+            if not before or not before["median_ms"]:
+                continue
+            change_percent = (stats["median_ms"] - before["median_ms"]) / before["median_ms"] * 100
+            flag = " !" if change_percent > threshold_percent else ""
+            regressions += 1 if flag else 0
+            print(f"{screen_name:<24}{function_name:<36}{before['median_ms']:>12.3f}{stats['median_ms']:>12.3f}{change_percent:>9.1f}%{flag}")
+    return 1 if regressions else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark UITree construction and the element processing helpers")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Node counts of the synthetic hierarchies")
+    parser.add_argument("--depth", type=int, default=12, help="Maximum depth of the synthetic hierarchies")
+    parser.add_argument("--fan-out", type=int, default=8, help="Maximum children per container")
+    parser.add_argument("--clickable-ratio", type=float, default=0.3, help="Fraction of clickable nodes")
+    parser.add_argument("--text-length", type=int, default=16, help="Length of node text and content-desc")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per function")
+    parser.add_argument("--no-image", action="store_true", help="Skip annotate_image")
+    parser.add_argument("--output", default="bench_output.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="Compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Regression threshold in percent for --compare")
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(compare(args.compare[0], args.compare[1], args.threshold))
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
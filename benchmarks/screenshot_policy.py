@@ -0,0 +1,135 @@
+"""
+Latency and ranking agreement of the screenshot policy against always sending the annotated screenshot.
+
+Every screen (sample dumps plus optional synthetic ones) is ranked twice: with the full annotated screenshot,
+the reference, and with what the screenshot policy decides to send (the full screenshot, the cropped regions
+of the unlabeled candidates, or no image). Latency is reported per decision, with the top-1 match, overlap
+of the top 3 and pairwise order agreement of the policy's ranking with the reference.
+
+By default the local LLM stub (loadtest/stubs.py) answers, with a latency per image and extra disagreement
+for rankings made without an image:
+
+    python -m benchmarks.screenshot_policy --llm-image-latency lognormal:400:0.3 --llm-blind-disagreement 0.1
+    python -m benchmarks.screenshot_policy --base-url https://api.openai.com/v1   # real model, needs OPENAI_API_KEY
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+# Keep the run offline and uncached: every call must reach the model
+os.environ["LANGSMITH_TRACING"] = "false"
+os.environ["LANGCHAIN_TRACING_V2"] = "false"
+os.environ["LLM_CACHE_ENABLED"] = "false"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate_screenshot
+from benchmarks.model_routing import start_stub_server, load_screens, parse_ranking, compare_rankings
+from loadtest.stubs import add_stub_arguments
+from screenshot_policy import decide_screenshot, FULL_SCREENSHOT, CROPPED_SCREENSHOT
+
+DEFAULT_STUB_IMAGE_LATENCY = "lognormal:400:0.3"
+DEFAULT_STUB_BLIND_DISAGREEMENT = 0.1
+
+
+def rank(name, trimmed_elements, image, image_kind, llm, repeat):
+    from llm_utils import llm_prioritize_actions
+    latencies, ranking = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        llm_response = llm_prioritize_actions(request_id=name, screen_context="", base64_image=image, actions=trimmed_elements, history=[],
+                                              user_prompt="", phase="explore-user-journeys", llm=llm, image_kind=image_kind)
+        latencies.append((time.perf_counter() - start) * 1000)
+        ranking = ranking or parse_ranking(llm_response)
+    return {"latencies_ms": latencies, "ranking": ranking}
+
+def rank_screen(name, xml, image, llm, repeat):
+    from ui_tree import UITree
+    from utils import filter_elements, trim_element_jsons, annotate_image, crop_image_regions, get_annotation_targets
+
+    uitree = UITree(request_id=name, xml=xml)
+    candidates = filter_elements(name, uitree, list(uitree.ui_element_dict_processed.values()))
+    trimmed_elements = trim_element_jsons(name, candidates)
+    decision, completeness, unlabeled, reasons = decide_screenshot(uitree, candidates)
+    annotated_image = annotate_image(image, get_annotation_targets(candidates))
+    if decision == CROPPED_SCREENSHOT:
+        policy_image = crop_image_regions(image, get_annotation_targets(unlabeled))
+    else:
+        policy_image = annotated_image if decision == FULL_SCREENSHOT else None
+    return {
+        "candidates": len(candidates),
+        "decision": decision,
+        "completeness": completeness,
+        "reasons": reasons,
+        "full": rank(name, trimmed_elements, annotated_image, FULL_SCREENSHOT, llm, repeat),
+        "policy": rank(name, trimmed_elements, policy_image, decision, llm, repeat)
+    }
+
+def summarise(screens):
+    by_decision = dict()
+    for screen in screens.values():
+        decision_summary = by_decision.setdefault(screen["decision"], {"screens": 0, "full_ms": [], "policy_ms": [], "agreements": []})
+        decision_summary["screens"] += 1
+        decision_summary["full_ms"].extend(screen["full"]["latencies_ms"])
+        decision_summary["policy_ms"].extend(screen["policy"]["latencies_ms"])
+        agreement = compare_rankings(screen["policy"]["ranking"], screen["full"]["ranking"])
+        if agreement:
+            decision_summary["agreements"].append(agreement)
+    report = dict()
+    for decision, decision_summary in by_decision.items():
+        agreements = decision_summary["agreements"]
+        report[decision] = {
+            "screens": decision_summary["screens"],
+            "full_median_ms": round(statistics.median(decision_summary["full_ms"]), 3),
+            "policy_median_ms": round(statistics.median(decision_summary["policy_ms"]), 3),
+            **{metric: round(statistics.mean(agreement[metric] for agreement in agreements), 3) if agreements else None for metric in ["top1", "top3_overlap", "pairwise_agreement"]}
+        }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the screenshot policy with always sending the annotated screenshot")
+    parser.add_argument("--base-url", help="OpenAI compatible endpoint to benchmark; the local LLM stub is started when omitted")
+    parser.add_argument("--stub-port", type=int, default=9102)
+    parser.add_argument("--repeat", type=int, default=3, help="Calls per screen and mode")
+    parser.add_argument("--synthetic-sizes", type=int, nargs="*", default=[200, 1000], help="Add synthetic screens of these node counts")
+    parser.add_argument("--output", help="Write the full results as JSON to this file")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.base_url:
+        args.llm_image_latency = args.llm_image_latency or DEFAULT_STUB_IMAGE_LATENCY
+        args.llm_blind_disagreement = args.llm_blind_disagreement or DEFAULT_STUB_BLIND_DISAGREEMENT
+        start_stub_server(args)
+        os.environ["OPENAI_API_KEY"] = "stub-key"
+    os.environ["OPENAI_BASE_URL"] = args.base_url or f"http://127.0.0.1:{args.stub_port}/v1"
+
+    from llm import initialize_llm
+    llm = initialize_llm(os.getenv("OPENAI_API_KEY"))
+    image = generate_screenshot()
+
+    screens = dict()
+    # annotate_image writes a debug copy of every annotated screenshot to the working directory
+    with tempfile.TemporaryDirectory() as scratch_directory:
+        working_directory = os.getcwd()
+        os.chdir(scratch_directory)
+        try:
+            for name, xml in load_screens(args):
+                print(f"Ranking {name}", file=sys.stderr)
+                screens[name] = rank_screen(name, xml, image, llm, args.repeat)
+        finally:
+            os.chdir(working_directory)
+
+    report = {"decisions": summarise(screens),
+              "screens": {name: {key: screen[key] for key in ["candidates", "decision", "completeness", "reasons"]} for name, screen in screens.items()}}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(dict(report, results=screens), output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import base64
+import random
+from io import BytesIO
+from xml.sax.saxutils import quoteattr
+from PIL import Image
+
+CONTAINER_CLASSES = ["android.widget.FrameLayout", "android.widget.LinearLayout", "android.view.ViewGroup", "androidx.recyclerview.widget.RecyclerView"]
+LEAF_CLASSES = ["android.widget.TextView", "android.widget.Button", "android.widget.ImageView", "android.widget.EditText", "android.widget.CheckBox", "android.widget.ImageButton"]
+WORDS = ["login", "home", "search", "profile", "settings", "cart", "order", "submit", "next", "email", "password", "offers", "help", "account", "share", "save"]
+
+
+def random_text(rng, text_length):
+    if text_length <= 0:
+        return ""
+    words = []
+    while len(" ".join(words)) < text_length:
+        words.append(rng.choice(WORDS))
+    return " ".join(words)[:text_length]
+
+def generate_hierarchy(node_count=1000, max_depth=12, fan_out=6, clickable_ratio=0.3, text_length=16, package="com.example.bench", width=1080, height=2340, seed=0):
+    """
+    Generate a uiautomator style hierarchy dump.
+
+    Nodes are created breadth first: every container gets up to fan_out children until node_count
+    is reached or max_depth is hit, and each child takes a horizontal slice of its parent's bounds.
+
+    Args:
+        node_count: Number of <node> elements in the dump
+        max_depth: Maximum depth of the hierarchy below the root node
+        fan_out: Maximum children per container
+        clickable_ratio: Fraction of nodes marked clickable
+        text_length: Length of the text/content-desc of text carrying nodes
+        package: Package name put on every node
+        width, height: Screen bounds of the root node
+        seed: Random seed, the same arguments always produce the same dump
+    """
+    rng = random.Random(seed)
+    # node -> {"depth", "bounds", "children"}
+    nodes = [{"depth": 0, "bounds": (0, 0, width, height), "children": []}]
+    frontier = [0]
+    while len(nodes) < node_count and frontier:
+        next_frontier = []
+        for parent_index in frontier:
+            parent = nodes[parent_index]
+            if parent["depth"] >= max_depth:
+                continue
+            child_count = min(rng.randint(1, fan_out), node_count - len(nodes))
+            left, top, right, bottom = parent["bounds"]
+            slice_height = max(1, (bottom - top) // max(child_count, 1))
+            for child_position in range(child_count):
+                child_top = min(bottom, top + child_position * slice_height)
+                nodes.append({"depth": parent["depth"] + 1, "bounds": (left, child_top, right, min(bottom, child_top + slice_height)), "children": []})
+                parent["children"].append(len(nodes) - 1)
+                next_frontier.append(len(nodes) - 1)
+            if len(nodes) >= node_count:
+                break
+        frontier = next_frontier
+
+    def render(node_index, index_in_parent):
+        node = nodes[node_index]
+        is_leaf = not node["children"]
+        element_class = rng.choice(LEAF_CLASSES) if is_leaf else rng.choice(CONTAINER_CLASSES)
+        clickable = rng.random() < clickable_ratio
+        text = random_text(rng, text_length) if is_leaf and rng.random() < 0.6 else ""
+        content_desc = random_text(rng, text_length) if is_leaf and not text and rng.random() < 0.5 else ""
+        resource_id = f"{package}:id/{rng.choice(WORDS)}_{node_index}" if rng.random() < 0.7 else ""
+        left, top, right, bottom = node["bounds"]
+        attributes = {
+            "index": str(index_in_parent), "text": text, "resource-id": resource_id, "class": element_class, "package": package,
+            "content-desc": content_desc, "checkable": str(element_class.endswith("CheckBox")).lower(), "checked": "false",
+            "clickable": str(clickable).lower(), "enabled": "true", "focusable": str(clickable).lower(), "focused": "false",
+            "scrollable": str(element_class.endswith("RecyclerView")).lower(), "long-clickable": "false",
+            "password": str(element_class.endswith("EditText") and "password" in text).lower(), "selected": "false",
+            "bounds": f"[{left},{top}][{right},{bottom}]", "displayed": "true"
+        }
+        rendered_attributes = " ".join(f"{name}={quoteattr(value)}" for name, value in attributes.items())
+        children = "".join(render(child_index, position) for position, child_index in enumerate(node["children"]))
+        return f"<node {rendered_attributes}>{children}</node>" if children else f"<node {rendered_attributes}/>"
+
+    return f"<?xml version='1.0' encoding='UTF-8' standalone='yes' ?><hierarchy rotation=\"0\">{render(0, 0)}</hierarchy>"
+
+def generate_screenshot(width=1080, height=2340, image_format="PNG", seed=0):
+    """Base64 encoded screenshot with a few coloured blocks, sized like a phone screen."""
+    rng = random.Random(seed)
+    image = Image.new("RGB", (width, height), "white")
+    for _ in range(20):
+        left, top = rng.randint(0, width - 100), rng.randint(0, height - 100)
+        block = Image.new("RGB", (rng.randint(50, 400), rng.randint(50, 200)), tuple(rng.randint(0, 255) for _ in range(3)))
+        image.paste(block, (left, top))
+    buffered = BytesIO()
+    image.save(buffered, format=image_format)
+    return base64.b64encode(buffered.getvalue()).decode()
@@ -0,0 +1,161 @@
+import asyncio
+import contextvars
+import os
+import time
+from metrics import STAGE_TIMEOUTS_TOTAL, HEDGED_ATTEMPTS_TOTAL
+from resilience import get_dependency_guard
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Latency budget of the request being served; stages read it to bound their waits
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+# Attempt of call_with_deadline running in the current thread, as {"budget_limited", "counted"}; the called
+# function reports through it whether its failure counts against the dependency
+current_attempt = contextvars.ContextVar("current_attempt", default=None)
+
+LATENCY_BUDGET_MS = float(os.getenv("LATENCY_BUDGET_MS", "0"))
+# Time kept back from the budget for mapping data fields and serializing the response
+LATENCY_BUDGET_RESERVE_MS = float(os.getenv("LATENCY_BUDGET_RESERVE_MS", "150"))
+# Upper bounds of each external call when the request has no latency budget
+AGENT_REQUEST_TIMEOUT_SECONDS = float(os.getenv("AGENT_REQUEST_TIMEOUT_SECONDS", "30"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+# A hedge is a second full call (for the LLM a second vision prompt) on exactly the slow, large screens, so it is opt-in
+HEDGED_RETRIES_ENABLED = os.getenv("HEDGED_RETRIES_ENABLED", "false").lower() == "true"
+# A hedge attempt starts once this fraction of the stage timeout has passed without an answer
+HEDGE_AFTER_FRACTION = float(os.getenv("HEDGE_AFTER_FRACTION", "0.5"))
+# Share of the whole budget each stage may take at most. Popup runs alone before the others, so it gets a
+# small share; datagen and the LLM run concurrently and may use whatever is left.
+STAGE_BUDGET_SHARES = {"popup": 0.2, "datagen": 1.0, "llm": 1.0}
+DEFAULT_STAGE_TIMEOUTS = {"popup": AGENT_REQUEST_TIMEOUT_SECONDS, "datagen": AGENT_REQUEST_TIMEOUT_SECONDS, "llm": LLM_TIMEOUT_SECONDS}
+MIN_ATTEMPT_SECONDS = 0.05
+
+
+class Deadline:
+    def __init__(self, budget_ms=None):
+        """
+        Latency budget of one request. A budget of None or 0 means the request is only bounded by the
+        per-stage default timeouts.
+        """
+        self.budget_ms = budget_ms if budget_ms and budget_ms > 0 else None
+        self.start_time = time.monotonic()
+        self.degraded_stages = set()
+
+    def remaining_seconds(self):
+        if self.budget_ms is None:
+            return None
+        return self.budget_ms / 1000 - LATENCY_BUDGET_RESERVE_MS / 1000 - (time.monotonic() - self.start_time)
+
+    def stage_timeout(self, stage):
+        default_timeout = DEFAULT_STAGE_TIMEOUTS.get(stage, AGENT_REQUEST_TIMEOUT_SECONDS)
+        remaining = self.remaining_seconds()
+        if remaining is None:
+            return default_timeout
+        return max(0.0, min(default_timeout, remaining, self.budget_ms / 1000 * STAGE_BUDGET_SHARES.get(stage, 1.0)))
+
+    def mark_degraded(self, stage):
+        self.degraded_stages.add(stage)
+
+
+def start_deadline(budget_ms=None):
+    """Start the deadline of the current request; the request's own budget takes precedence over LATENCY_BUDGET_MS."""
+    deadline = Deadline(budget_ms if budget_ms is not None else LATENCY_BUDGET_MS)
+    request_deadline.set(deadline)
+    return deadline
+
+def get_stage_timeout(stage):
+    deadline = request_deadline.get()
+    return deadline.stage_timeout(stage) if deadline else DEFAULT_STAGE_TIMEOUTS.get(stage, AGENT_REQUEST_TIMEOUT_SECONDS)
+
+def get_remaining_seconds():
+    """Seconds left of the current request's latency budget, or None when it has none."""
+    deadline = request_deadline.get()
+    return max(0.0, deadline.remaining_seconds()) if deadline and deadline.budget_ms is not None else None
+
+def mark_degraded(stage):
+    deadline = request_deadline.get()
+    if deadline:
+        deadline.mark_degraded(stage)
+
+def get_degraded_stages():
+    deadline = request_deadline.get()
+    return sorted(deadline.degraded_stages) if deadline else []
+
+def is_timeout_error(error):
+    # requests, httpx and the OpenAI client each have their own timeout classes
+    return isinstance(error, TimeoutError) or any("Timeout" in error_class.__name__ for error_class in type(error).__mro__)
+
+def skip_attempt():
+    """Called by a function run through call_with_deadline that returns None without calling the dependency."""
+    attempt = current_attempt.get()
+    if attempt is not None:
+        attempt["counted"] = False
+
+def record_attempt_error(error):
+    """
+    Called by a function run through call_with_deadline when the dependency call raised. A timeout on a timeout
+    the request's latency budget cut short is the caller's doing, not the dependency's, and does not count.
+    """
+    attempt = current_attempt.get()
+    if attempt is not None and attempt["budget_limited"] and is_timeout_error(error):
+        attempt["counted"] = False
+
+async def run_attempt(guard, fn, args, kwargs, timeout_seconds, stage):
+    attempt = {"budget_limited": timeout_seconds < DEFAULT_STAGE_TIMEOUTS.get(stage, AGENT_REQUEST_TIMEOUT_SECONDS), "counted": True}
+    # The attempt runs as its own task, so this only reaches the thread the call runs in
+    current_attempt.set(attempt)
+    success = False
+    try:
+        result = await asyncio.to_thread(fn, *args, timeout=timeout_seconds, **kwargs)
+        success = result is not None
+        return result
+    finally:
+        # Runs when the call really ends, also for attempts the request stopped waiting for
+        guard.release(True if success else (False if attempt["counted"] else None))
+
+async def call_with_deadline(request_id, stage, fn, /, *args, **kwargs):
+    """
+    Run the blocking call fn(*args, timeout=..., **kwargs) in a thread, bounded by the stage timeout.
+    fn must return None when it fails, after reporting the error with record_attempt_error, or skip_attempt
+    when it did not call the dependency. When the first attempt is slow (HEDGE_AFTER_FRACTION of the timeout)
+    or fails early, and enough of the budget is left, a second attempt is started and the first answer wins.
+    Calls go through the stage's circuit breaker and concurrency limiter; a rejected call returns None at once.
+    Returns the result, or None when no attempt answered in time.
+    """
+    timeout_seconds = get_stage_timeout(stage)
+    if timeout_seconds < MIN_ATTEMPT_SECONDS:
+        logger.warning("No latency budget left for %s; skipping", stage, extra={"request_id": request_id})
+        STAGE_TIMEOUTS_TOTAL.inc(stage=stage)
+        return None
+    guard = get_dependency_guard(stage)
+    if not await guard.acquire(request_id, timeout_seconds):
+        return None
+    # Waiting for a free slot used up part of the budget
+    timeout_seconds = max(MIN_ATTEMPT_SECONDS, get_stage_timeout(stage))
+    end_time = time.monotonic() + timeout_seconds
+    hedge_time = time.monotonic() + timeout_seconds * HEDGE_AFTER_FRACTION
+    attempts = {asyncio.create_task(run_attempt(guard, fn, args, kwargs, timeout_seconds, stage))}
+    hedged = not HEDGED_RETRIES_ENABLED
+    while attempts:
+        remaining = end_time - time.monotonic()
+        if remaining <= 0:
+            break
+        wait_seconds = remaining if hedged else max(0.0, min(remaining, hedge_time - time.monotonic()))
+        done, attempts = await asyncio.wait(attempts, timeout=wait_seconds, return_when=asyncio.FIRST_COMPLETED)
+        for attempt in done:
+            result = attempt.result() if not attempt.exception() else None
+            if result is not None:
+                return result
+        # Hedge once: on a slow first attempt, or right away when it failed and there is time for another
+        remaining = end_time - time.monotonic()
+        if not hedged and (done or time.monotonic() >= hedge_time):
+            hedged = True
+            if remaining >= MIN_ATTEMPT_SECONDS and guard.try_acquire():
+                HEDGED_ATTEMPTS_TOTAL.inc(stage=stage)
+                logger.info("Starting hedged %s attempt with %s milliseconds left", stage, round(remaining * 1000), extra={"request_id": request_id})
+                attempts.add(asyncio.create_task(run_attempt(guard, fn, args, kwargs, remaining, stage)))
+    if attempts:
+        # Threads cannot be cancelled; the attempts still running end on their own timeout
+        logger.warning("%s did not answer within %s milliseconds", stage, round(timeout_seconds * 1000), extra={"request_id": request_id})
+        STAGE_TIMEOUTS_TOTAL.inc(stage=stage)
+    return None
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import re
+from collections import Counter
+from llm_cache import open_persistent_store, ELEMENT_KNOWLEDGE_NAMESPACE
+from metrics import CACHE_REQUESTS_TOTAL
+
+import logging
+logger = logging.getLogger(__name__)
+
+DIGITS_PATTERN = re.compile(r"\d+")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+# Longer labels are content (product names, messages) rather than app chrome and are not worth remembering
+MAX_LABEL_LENGTH = 80
+
+
+def get_element_knowledge_cache():
+    """The store holding what the LLM said about recurring elements; None when ELEMENT_KNOWLEDGE_ENABLED is false."""
+    if os.getenv("ELEMENT_KNOWLEDGE_ENABLED", "true").lower() != "true":
+        return None
+    return open_persistent_store()
+
+def get_min_sightings():
+    return int(os.getenv("ELEMENT_KNOWLEDGE_MIN_SIGHTINGS", "2"))
+
+def normalise_label(label):
+    # Counters and badges ("Cart 3", "12 new") change between visits of the same element
+    return WHITESPACE_PATTERN.sub(" ", DIGITS_PATTERN.sub("#", label.lower())).strip()
+
+def get_element_key(element):
+    """Key of the element across the screens of its app: package, resource id, class and normalised label."""
+    attributes = element.get("attributes", {})
+    resource_id = attributes.get("resource_id", "")
+    label = normalise_label((attributes.get("text", "") + " " + attributes.get("content_desc", "")).strip())
+    # Without a resource id or a label there is nothing that identifies the same element on another screen
+    if not (resource_id or label) or len(label) > MAX_LABEL_LENGTH:
+        return None
+    key_material = json.dumps([attributes.get("package", ""), resource_id, attributes.get("class", ""), label])
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+def lookup_elements(request_id, cache, elements):
+    """
+    Returns {node_id: (key, entry)} for the elements with a key of their own on the screen; entry is the stored
+    {"action_description", "sightings"}, or None for an element not seen before.
+    """
+    keys = {element.get("node_id"): get_element_key(element) for element in elements}
+    key_counts = Counter(keys.values())
+    # Repeated keys are list items told apart only by their content (product images, row icons); what the
+    # LLM says about one of them does not hold for the others
+    keys = {node_id: key for node_id, key in keys.items() if key is not None and key_counts[key] == 1}
+    stored = cache.get_many(ELEMENT_KNOWLEDGE_NAMESPACE, list(keys.values()))
+    CACHE_REQUESTS_TOTAL.inc(len(stored), cache=ELEMENT_KNOWLEDGE_NAMESPACE, result="hit")
+    CACHE_REQUESTS_TOTAL.inc(len(keys) - len(stored), cache=ELEMENT_KNOWLEDGE_NAMESPACE, result="miss")
+    return {node_id: (key, json.loads(stored[key]) if key in stored else None) for node_id, key in keys.items()}
+
+def get_known_descriptions(lookups):
+    """Action descriptions of the elements the LLM described on at least ELEMENT_KNOWLEDGE_MIN_SIGHTINGS screens."""
+    min_sightings = get_min_sightings()
+    return {node_id: entry["action_description"] for node_id, (key, entry) in lookups.items() if entry and entry["sightings"] >= min_sightings}
+
+def learn_element_descriptions(request_id, cache, lookups, ranked_elements):
+    """Count the action descriptions of an LLM response towards their elements; known elements are left as they are."""
+    min_sightings = get_min_sightings()
+    learned = 0
+    for element in ranked_elements:
+        action_description = element.get("action_description")
+        lookup = lookups.get(element.get("node_id"))
+        if not action_description or lookup is None:
+            continue
+        key, entry = lookup
+        if entry and entry["sightings"] >= min_sightings:
+            continue
+        cache.put(ELEMENT_KNOWLEDGE_NAMESPACE, key, json.dumps({"action_description": action_description, "sightings": (entry["sightings"] if entry else 0) + 1}))
+        learned += 1
+    if learned:
+        logger.debug("Learned action descriptions of %s elements", learned, extra={"request_id": request_id})
+    return learned
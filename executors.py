@@ -0,0 +1,123 @@
+import asyncio
+import contextvars
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException
+from metrics import stage_timer, record_timing, EXECUTOR_WAIT
+from memory import start_worker_peak, get_worker_peak
+from log_config import configure_worker_logging
+
+import logging
+logger = logging.getLogger(__name__)
+
+# EXECUTOR_MODE decides where CPU-bound stages run:
+#   process - parsing and image work in a process pool, light CPU work in a thread pool (default)
+#   thread  - everything in the thread pool
+#   inline  - everything on the event loop, as before
+EXECUTOR_MODE = os.getenv("EXECUTOR_MODE", "process").lower()
+PROCESS_POOL_WORKERS = int(os.getenv("PROCESS_POOL_WORKERS", str(os.cpu_count() or 1)))
+THREAD_POOL_WORKERS = int(os.getenv("THREAD_POOL_WORKERS", "4"))
+# Process pool workers are never forked from the service itself, which runs the log listener and the thread pools:
+# forking a process with threads can leave a worker stuck on a lock one of them held. The fork server is a
+# single-threaded process that preloads the modules the tasks come from and forks the workers; spawn starts each
+# worker from scratch where there is no fork server (macOS before 3.12 defaults, Windows)
+PROCESS_POOL_START_METHOD = os.getenv("PROCESS_POOL_START_METHOD", "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+PROCESS_POOL_PRELOAD = ["ui_tree", "utils"]
+# Tasks submitted but not finished, per pool, before new work is rejected with a 503
+EXECUTOR_MAX_QUEUE_DEPTH = int(os.getenv("EXECUTOR_MAX_QUEUE_DEPTH", "64"))
+
+process_pool = None
+thread_pool = None
+pool_lock = threading.Lock()
+pending_tasks = {"process": 0, "thread": 0}
+
+
+def get_process_pool():
+    global process_pool
+    with pool_lock:
+        if process_pool is None:
+            context = multiprocessing.get_context(PROCESS_POOL_START_METHOD)
+            if PROCESS_POOL_START_METHOD == "forkserver":
+                context.set_forkserver_preload(PROCESS_POOL_PRELOAD)
+            process_pool = ProcessPoolExecutor(max_workers=PROCESS_POOL_WORKERS, mp_context=context, initializer=configure_worker_logging)
+        return process_pool
+
+def get_thread_pool():
+    global thread_pool
+    with pool_lock:
+        if thread_pool is None:
+            thread_pool = ThreadPoolExecutor(max_workers=THREAD_POOL_WORKERS, thread_name_prefix="mneme-cpu")
+        return thread_pool
+
+def shutdown_executors():
+    global process_pool, thread_pool
+    with pool_lock:
+        if process_pool is not None:
+            process_pool.shutdown(wait=False, cancel_futures=True)
+            process_pool = None
+        if thread_pool is not None:
+            thread_pool.shutdown(wait=False, cancel_futures=True)
+            thread_pool = None
+
+def run_timed(fn, args, kwargs):
+    # Runs inside the worker; the wall clock start is compared with the submit time to get the queue wait
+    return time.time(), fn(*args, **kwargs)
+
+def run_measured(fn, args, kwargs):
+    # Runs inside a process pool worker, whose memory the request's accounting in the parent does not see
+    memory_state = start_worker_peak()
+    started_at, result = run_timed(fn, args, kwargs)
+    return started_at, get_worker_peak(memory_state), result
+
+def record_wait(request_id, stage, pool_name, wait_ms):
+    EXECUTOR_WAIT.observe(wait_ms / 1000, stage=stage, pool=pool_name)
+    record_timing(f"{stage}_queue_ms", wait_ms)
+    logger.debug("Time spent waiting for %s executor", pool_name, extra={"request_id": request_id, "stage": stage, "wait_ms": round(wait_ms, 3)})
+
+async def run_on_executor(request_id, stage, pool_name, fn, *args, **kwargs):
+    with stage_timer(stage) as timer:
+        result, worker_peak_bytes = await submit_to_executor(request_id, stage, pool_name, fn, *args, **kwargs)
+        timer.memory.record_worker_peak(worker_peak_bytes)
+        return result
+
+async def submit_to_executor(request_id, stage, pool_name, fn, *args, **kwargs):
+    """Returns (result, peak memory of the worker process in bytes, or None outside the process pool)."""
+    if EXECUTOR_MODE == "inline":
+        return fn(*args, **kwargs), None
+    if EXECUTOR_MODE == "thread":
+        pool_name = "thread"
+    if pending_tasks[pool_name] >= EXECUTOR_MAX_QUEUE_DEPTH:
+        logger.error("%s executor queue is full; rejecting stage - %s", pool_name, stage, extra={"request_id": request_id})
+        raise HTTPException(status_code=503, detail=f"requestid :: {request_id} :: Server is busy, please retry")
+    pool = get_process_pool() if pool_name == "process" else get_thread_pool()
+    pending_tasks[pool_name] += 1
+    submitted_at = time.time()
+    try:
+        if pool_name == "thread":
+            # Threads run the stage in a copy of the request's context, so its logs carry the request_id
+            started_at, result = await asyncio.get_running_loop().run_in_executor(pool, contextvars.copy_context().run, run_timed, fn, args, kwargs)
+            worker_peak_bytes = None
+        else:
+            started_at, worker_peak_bytes, result = await asyncio.get_running_loop().run_in_executor(pool, run_measured, fn, args, kwargs)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory); drop the pool so the next task starts a fresh one
+        global process_pool
+        with pool_lock:
+            process_pool = None
+        raise
+    finally:
+        pending_tasks[pool_name] -= 1
+    record_wait(request_id, stage, pool_name, (started_at - submitted_at) * 1000)
+    return result, worker_peak_bytes
+
+async def run_in_process(request_id, stage, fn, *args, **kwargs):
+    """Run a CPU-heavy stage (XML parsing, image work) in the process pool. Arguments and result must be picklable."""
+    return await run_on_executor(request_id, stage, "process", fn, *args, **kwargs)
+
+async def run_in_thread(request_id, stage, fn, *args, **kwargs):
+    """Run a light CPU stage in the thread pool so it does not hold the event loop."""
+    return await run_on_executor(request_id, stage, "thread", fn, *args, **kwargs)
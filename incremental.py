@@ -0,0 +1,258 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from lxml import etree
+from ui_tree import parse_uitree
+from executors import run_in_thread
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Patch operations, applied in order. Nodes are addressed by their path of child positions from the root
+# of the hierarchy ("" is the root itself, "0/2" the third child of its first child), evaluated against
+# the tree as left by the previous operation.
+#   {"op": "set_attributes", "path": ..., "attributes": {name: value or None to remove}}
+#   {"op": "replace", "path": ..., "xml": "<node .../>"}
+#   {"op": "insert", "path": <parent path>, "index": <position, default last>, "xml": "<node .../>"}
+#   {"op": "remove", "path": ...}
+PATCH_OPERATIONS = ["set_attributes", "replace", "insert", "remove"]
+
+
+class PatchError(Exception):
+    """The patch cannot be applied to the session's tree."""
+
+
+class SessionTree:
+    def __init__(self, uitree, patching=False):
+        # uitree.root is the lxml tree the patches are applied to; it is kept in step with the graph. It is only
+        # built once the session has sent a patch (patching), so sessions that always send full XML parse it once
+        self.uitree = uitree
+        self.patching = patching
+        self.xml_version = get_xml_version(uitree.xml)
+        self.last_used = time.monotonic()
+
+
+class SessionTreeCache:
+    def __init__(self, max_sessions=256, ttl_seconds=600.0):
+        """
+        Last screen of each session, parsed, so that the next step can be sent as a patch against it.
+
+        The cache is per worker process; a patch sent to a worker that does not hold the session is
+        rejected and the client falls back to sending the full XML.
+
+        Args:
+            max_sessions: Sessions kept; the least recently used one is dropped beyond this
+            ttl_seconds: Sessions not used for this long are dropped
+        """
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.trees = OrderedDict() # session_id -> SessionTree
+        self.locks = dict() # session_id -> asyncio.Lock serialising the steps of a session
+
+    def get_lock(self, session_id):
+        if session_id not in self.locks:
+            self.locks[session_id] = asyncio.Lock()
+        return self.locks[session_id]
+
+    def evict(self):
+        expiry = time.monotonic() - self.ttl_seconds
+        for session_id in [session_id for session_id, tree in self.trees.items() if tree.last_used < expiry]:
+            self.drop(session_id)
+        while len(self.trees) > self.max_sessions:
+            self.drop(next(iter(self.trees)))
+
+    def drop(self, session_id):
+        self.trees.pop(session_id, None)
+        lock = self.locks.get(session_id)
+        if lock is not None and not lock.locked():
+            self.locks.pop(session_id, None)
+
+    def get(self, session_id):
+        self.evict()
+        tree = self.trees.get(session_id)
+        if tree is not None:
+            tree.last_used = time.monotonic()
+            self.trees.move_to_end(session_id)
+        return tree
+
+    def put(self, session_id, tree):
+        self.trees[session_id] = tree
+        self.trees.move_to_end(session_id)
+        self.evict()
+
+
+def get_xml_version(xml):
+    return hashlib.sha1(xml.encode('utf-8')).hexdigest()
+
+def get_patched_xml_version(xml_version, operations):
+    """Version of a patched screen, from the version the patch applies to and the patch; the tree is not serialised."""
+    return hashlib.sha1((xml_version + json.dumps(operations, sort_keys=True)).encode('utf-8')).hexdigest()
+
+async def parse_session_tree(request_id, xml, patching=False):
+    """
+    Parse a full upload into a SessionTree. The UITree is built in the process pool like any other screen.
+    The lxml tree patches are applied to does not survive the trip back; for a session that sends patches it
+    is parsed again here, for the others only when their first patch arrives (see load_xml_tree).
+    """
+    uitree = await parse_uitree(request_id, xml, keep_xml_tree=patching)
+    session_tree = SessionTree(uitree, patching=patching)
+    if patching:
+        await load_xml_tree(request_id, session_tree)
+    return session_tree
+
+async def load_xml_tree(request_id, session_tree):
+    """Parse the lxml tree of the session's screen, if not done yet, and mark the session as sending patches."""
+    if session_tree.uitree.root is None:
+        session_tree.uitree.root = await run_in_thread(request_id, "parse_xml", etree.fromstring, session_tree.uitree.xml.encode('utf-8'))
+    session_tree.patching = True
+
+def get_xml_node_at_path(xml_root, path):
+    node = xml_root
+    for position in [part for part in str(path).split('/') if part != '']:
+        children = list(node)
+        if not position.isdigit() or int(position) >= len(children):
+            raise PatchError(f"No node at path {path}")
+        node = children[int(position)]
+    return node
+
+def split_path(path):
+    parts = [part for part in str(path).split('/') if part != '']
+    if not parts or not parts[-1].isdigit():
+        raise PatchError(f"Path {path} does not address a child node")
+    return "/".join(parts[:-1]), int(parts[-1])
+
+def parse_patch_node(operation):
+    try:
+        return etree.fromstring(str(operation.get("xml", "")).encode('utf-8'))
+    except etree.XMLSyntaxError as e:
+        raise PatchError(f"Invalid XML in {operation.get('op')} operation at path {operation.get('path')} - {str(e)}")
+
+def validate_patch(operations):
+    """Check the shape of every operation before any is applied, so a malformed patch leaves the tree untouched."""
+    if not isinstance(operations, list):
+        raise PatchError("xml_patch must be a list of operations")
+    for position, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            raise PatchError(f"Operation {position} is not an object")
+        kind = operation.get("op")
+        if kind not in PATCH_OPERATIONS:
+            raise PatchError(f"Unknown patch operation {kind}; expected one of {PATCH_OPERATIONS}")
+        if not isinstance(operation.get("path", ""), (str, int)) or isinstance(operation.get("path"), bool):
+            raise PatchError(f"Operation {position} has a path that is not a string")
+        if kind == "set_attributes":
+            attributes = operation.get("attributes")
+            if not isinstance(attributes, dict) or not all(isinstance(name, str) and (value is None or isinstance(value, (str, int, float, bool)))
+                                                           for name, value in attributes.items()):
+                raise PatchError(f"Operation {position} needs attributes as an object of names to string values or null")
+        if kind in ["replace", "insert"] and not isinstance(operation.get("xml"), str):
+            raise PatchError(f"Operation {position} needs the node's xml as a string")
+        if kind == "insert" and operation.get("index") is not None and (not isinstance(operation.get("index"), int) or isinstance(operation.get("index"), bool)):
+            raise PatchError(f"Operation {position} has an index that is not an integer")
+
+def apply_patch(request_id, session_tree, operations):
+    """
+    Apply the patch operations to the session's tree and refresh only the subtrees they touch: the changed
+    node with its descendants (which inherit fields from it) and, for inserts and removals, the later
+    siblings, whose xpath positions shift. Returns the number of refreshed elements.
+    Raises PatchError for any operation that cannot be applied; the operations before it may already be, so the
+    caller has to drop the session's tree.
+    """
+    validate_patch(operations)
+    uitree = session_tree.uitree
+    xml_root = uitree.root
+    affected = set()
+
+    def remove(parent_id, xml_parent, index):
+        children = uitree.get_children(parent_id)
+        if index >= len(children) or index >= len(xml_parent):
+            raise PatchError(f"No child {index} to remove")
+        xml_parent.remove(xml_parent[index])
+        uitree.remove_subtree(children[index])
+        affected.update(children[index + 1:])
+
+    def insert(parent_id, xml_parent, index, node):
+        children = uitree.get_children(parent_id)
+        if index < 0 or index > len(children):
+            raise PatchError(f"Cannot insert at position {index} of a node with {len(children)} children")
+        xml_parent.insert(index, node)
+        affected.add(uitree.insert_subtree(parent_id, index, node))
+        affected.update(children[index:])
+
+    for operation in operations:
+        kind, path = operation.get("op"), operation.get("path", "")
+        try:
+            if kind == "set_attributes":
+                attributes = operation["attributes"]
+                xml_node = get_xml_node_at_path(xml_root, path)
+                for name, value in attributes.items():
+                    if value is None:
+                        xml_node.attrib.pop(name, None)
+                    else:
+                        xml_node.set(name, str(value))
+                node_id = uitree.get_node_at_path(path)
+                uitree.set_node_attributes(node_id, attributes)
+                affected.add(node_id)
+            elif kind == "insert":
+                parent_id, xml_parent = uitree.get_node_at_path(path), get_xml_node_at_path(xml_root, path)
+                index = operation.get("index")
+                insert(parent_id, xml_parent, len(xml_parent) if index is None else index, parse_patch_node(operation))
+            else:
+                parent_path, index = split_path(path)
+                parent_id, xml_parent = uitree.get_node_at_path(parent_path), get_xml_node_at_path(xml_root, parent_path)
+                node = parse_patch_node(operation) if kind == "replace" else None
+                remove(parent_id, xml_parent, index)
+                if node is not None:
+                    insert(parent_id, xml_parent, index, node)
+        except PatchError:
+            raise
+        except Exception as e:
+            # lxml rejects e.g. invalid attribute names; any failure leaves the tree half patched
+            raise PatchError(f"{kind} operation at path {path} failed - {str(e)}") from e
+
+    refreshed = uitree.refresh_subtrees(affected)
+    # The XML is serialised from the lxml tree only if a stage reads it (see get_uitree_xml)
+    uitree.xml = None
+    session_tree.xml_version = get_patched_xml_version(session_tree.xml_version, operations)
+    logger.debug("Patch applied", extra={"request_id": request_id, "operations": len(operations), "refreshed_elements": refreshed, "elements": len(uitree.ui_element_dict_processed)})
+    return refreshed
+
+def make_xml_patch(previous_xml, xml):
+    """
+    Patch turning previous_xml into xml, for clients and replays. Nodes are compared position by position:
+    attribute changes become set_attributes, a node whose tag or number of children changed is replaced.
+    """
+    operations = []
+
+    def compare(previous_node, node, path):
+        if previous_node.tag != node.tag or len(previous_node) != len(node):
+            if not path:
+                raise PatchError("The root node changed; send the full XML")
+            operations.append({"op": "replace", "path": path, "xml": etree.tostring(node, encoding='unicode')})
+            return
+        changed = {name: value for name, value in node.attrib.items() if previous_node.get(name) != value}
+        changed.update({name: None for name in previous_node.attrib if name not in node.attrib})
+        if changed:
+            operations.append({"op": "set_attributes", "path": path, "attributes": changed})
+        for position, (previous_child, child) in enumerate(zip(previous_node, node)):
+            compare(previous_child, child, f"{path}/{position}" if path else str(position))
+
+    compare(etree.fromstring(previous_xml.encode('utf-8')), etree.fromstring(xml.encode('utf-8')), "")
+    return operations
+
+def is_incremental_mode_enabled():
+    return os.getenv("INCREMENTAL_UPDATES_ENABLED", "true").lower() == "true"
+
+
+session_tree_cache = None
+
+def get_session_tree_cache():
+    global session_tree_cache
+    if not is_incremental_mode_enabled():
+        return None
+    if session_tree_cache is None:
+        session_tree_cache = SessionTreeCache(max_sessions=int(os.getenv("INCREMENTAL_MAX_SESSIONS", "256")),
+                                              ttl_seconds=float(os.getenv("INCREMENTAL_SESSION_TTL_SECONDS", "600")))
+    return session_tree_cache
@@ -0,0 +1,239 @@
+import base64
+import gzip
+import os
+import zlib
+import orjson
+import zstandard
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+from python_multipart.multipart import MultipartParser, MultipartParseError, parse_options_header
+from metrics import PAYLOAD_BYTES
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Largest request body accepted after decompression, so a small compressed body cannot expand without bound
+MAX_REQUEST_BODY_BYTES = int(float(os.getenv("MAX_REQUEST_BODY_MB", "64")) * 1024 * 1024)
+# Responses smaller than this are sent uncompressed; compressing them costs more than it saves
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+RESPONSE_COMPRESSION_ENABLED = os.getenv("RESPONSE_COMPRESSION_ENABLED", "true").lower() == "true"
+# Response encodings in order of preference
+RESPONSE_ENCODINGS = ["zstd", "gzip"]
+
+
+# Largest piece of decompressed output produced at once, so memory stays bounded whatever the compression ratio
+DECOMPRESSED_CHUNK_BYTES = 1024 * 1024
+
+
+def raise_body_too_large():
+    raise HTTPException(status_code=413, detail=f"Request body exceeds {MAX_REQUEST_BODY_BYTES} bytes")
+
+
+class ZlibBodyDecompressor:
+    def __init__(self, wbits):
+        self.decompressor = zlib.decompressobj(wbits)
+
+    def decompress(self, data, limit):
+        """Yield the output for data in pieces of at most DECOMPRESSED_CHUNK_BYTES; 413 once it passes limit bytes."""
+        while data:
+            # One byte over the limit is enough to tell the body is too large
+            chunk = self.decompressor.decompress(data, min(limit + 1, DECOMPRESSED_CHUNK_BYTES))
+            limit -= len(chunk)
+            if limit < 0:
+                raise_body_too_large()
+            if chunk:
+                yield chunk
+            data = self.decompressor.unconsumed_tail
+
+    def flush(self, limit):
+        # With no input left, what the decompressor still holds is a few bytes of its last block
+        chunk = self.decompressor.flush()
+        if len(chunk) > limit:
+            raise_body_too_large()
+        if chunk:
+            yield chunk
+
+
+class ZstdBodyDecompressor:
+    """
+    zstd decompression pulled through a stream reader in reads of DECOMPRESSED_CHUNK_BYTES. Compressed chunks
+    are fed to the reader's source as they arrive; a read returns nothing once the source has run dry.
+    """
+    def __init__(self):
+        self.compressed = bytearray()
+        self.reader = zstandard.ZstdDecompressor().stream_reader(self, read_across_frames=True, closefd=False)
+
+    def read(self, size):
+        data = bytes(self.compressed[:size])
+        del self.compressed[:size]
+        return data
+
+    def decompress(self, data, limit):
+        self.compressed.extend(data)
+        while True:
+            chunk = self.reader.read(min(limit + 1, DECOMPRESSED_CHUNK_BYTES))
+            if not chunk:
+                return
+            limit -= len(chunk)
+            if limit < 0:
+                raise_body_too_large()
+            yield chunk
+
+    def flush(self, limit):
+        # Everything the compressed data holds has been read out
+        return iter(())
+
+
+def get_decompressor(content_encoding):
+    """Streaming decompressor for a Content-Encoding header, or None for an uncompressed body."""
+    if content_encoding in ("", "identity"):
+        return None
+    if content_encoding in ("gzip", "x-gzip"):
+        return ZlibBodyDecompressor(16 + zlib.MAX_WBITS)
+    if content_encoding == "deflate":
+        return ZlibBodyDecompressor(zlib.MAX_WBITS)
+    if content_encoding == "zstd":
+        return ZstdBodyDecompressor()
+    raise HTTPException(status_code=415, detail=f"Unsupported Content-Encoding {content_encoding}; use gzip or zstd")
+
+async def iterate_body(request: Request):
+    """
+    Yield the request body chunk by chunk as it arrives, decompressed, enforcing MAX_REQUEST_BODY_BYTES. Compressed
+    bodies are decompressed in bounded pieces and rejected as soon as the limit is passed, before the rest is inflated.
+    """
+    decompressor = get_decompressor(request.headers.get("content-encoding", "").strip().lower())
+    wire_bytes, body_bytes = 0, 0
+    try:
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            wire_bytes += len(chunk)
+            if decompressor is None:
+                body_bytes += len(chunk)
+                if body_bytes > MAX_REQUEST_BODY_BYTES:
+                    raise_body_too_large()
+                yield chunk
+                continue
+            for piece in decompressor.decompress(chunk, MAX_REQUEST_BODY_BYTES - body_bytes):
+                body_bytes += len(piece)
+                yield piece
+        if decompressor is not None:
+            for piece in decompressor.flush(MAX_REQUEST_BODY_BYTES - body_bytes):
+                body_bytes += len(piece)
+                yield piece
+    except (zlib.error, zstandard.ZstdError) as e:
+        raise HTTPException(status_code=400, detail=f"Request body could not be decompressed - {str(e)}")
+    PAYLOAD_BYTES.observe(wire_bytes, kind="request")
+
+
+class DecodedRequest(Request):
+    async def body(self) -> bytes:
+        if not hasattr(self, "_body"):
+            self._body = b"".join([chunk async for chunk in iterate_body(self)])
+        return self._body
+
+
+class DecodedRoute(APIRoute):
+    """Route whose request body may be sent gzip or zstd compressed (Content-Encoding)."""
+    def get_route_handler(self):
+        route_handler = super().get_route_handler()
+
+        async def decoded_route_handler(request: Request):
+            return await route_handler(DecodedRequest(request.scope, request.receive))
+
+        return decoded_route_handler
+
+
+async def read_multipart(request: Request):
+    """
+    Parse a multipart/form-data body into {part name: bytearray}. Parts are collected in memory as the body
+    streams in; nothing is spooled to disk and no part is decoded or validated here.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not options.get(b"boundary"):
+        raise HTTPException(status_code=415, detail="Expected a multipart/form-data body with a boundary")
+
+    parts = dict()
+    current = {"headers": dict(), "data": bytearray()}
+    header_field, header_value = bytearray(), bytearray()
+
+    def on_part_begin():
+        current["headers"], current["data"] = dict(), bytearray()
+
+    def on_header_field(data, start, end):
+        header_field.extend(memoryview(data)[start:end])
+
+    def on_header_value(data, start, end):
+        header_value.extend(memoryview(data)[start:end])
+
+    def on_header_end():
+        current["headers"][bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    def on_part_data(data, start, end):
+        current["data"].extend(memoryview(data)[start:end])
+
+    def on_part_end():
+        _, disposition = parse_options_header(current["headers"].get(b"content-disposition", b""))
+        parts[disposition.get(b"name", b"").decode("utf-8")] = current["data"]
+
+    parser = MultipartParser(options[b"boundary"], callbacks={
+        "on_part_begin": on_part_begin, "on_header_field": on_header_field, "on_header_value": on_header_value,
+        "on_header_end": on_header_end, "on_part_data": on_part_data, "on_part_end": on_part_end
+    })
+    try:
+        async for chunk in iterate_body(request):
+            parser.write(chunk)
+        parser.finalize()
+    except MultipartParseError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid multipart body - {str(e)}")
+    return parts
+
+def encode_image(image_bytes):
+    # Raw uploads are encoded once here for the agents and the LLM, which take base64 images
+    return base64.b64encode(image_bytes).decode("ascii")
+
+def get_response_encoding(accept_encoding):
+    """Preferred encoding from RESPONSE_ENCODINGS that the client accepts, or None."""
+    accepted = set()
+    for item in (accept_encoding or "").lower().split(","):
+        encoding, _, parameters = item.strip().partition(";")
+        if parameters.strip().replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(encoding.strip())
+    return next((encoding for encoding in RESPONSE_ENCODINGS if encoding in accepted), None)
+
+def project_ranked_actions(ranked_actions, fields):
+    """
+    Ranked actions reduced to the requested fields. A field is taken from the action (node_id, llm_rank,
+    action_description, generated_data, ...) or else from its attributes (bounds, xpath, resource_id, ...);
+    fields an action does not have are left out.
+    """
+    projected = []
+    for action in ranked_actions:
+        attributes = action.get("attributes") or {}
+        entry = dict()
+        for field in fields:
+            if field in action:
+                entry[field] = action[field]
+            elif field in attributes:
+                entry[field] = attributes[field]
+        projected.append(entry)
+    return projected
+
+def serialize_response(payload):
+    # orjson is several times faster than json.dumps on the nested ranked actions. Unlike json.dumps without a
+    # default, values it cannot serialise are written as their str() rather than failing the response, and
+    # non-string keys are converted as json.dumps does
+    return orjson.dumps(payload, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+def compress_response(body, accept_encoding):
+    """Returns (body, headers) with the body compressed for the client when it is worth it."""
+    encoding = get_response_encoding(accept_encoding) if RESPONSE_COMPRESSION_ENABLED else None
+    if encoding is None or len(body) < RESPONSE_COMPRESSION_MIN_BYTES:
+        return body, {"Vary": "Accept-Encoding"}
+    if encoding == "zstd":
+        body = zstandard.ZstdCompressor(level=3).compress(body)
+    else:
+        body = gzip.compress(body, compresslevel=6)
+    return body, {"Content-Encoding": encoding, "Vary": "Accept-Encoding"}
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import re
+from lxml import etree
+from llm_cache import open_persistent_store
+
+import logging
+logger = logging.getLogger(__name__)
+
+INPUT_CLASS_PATTERN = re.compile(r"EditText|AutoCompleteTextView|TextInput|SearchView|SearchBox|TextField", re.IGNORECASE)
+INPUT_HINT_PATTERN = re.compile(r"email|e-mail|password|passcode|phone|mobile|otp|pin|user ?name|login|first ?name|last ?name|full ?name|address|city|zip|postal|card_?number|card ?no|cvv|expiry|search|enter|input|field", re.IGNORECASE)
+NON_INPUT_CLASS_PATTERN = re.compile(r"Button|ImageView|CheckBox|Switch|RadioButton|ProgressBar|Image$|Layout|ViewGroup|RecyclerView|ListView|ScrollView|ViewPager", re.IGNORECASE)
+WEBVIEW_CLASS = "android.webkit.WebView"
+
+
+def is_input_field(attributes, inside_webview, is_leaf):
+    """
+    EditText style classes and password fields are inputs. Leaf views that only look like inputs (focusable,
+    with an input-like resource id or description) count when they are not buttons, images or containers;
+    inside a WebView, where form fields are exposed as plain views, the view's text is used as label too.
+    """
+    element_class = attributes.get('class', '')
+    if INPUT_CLASS_PATTERN.search(element_class) or attributes.get('password') == 'true':
+        return True
+    if not is_leaf or attributes.get('focusable') != 'true' or NON_INPUT_CLASS_PATTERN.search(element_class):
+        return False
+    label = " ".join([attributes.get('resource-id', '').split('/')[-1], attributes.get('content-desc', '')])
+    if inside_webview:
+        label = label + " " + attributes.get('text', '')
+        return attributes.get('clickable') == 'true' and bool(INPUT_HINT_PATTERN.search(label))
+    return bool(INPUT_HINT_PATTERN.search(label)) and attributes.get('clickable') == 'true' and not attributes.get('text')
+
+def find_input_fields(uitree):
+    """Node ids of the input fields on the screen, in document order."""
+    input_node_ids = []
+    inside_webview_by_node = dict() # node_id -> True when the node is inside a WebView
+    for node_id in uitree.graph.nodes:
+        attributes = uitree.graph.nodes[node_id].get('attributes', {})
+        parent_id = uitree.get_parent(node_id)
+        inside_webview = inside_webview_by_node.get(parent_id, False) or attributes.get('class') == WEBVIEW_CLASS
+        inside_webview_by_node[node_id] = inside_webview
+        if attributes and is_input_field(attributes, inside_webview, is_leaf=uitree.graph.out_degree(node_id) == 0):
+            input_node_ids.append(node_id)
+    return input_node_ids
+
+def get_field_signature(uitree, input_node_ids):
+    """
+    Identifies the form on a screen: package plus class, resource id, description, password flag and bounds of
+    each input. Typed text is left out so that a partly filled form keeps its signature.
+    """
+    fields = []
+    for node_id in input_node_ids:
+        attributes = uitree.graph.nodes[node_id].get('attributes', {})
+        fields.append([attributes.get(name, '') for name in ['package', 'class', 'resource-id', 'content-desc', 'password', 'bounds']])
+    return hashlib.sha256(json.dumps(fields).encode('utf-8')).hexdigest()
+
+def build_input_subtree_xml(uitree, input_node_ids):
+    """
+    XML holding only the input fields, their ancestors and their siblings (which usually carry the field
+    labels), with the original attributes so bounds still match the full screen.
+    """
+    keep = set()
+    for node_id in input_node_ids:
+        parent_id = uitree.get_parent(node_id)
+        keep.add(node_id)
+        keep.update(uitree.get_children(node_id))
+        if parent_id is not None:
+            keep.update(uitree.get_children(parent_id))
+        while parent_id is not None:
+            keep.add(parent_id)
+            parent_id = uitree.get_parent(parent_id)
+
+    def build(node_id, parent_element):
+        node_data = uitree.graph.nodes[node_id]
+        element = etree.Element(node_data['tag'], node_data.get('attributes', {})) if parent_element is None else etree.SubElement(parent_element, node_data['tag'], node_data.get('attributes', {}))
+        for child_id in uitree.get_children(node_id):
+            if child_id in keep:
+                build(child_id, element)
+        return element
+
+    root_ids = [node_id for node_id in keep if uitree.get_parent(node_id) is None]
+    if not root_ids:
+        return None
+    return etree.tostring(build(root_ids[0], None), encoding='unicode')
+
+def prepare_datagen_input(uitree):
+    """Returns (input node ids, field signature, subtree XML); the last two are None when there are no inputs."""
+    input_node_ids = find_input_fields(uitree)
+    if not input_node_ids:
+        return input_node_ids, None, None
+    return input_node_ids, get_field_signature(uitree, input_node_ids), build_input_subtree_xml(uitree, input_node_ids)
+
+def get_test_data_cache_key(field_signature, config_data):
+    return hashlib.sha256(json.dumps({"fields": field_signature, "config_data": config_data or {}}, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def is_input_detection_enabled():
+    return os.getenv("INPUT_FIELD_DETECTION_ENABLED", "true").lower() == "true"
+
+def get_test_data_cache():
+    if os.getenv("TEST_DATA_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    return open_persistent_store()
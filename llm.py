@@ -1,14 +1,30 @@
-from langchain_openai import ChatOpenAI
+import os
+import threading
+from deadline import LLM_TIMEOUT_SECONDS
+from llm_scheduler import is_llm_scheduler_enabled
 import logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+llm_clients = dict() # api key -> client shared by all requests
+llm_clients_lock = threading.Lock()
 
 def initialize_llm(OPENAI_API_KEY):
+    # langchain_openai (and openai under it) is most of the app's import time, so it is loaded on first use
+    from langchain_openai import ChatOpenAI
 
     return ChatOpenAI(
         model="gpt-4o",
         temperature=0,
         max_tokens=None,
-        timeout=None,
-        max_retries=2,
+        timeout=LLM_TIMEOUT_SECONDS,
+        # Under a rate limit scheduler a 429 pauses the scheduler rather than being retried by the client
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "0" if is_llm_scheduler_enabled() else "2")),
         api_key=OPENAI_API_KEY,
-    )
\ No newline at end of file
+    )
+
+def get_llm(OPENAI_API_KEY):
+    """LLM client shared across requests, so its HTTP connection pool is reused."""
+    with llm_clients_lock:
+        if OPENAI_API_KEY not in llm_clients:
+            llm_clients[OPENAI_API_KEY] = initialize_llm(OPENAI_API_KEY)
+        return llm_clients[OPENAI_API_KEY]
@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+LLM_PRIORITIZATION_NAMESPACE = "llm_prioritization"
+TEST_DATA_NAMESPACE = "test_data"
+ELEMENT_KNOWLEDGE_NAMESPACE = "element_knowledge"
+# SQLite's default limit on the parameters of one statement is 999 on older builds
+MAX_KEYS_PER_QUERY = 500
+
+
+class PersistentStore:
+    def __init__(self, path, max_bytes, eviction_check_interval=50):
+        """
+        Durable key-value store on SQLite in WAL mode, safe to share between uvicorn worker processes.
+
+        Entries are grouped by namespace so that one file can hold several caches. When the total
+        size of the values crosses max_bytes, least recently used entries are evicted down to 90%
+        of the limit and the freed pages are returned to the file system.
+
+        Args:
+            path: SQLite database file
+            max_bytes: Upper bound on the total size of the stored values
+            eviction_check_interval: Number of writes between two checks of the total size
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.eviction_check_interval = eviction_check_interval
+        self.writes_since_check = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.initialize()
+
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            # auto_vacuum only takes effect on a new database before anything writes its header, switching to WAL
+            # included; on an existing one this is a no-op
+            connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=10000")
+            self.local.connection = connection
+        return connection
+
+    def initialize(self):
+        connection = self.get_connection()
+        if connection.execute("PRAGMA auto_vacuum").fetchone()[0] == 0:
+            # A store created without it never gives freed pages back; a one-time VACUUM switches it over
+            logger.info("Persistent store %s has no incremental auto_vacuum; vacuuming it once", self.path)
+            connection.execute("VACUUM")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        connection.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+
+    def get(self, namespace, key):
+        try:
+            connection = self.get_connection()
+            row = connection.execute("SELECT value FROM entries WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE namespace = ? AND key = ?", (time.time(), namespace, key))
+            return row[0]
+        except sqlite3.Error as e:
+            logger.exception("Persistent store read failed for namespace %s - %s", namespace, e)
+            return None
+
+    def get_many(self, namespace, keys):
+        """Values of the keys that are stored, by key; read with one query per MAX_KEYS_PER_QUERY keys."""
+        values = dict()
+        try:
+            connection = self.get_connection()
+            for start in range(0, len(keys), MAX_KEYS_PER_QUERY):
+                batch = keys[start:start + MAX_KEYS_PER_QUERY]
+                placeholders = ",".join("?" * len(batch))
+                values.update(connection.execute(f"SELECT key, value FROM entries WHERE namespace = ? AND key IN ({placeholders})", (namespace, *batch)).fetchall())
+            if values:
+                now = time.time()
+                connection.executemany("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE namespace = ? AND key = ?", [(now, namespace, key) for key in values])
+            return values
+        except sqlite3.Error as e:
+            logger.exception("Persistent store read failed for namespace %s - %s", namespace, e)
+            return values
+
+    def put(self, namespace, key, value):
+        try:
+            now = time.time()
+            connection = self.get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (namespace, key, value, size, created_at, last_access, hits) VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (namespace, key, value, len(value.encode('utf-8')), now, now)
+            )
+            with self.lock:
+                self.writes_since_check += 1
+                check_size = self.writes_since_check >= self.eviction_check_interval
+                if check_size:
+                    self.writes_since_check = 0
+            if check_size:
+                self.evict()
+        except sqlite3.Error as e:
+            logger.exception("Persistent store write failed for namespace %s - %s", namespace, e)
+
+    def evict(self):
+        connection = self.get_connection()
+        total_bytes = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        target_bytes = int(self.max_bytes * 0.9)
+        bytes_to_free = total_bytes - target_bytes
+        # Walk entries from least recently used and delete until enough space is freed
+        freed_bytes = 0
+        keys_to_delete = []
+        for namespace, key, size in connection.execute("SELECT namespace, key, size FROM entries ORDER BY last_access ASC"):
+            keys_to_delete.append((namespace, key))
+            freed_bytes += size
+            if freed_bytes >= bytes_to_free:
+                break
+        connection.executemany("DELETE FROM entries WHERE namespace = ? AND key = ?", keys_to_delete)
+        self.compact()
+        logger.info("Persistent store evicted %s entries", len(keys_to_delete), extra={"freed_bytes": freed_bytes, "size_before_bytes": total_bytes})
+
+    def compact(self):
+        connection = self.get_connection()
+        # The pragma frees one page per step, and execute() steps a statement without result columns only once;
+        # executescript() steps it to the end
+        connection.executescript("PRAGMA incremental_vacuum;")
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def stats(self):
+        connection = self.get_connection()
+        entries, total_bytes = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"entries": entries, "bytes": total_bytes}
+
+
+def get_llm_cache_key(llm, messages):
+    """Hash of the prompt messages together with the model parameters that change the completion."""
+    key_material = json.dumps({
+        "model": getattr(llm, 'model_name', None),
+        "temperature": getattr(llm, 'temperature', None),
+        "max_tokens": getattr(llm, 'max_tokens', None),
+        "messages": messages
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+
+persistent_store = None
+persistent_store_lock = threading.Lock()
+
+def get_persistent_store():
+    """The store used as LLM response cache; None when LLM_CACHE_ENABLED is false."""
+    if os.getenv("LLM_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    return open_persistent_store()
+
+def open_persistent_store():
+    global persistent_store
+    if persistent_store is None:
+        with persistent_store_lock:
+            if persistent_store is None:
+                try:
+                    persistent_store = PersistentStore(path=os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3"),
+                                                       max_bytes=int(float(os.getenv("LLM_CACHE_MAX_MB", "512")) * 1024 * 1024))
+                except sqlite3.Error as e:
+                    logger.exception("Persistent store could not be opened; continuing without cache - %s", e)
+                    return None
+    return persistent_store
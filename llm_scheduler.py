@@ -0,0 +1,291 @@
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from fastapi import HTTPException
+from metrics import LLM_QUEUE_DEPTH, LLM_QUEUE_WAIT, LLM_SCHEDULER_REJECTIONS_TOTAL, LLM_TOKEN_BUDGET
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Priority class of each phase; lower classes are served first. A journey in progress comes first, then the
+# search for journey start nodes; the home search is often answered by the screen graph anyway.
+DEFAULT_PHASE_PRIORITIES = {"explore-user-journeys": 0, "identify-journey-start-nodes": 1, "find-home-node": 2}
+DEFAULT_PRIORITY = 1
+# Prompt tokens are estimated from the prompt's length; images and the completion from these figures. A portrait
+# phone screenshot sent at high detail is 8 tiles of 170 tokens plus 85.
+CHARACTERS_PER_TOKEN = 4
+IMAGE_TOKEN_ESTIMATE = int(os.getenv("LLM_IMAGE_TOKEN_ESTIMATE", "1445"))
+OUTPUT_TOKEN_ESTIMATE = int(os.getenv("LLM_OUTPUT_TOKEN_ESTIMATE", "600"))
+LLM_SCHEDULER_MAX_QUEUE_DEPTH = int(os.getenv("LLM_SCHEDULER_MAX_QUEUE_DEPTH", "256"))
+# Pause after a provider 429 that names no Retry-After
+DEFAULT_RATE_LIMIT_PAUSE_SECONDS = 1.0
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        """
+        Budget refilling continuously at per_minute and holding at most a minute's worth. Usage reported after
+        a call may take it below zero; the debt is paid back by refilling before the next call is let through.
+        """
+        self.rate = per_minute / 60
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        with self.lock:
+            self.refill()
+            return self.tokens
+
+    def seconds_until(self, amount):
+        """Seconds until amount is available; a call larger than the whole bucket only waits for a full bucket."""
+        with self.lock:
+            self.refill()
+            return max(0.0, (amount - self.tokens) / self.rate)
+
+    def consume(self, amount):
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+
+
+class LLMTicket:
+    def __init__(self, scheduler, request_id, session_key, priority, tokens):
+        """
+        An LLM call waiting for, or granted, its turn. The estimated tokens are charged when it is granted;
+        the attempts of the call report what they really used.
+        """
+        self.scheduler = scheduler
+        self.request_id = request_id
+        self.session_key = session_key
+        self.priority = priority
+        self.tokens = tokens
+        self.uncharged_estimate = tokens
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+        self.lock = threading.Lock()
+
+    def record_usage(self, used_tokens):
+        # The first attempt settles the estimate charged at grant time; a hedged attempt is charged in full
+        with self.lock:
+            charged, self.uncharged_estimate = self.uncharged_estimate, 0
+        self.scheduler.token_bucket.consume(used_tokens - charged)
+
+    def record_rate_limit(self, retry_after_seconds):
+        self.scheduler.pause(retry_after_seconds)
+
+    def start_attempt(self):
+        """False for a hedged attempt while the provider asked for a pause; the first attempt always goes ahead."""
+        with self.lock:
+            self.attempts += 1
+            return self.attempts == 1 or self.scheduler.paused_until <= time.monotonic()
+
+
+class LLMScheduler:
+    def __init__(self, model, tokens_per_minute, requests_per_minute=0, max_queue_depth=256, phase_priorities=None):
+        """
+        Lets LLM calls for one model through at the rate of the provider's quota. Calls wait in priority classes
+        (by phase); within a class the sessions take turns, so one busy session does not hold up the others.
+        A call that could not be let through within its time budget is rejected with a 429 before it waits.
+
+        Args:
+            model: Model the quota is for
+            tokens_per_minute: Token budget (prompt and completion) of this worker
+            requests_per_minute: Request budget of this worker; 0 for none
+            max_queue_depth: Calls waiting at most; further calls are rejected
+            phase_priorities: {phase: priority class}, lower served first
+        """
+        self.model = model
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.max_queue_depth = max_queue_depth
+        self.phase_priorities = phase_priorities if phase_priorities is not None else DEFAULT_PHASE_PRIORITIES
+        self.queues = dict() # priority -> OrderedDict(session key -> deque of tickets), sessions in turn order
+        self.queued_tokens = dict() # priority -> estimated tokens waiting
+        self.queued_calls = dict() # priority -> calls waiting
+        self.paused_until = 0.0
+        self.pause_lock = threading.Lock()
+        self.dispatcher = None
+        self.wakeup = None
+
+    def get_priority(self, phase):
+        return self.phase_priorities.get(phase, DEFAULT_PRIORITY)
+
+    def get_budget_wait(self, tokens, calls):
+        wait = max(0.0, self.paused_until - time.monotonic(), self.token_bucket.seconds_until(tokens))
+        if self.request_bucket:
+            wait = max(wait, self.request_bucket.seconds_until(calls))
+        return wait
+
+    def estimate_wait(self, priority, tokens):
+        """Time until a new call of this priority would be let through, behind the calls of its class and the classes before it."""
+        ahead = [queue_priority for queue_priority in self.queued_calls if queue_priority <= priority]
+        return self.get_budget_wait(sum(self.queued_tokens[queue_priority] for queue_priority in ahead) + tokens,
+                                    sum(self.queued_calls[queue_priority] for queue_priority in ahead) + 1)
+
+    def reject(self, request_id, reason, retry_after_seconds):
+        LLM_SCHEDULER_REJECTIONS_TOTAL.inc(model=self.model, reason=reason)
+        logger.warning("LLM call rejected by the rate limit scheduler - %s", reason, extra={"request_id": request_id, "model": self.model, "retry_after_seconds": round(retry_after_seconds, 3)})
+        raise HTTPException(status_code=429, detail=f"requestid :: {request_id} :: LLM rate limit reached, please retry",
+                            headers={"Retry-After": str(max(1, math.ceil(retry_after_seconds)))})
+
+    def update_queue_gauge(self, priority):
+        LLM_QUEUE_DEPTH.set(self.queued_calls.get(priority, 0), model=self.model, priority=priority)
+
+    def enqueue(self, ticket):
+        self.queues.setdefault(ticket.priority, OrderedDict()).setdefault(ticket.session_key, deque()).append(ticket)
+        self.queued_tokens[ticket.priority] = self.queued_tokens.get(ticket.priority, 0) + ticket.tokens
+        self.queued_calls[ticket.priority] = self.queued_calls.get(ticket.priority, 0) + 1
+        self.update_queue_gauge(ticket.priority)
+
+    def dequeue(self, ticket):
+        sessions = self.queues[ticket.priority]
+        sessions[ticket.session_key].remove(ticket)
+        if sessions[ticket.session_key]:
+            # The session goes to the back of the turn order
+            sessions.move_to_end(ticket.session_key)
+        else:
+            del sessions[ticket.session_key]
+        if not sessions:
+            del self.queues[ticket.priority]
+        self.queued_tokens[ticket.priority] -= ticket.tokens
+        self.queued_calls[ticket.priority] -= 1
+        self.update_queue_gauge(ticket.priority)
+        if not self.queued_calls[ticket.priority]:
+            del self.queued_tokens[ticket.priority], self.queued_calls[ticket.priority]
+
+    def get_next_ticket(self):
+        if not self.queues:
+            return None
+        sessions = self.queues[min(self.queues)]
+        return sessions[next(iter(sessions))][0]
+
+    async def dispatch(self):
+        while True:
+            ticket = self.get_next_ticket()
+            if ticket is None:
+                break
+            wait = self.get_budget_wait(min(ticket.tokens, self.token_bucket.capacity), 1)
+            if wait > 0:
+                # New calls may change which one is next, so their arrival ends the wait early
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.dequeue(ticket)
+            self.token_bucket.consume(ticket.tokens)
+            if self.request_bucket:
+                self.request_bucket.consume(1)
+            LLM_TOKEN_BUDGET.set(round(self.token_bucket.available()), model=self.model)
+            ticket.future.set_result(True)
+        self.dispatcher = None
+
+    def wake_dispatcher(self):
+        if self.dispatcher is None or self.dispatcher.done():
+            self.wakeup = asyncio.Event()
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        self.wakeup.set()
+
+    async def acquire(self, request_id, session_key, phase, tokens, timeout_seconds):
+        """
+        Wait until the call may be made. Raises a 429 HTTPException, with Retry-After, when the queue is full
+        or the call would not be let through within timeout_seconds. Returns the LLMTicket of the call.
+        """
+        priority = self.get_priority(phase)
+        if sum(self.queued_calls.values()) >= self.max_queue_depth:
+            self.reject(request_id, "queue_full", self.estimate_wait(priority, tokens))
+        estimated_wait = self.estimate_wait(priority, tokens)
+        if estimated_wait > timeout_seconds:
+            self.reject(request_id, "over_budget", estimated_wait)
+
+        ticket = LLMTicket(self, request_id, session_key, priority, tokens)
+        self.enqueue(ticket)
+        self.wake_dispatcher()
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout_seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if not ticket.future.done():
+                self.dequeue(ticket)
+                ticket.future.cancel()
+                self.wake_dispatcher()
+        LLM_QUEUE_WAIT.observe(time.monotonic() - ticket.enqueued_at, model=self.model, priority=priority)
+        if ticket.future.cancelled():
+            self.reject(request_id, "timed_out", self.estimate_wait(priority, tokens))
+        return ticket
+
+    def pause(self, seconds):
+        """The provider answered 429; nothing is let through for seconds. May be called from any thread."""
+        with self.pause_lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def status(self):
+        return {
+            "tokens_available": round(self.token_bucket.available()),
+            "queued": {str(priority): calls for priority, calls in sorted(self.queued_calls.items())},
+            "paused_for_seconds": round(max(0.0, self.paused_until - time.monotonic()), 3)
+        }
+
+
+def estimate_tokens(messages):
+    """Prompt and completion tokens of a call, estimated from its messages."""
+    characters, images = 0, 0
+    for _, content in messages:
+        for part in (content if isinstance(content, list) else [content]):
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                images += 1
+            else:
+                characters += len(part.get("text", "") if isinstance(part, dict) else str(part))
+    return characters // CHARACTERS_PER_TOKEN + images * IMAGE_TOKEN_ESTIMATE + OUTPUT_TOKEN_ESTIMATE
+
+def get_retry_after_seconds(error):
+    """Pause asked for by a provider 429 error, or None when the error is not a rate limit."""
+    if getattr(error, "status_code", None) != 429:
+        return None
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        return float(headers.get("retry-after", DEFAULT_RATE_LIMIT_PAUSE_SECONDS))
+    except ValueError:
+        return DEFAULT_RATE_LIMIT_PAUSE_SECONDS
+
+def load_json_setting(name, default):
+    try:
+        return json.loads(os.getenv(name) or "null") or default
+    except ValueError as e:
+        logger.error("Invalid %s; using the default - %s", name, e)
+        return default
+
+def is_llm_scheduler_enabled():
+    return float(os.getenv("LLM_TOKENS_PER_MINUTE", "0")) > 0 or bool(os.getenv("LLM_RATE_LIMITS"))
+
+
+llm_schedulers = dict() # model -> LLMScheduler, or None for a model without a quota
+
+def get_llm_scheduler(model):
+    """Scheduler for the model's quota; None when no quota is configured for it."""
+    if model not in llm_schedulers:
+        limits = load_json_setting("LLM_RATE_LIMITS", {}).get(model, {})
+        tokens_per_minute = float(limits.get("tokens_per_minute", os.getenv("LLM_TOKENS_PER_MINUTE", "0")))
+        requests_per_minute = float(limits.get("requests_per_minute", os.getenv("LLM_REQUESTS_PER_MINUTE", "0")))
+        llm_schedulers[model] = LLMScheduler(model, tokens_per_minute, requests_per_minute, LLM_SCHEDULER_MAX_QUEUE_DEPTH,
+                                             load_json_setting("LLM_PHASE_PRIORITIES", DEFAULT_PHASE_PRIORITIES)) if tokens_per_minute > 0 else None
+    return llm_schedulers[model]
+
+def get_llm_scheduler_status():
+    return {model: scheduler.status() for model, scheduler in llm_schedulers.items() if scheduler}
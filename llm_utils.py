@@ -1,24 +1,32 @@
-from langsmith import traceable
-from langchain.prompts import PromptTemplate
-from prompts import action_prioritization_template, screen_context_generation_template, phase_objective_map, action_prioritization_template_objective_phase_2
+import functools
+from tracing import traceable
+from prompts import action_prioritization_template, screen_context_generation_template, phase_objective_map, action_prioritization_template_objective_phase_2, known_elements_instruction, partition_instruction, partition_merge_instruction
+from llm_cache import get_persistent_store, get_llm_cache_key, LLM_PRIORITIZATION_NAMESPACE
+from llm_scheduler import get_retry_after_seconds
+from deadline import record_attempt_error, skip_attempt
+from metrics import LLM_TOKENS_TOTAL, CACHE_REQUESTS_TOTAL, REQUEST_ERRORS_TOTAL, LLM_RATE_LIMITED_TOTAL
 
-import traceback
 import logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
-@traceable
-# Use LangChain for reasoning-based prioritization
-def llm_prioritize_actions(request_id, screen_context, base64_image, actions, history, user_prompt, phase, llm):
-    """
-    Use an LLM to prioritize actions based on screen context and history.
-    Args:
-    - screen_context: Textual representation of the current screen.
-    - actions: List of available actions with descriptions.
-    - history: Log of previously performed actions.
-    - llm: LangChain LLM object.
+SCREENSHOT_IMAGE_TEXT = "Here is the screenshot of the mobile app screen with actionable elements annotated on the image with node_id. Please create an understanding of the screen to give a prioritization to the elements to act on and the order to act on."
+REGION_IMAGE_TEXT = "Here is the part of the mobile app screen holding these actionable elements, annotated on the image with node_id. Please create an understanding of this part of the screen to give a prioritization to the elements to act on and the order to act on."
+CROPPED_IMAGE_TEXT = "Here are the parts of the mobile app screen showing the actionable elements that have no text label, each under its node_id. The other elements are described by their text. Please use these to give a prioritization to the elements to act on and the order to act on."
+IMAGE_TEXTS = {"full": SCREENSHOT_IMAGE_TEXT, "crops": CROPPED_IMAGE_TEXT, "region": REGION_IMAGE_TEXT}
 
-    Returns:
-    - List of actions ranked by priority with explanations.
+@functools.lru_cache(maxsize=None)
+def get_prompt_template(template, input_variables):
+    # langchain's prompt module is slow to import and the templates never change, so both happen once
+    from langchain.prompts import PromptTemplate
+    return PromptTemplate(input_variables=list(input_variables), template=template)
+
+def build_prioritization_messages(screen_context, base64_image, actions, history, user_prompt, phase, image_kind="full", region=None, partition_merge=False):
+    """
+    Prompt messages asking the LLM to prioritize the actions. The image is attached when given: the annotated
+    screenshot (image_kind "full"), the cropped regions of the unlabeled elements (image_kind "crops") or the
+    annotated part of the screenshot holding the actions (image_kind "region"). region describes where the
+    actions are when they are one partition of a large screen; partition_merge asks for the order of the best
+    actions of all partitions.
     """
     selected_user_prompt = user_prompt
     objective = action_prioritization_template_objective_phase_2
@@ -30,7 +38,7 @@ def llm_prioritize_actions(request_id, screen_context, base64_image, actions, hi
             
 
     # Create prompt template
-    prompt_template = PromptTemplate(input_variables=["screen_context", "actions", "history", "user_prompt", "objective"], template=action_prioritization_template)
+    prompt_template = get_prompt_template(action_prioritization_template, ("screen_context", "actions", "history", "user_prompt", "objective"))
     # Fill the prompt template
     filled_prompt = prompt_template.format(
         screen_context=screen_context,
@@ -39,21 +47,93 @@ def llm_prioritize_actions(request_id, screen_context, base64_image, actions, hi
         user_prompt=selected_user_prompt,
         objective=objective
     )
+    if any("known_action" in action for action in actions):
+        filled_prompt = filled_prompt + known_elements_instruction
+    if region:
+        filled_prompt = filled_prompt + partition_instruction.format(region=region)
+    if partition_merge:
+        filled_prompt = filled_prompt + partition_merge_instruction
     messages = [("system", filled_prompt)]
     if base64_image:
         messages.append(("human", [
-                        {"type": "text", "text": "Here is the screenshot of the mobile app screen with actionable elements annotated on the image with node_id. Please create an understanding of the screen to give a prioritization to the elements to act on and the order to act on."},
+                        {"type": "text", "text": IMAGE_TEXTS.get(image_kind, SCREENSHOT_IMAGE_TEXT)},
                         {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
                     ]))
+    return messages
 
+def get_cached_prioritization(request_id, llm, messages):
+    """Returns (cached response or None, cache key); the key is None when the cache is disabled."""
+    llm_cache = get_persistent_store()
+    if not llm_cache:
+        return None, None
+    cache_key = get_llm_cache_key(llm, messages)
+    cached_content = llm_cache.get(LLM_PRIORITIZATION_NAMESPACE, cache_key)
+    if cached_content is None:
+        CACHE_REQUESTS_TOTAL.inc(cache=LLM_PRIORITIZATION_NAMESPACE, result="miss")
+        return None, cache_key
+    CACHE_REQUESTS_TOTAL.inc(cache=LLM_PRIORITIZATION_NAMESPACE, result="hit")
+    logger.debug("LLM prioritization served from persistent cache", extra={"request_id": request_id})
+    from langchain_core.messages import AIMessage
+    return AIMessage(content=cached_content), cache_key
+
+@traceable
+def invoke_prioritization_llm(request_id, messages, llm, cache_key=None, ticket=None, timeout=None):
+    """
+    Send the prioritization messages to the LLM and store the answer under cache_key. ticket is the call's
+    LLMTicket when it went through the rate limit scheduler; it is told the tokens used and any provider 429.
+    Returns the response, or None when the call failed.
+    """
+    if ticket and not ticket.start_attempt():
+        skip_attempt()
+        return None
     try:
         # Invoke the LLM
-        response = llm.invoke(input=messages)
-        logging.info(f"requestid :: {request_id} :: LLM invokation succesfull")
+        response = llm.invoke(input=messages, timeout=timeout) if timeout else llm.invoke(input=messages)
+        logger.debug("LLM invokation succesfull", extra={"request_id": request_id})
+        used_tokens = record_token_usage(response)
+        if ticket and used_tokens:
+            ticket.record_usage(used_tokens)
+        if cache_key and isinstance(response.content, str) and "ranked_actions" in response.content:
+            get_persistent_store().put(LLM_PRIORITIZATION_NAMESPACE, cache_key, response.content)
         return response
     except Exception as e:
-        logging.error(f"requestid :: {request_id} :: LLM invokation failed; couldn't prioritize - {str(e)} -- {traceback.format_exc()}")
+        record_attempt_error(e)
+        retry_after_seconds = get_retry_after_seconds(e)
+        if retry_after_seconds is not None:
+            LLM_RATE_LIMITED_TOTAL.inc(model=getattr(llm, 'model_name', None))
+            if ticket:
+                ticket.record_rate_limit(retry_after_seconds)
+        logger.exception("LLM invokation failed; couldn't prioritize - %s", e, extra={"request_id": request_id})
+        REQUEST_ERRORS_TOTAL.inc(stage="llm")
         return None
+
+@traceable
+# Use LangChain for reasoning-based prioritization
+def llm_prioritize_actions(request_id, screen_context, base64_image, actions, history, user_prompt, phase, llm, timeout=None, image_kind="full"):
+    """
+    Use an LLM to prioritize actions based on screen context and history.
+    Args:
+    - screen_context: Textual representation of the current screen.
+    - actions: List of available actions with descriptions.
+    - history: Log of previously performed actions.
+    - llm: LangChain LLM object.
+    - timeout: Seconds the LLM call may take; the client's timeout when None.
+    - image_kind: "full" for an annotated screenshot, "crops" for the cropped regions of unlabeled elements.
+
+    Returns:
+    - List of actions ranked by priority with explanations.
+    """
+    messages = build_prioritization_messages(screen_context, base64_image, actions, history, user_prompt, phase, image_kind)
+    cached_response, cache_key = get_cached_prioritization(request_id, llm, messages)
+    if cached_response is not None:
+        return cached_response
+    return invoke_prioritization_llm(request_id, messages, llm, cache_key=cache_key, timeout=timeout)
+
+def record_token_usage(response):
+    usage_metadata = getattr(response, 'usage_metadata', None) or {}
+    LLM_TOKENS_TOTAL.inc(usage_metadata.get("input_tokens", 0), direction="in")
+    LLM_TOKENS_TOTAL.inc(usage_metadata.get("output_tokens", 0), direction="out")
+    return usage_metadata.get("input_tokens", 0) + usage_metadata.get("output_tokens", 0)
     
 @traceable
 def llm_generate_screen_context(xml, llm):
@@ -67,7 +147,7 @@ def llm_generate_screen_context(xml, llm):
     - Short description of the text in natural language
     """
     # Create a chain with the LLM and prompt template
-    prompt_template = PromptTemplate(input_variables=["xml"], template=screen_context_generation_template)
+    prompt_template = get_prompt_template(screen_context_generation_template, ("xml",))
     # Fill the prompt template
     filled_prompt = prompt_template.format(
         xml=xml
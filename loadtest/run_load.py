@@ -0,0 +1,257 @@
+"""
+Load test for /invoke against local stand-ins of the LLM, popup handler and test data generator.
+
+Starts the stub services (loadtest/stubs.py) and the Mneme app under uvicorn with its dependencies
+pointed at the stubs, then drives /invoke at a fixed concurrency and reports throughput, latency
+percentiles and event loop lag of both the app and the load generator.
+
+    python -m loadtest.run_load --concurrency 32 --duration 60 --app-workers 2 --with-image
+    python -m loadtest.run_load --target http://localhost:8000 --concurrency 16   # existing deployment
+    python -m loadtest.run_load --with-image --ingest multipart --compress zstd   # raw screenshot, compressed body
+"""
+import argparse
+import asyncio
+import base64
+import glob
+import gzip
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import httpx
+import uvicorn
+import zstandard
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIRECTORY)
+
+from loadtest.stubs import add_stub_arguments, create_stub_app_from_arguments
+from benchmarks.synthetic import generate_hierarchy, generate_screenshot
+
+DUMPS_DIRECTORY = os.path.join(ROOT_DIRECTORY, "benchmarks", "dumps")
+
+
+def start_stub_server(args):
+    config = uvicorn.Config(create_stub_app_from_arguments(args), host="127.0.0.1", port=args.stub_port, log_level="warning")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    return server
+
+def start_app(args):
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    environment = dict(os.environ)
+    environment.update({
+        "OPENAI_API_KEY": "stub-key",
+        "OPENAI_BASE_URL": f"{stub_url}/v1",
+        "POPUP_HANDLER_URL": f"{stub_url}/popup",
+        "TEST_DATA_GENERATOR_URL": f"{stub_url}/datagen",
+        "LANGSMITH_TRACING": "false",
+        "LLM_CACHE_ENABLED": "true" if args.llm_cache else "false",
+        "SCREEN_GRAPH_ENABLED": "false"
+    })
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.app_port),
+               "--workers", str(args.app_workers), "--log-level", "warning"]
+    log_file = open(args.app_log, "w")
+    return subprocess.Popen(command, cwd=ROOT_DIRECTORY, env=environment, stdout=log_file, stderr=subprocess.STDOUT)
+
+def wait_until_ready(url, timeout_seconds=60):
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+        try:
+            # /ready answers 200 once the worker has warmed up, so the first requests are not cold
+            if httpx.get(f"{url}/ready", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.25)
+    raise RuntimeError(f"{url} did not become ready within {timeout_seconds} seconds")
+
+def load_screens(args):
+    screens = []
+    for dump_path in sorted(glob.glob(os.path.join(DUMPS_DIRECTORY, "*.xml"))):
+        with open(dump_path) as dump_file:
+            screens.append(dump_file.read())
+    for size in args.synthetic_sizes:
+        screens.append(generate_hierarchy(node_count=size, seed=size))
+    return screens
+
+def build_payloads(args):
+    image = generate_screenshot() if args.with_image else None
+    payloads = []
+    for xml in load_screens(args):
+        payload = {"xml": xml, "phase": args.phase, "history": []}
+        if image:
+            payload["image"] = image
+        payloads.append(payload)
+    return payloads
+
+def encode_payload(args, payload, request_id):
+    """Returns (path, body, headers) of the payload in the ingest format and content encoding under test."""
+    if args.ingest == "multipart":
+        metadata = {name: value for name, value in payload.items() if name not in ("xml", "image")}
+        files = {"xml": ("screen.xml", payload["xml"].encode("utf-8"), "application/xml"),
+                 "metadata": (None, json.dumps(dict(metadata, request_id=request_id)), "application/json")}
+        if payload.get("image"):
+            files["image"] = ("screen.png", base64.b64decode(payload["image"]), "image/png")
+        request = httpx.Request("POST", "http://mneme/invoke/multipart", files=files)
+        path, body, headers = "/invoke/multipart", request.read(), {"content-type": request.headers["content-type"]}
+    else:
+        path, body, headers = "/invoke", json.dumps(dict(payload, request_id=request_id)).encode("utf-8"), {"content-type": "application/json"}
+    if args.compress == "gzip":
+        body, headers["content-encoding"] = gzip.compress(body), "gzip"
+    elif args.compress == "zstd":
+        body, headers["content-encoding"] = zstandard.ZstdCompressor(level=3).compress(body), "zstd"
+    return path, body, headers
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    position = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[position]
+
+def parse_histogram(metrics_text, name):
+    """Returns ({le: cumulative count}, sum, count) of an unlabelled histogram from Prometheus text."""
+    buckets, total_sum, total_count = dict(), 0.0, 0
+    for line in metrics_text.splitlines():
+        if line.startswith(f"{name}_bucket"):
+            bound = line.split('le="')[1].split('"')[0]
+            buckets[float("inf") if bound == "+Inf" else float(bound)] = float(line.rsplit(" ", 1)[1])
+        elif line.startswith(f"{name}_sum"):
+            total_sum = float(line.rsplit(" ", 1)[1])
+        elif line.startswith(f"{name}_count"):
+            total_count = float(line.rsplit(" ", 1)[1])
+    return buckets, total_sum, total_count
+
+def summarise_lag(before_text, after_text):
+    name = "mneme_event_loop_lag_seconds"
+    buckets_before, sum_before, count_before = parse_histogram(before_text, name)
+    buckets_after, sum_after, count_after = parse_histogram(after_text, name)
+    samples = count_after - count_before
+    if samples <= 0:
+        return None
+    # Upper bound of the bucket that holds the 99th percentile sample
+    p99_bound = None
+    for bound in sorted(buckets_after):
+        if buckets_after[bound] - buckets_before.get(bound, 0) >= 0.99 * samples:
+            p99_bound = bound
+            break
+    return {"samples": samples, "mean_ms": round((sum_after - sum_before) / samples * 1000, 3), "p99_upper_bound_ms": p99_bound * 1000 if p99_bound not in [None, float("inf")] else None}
+
+async def measure_driver_lag(lag_samples, stop_event, interval_seconds=0.05):
+    while not stop_event.is_set():
+        scheduled = time.perf_counter() + interval_seconds
+        await asyncio.sleep(interval_seconds)
+        lag_samples.append(max(0.0, time.perf_counter() - scheduled))
+
+async def drive(args, url, payloads):
+    latencies, statuses = [], dict()
+    # Bodies are encoded (and compressed) up front so the driver's own CPU does not skew the latencies
+    encoded_payloads = [encode_payload(args, payload, f"load-{index}") for index, payload in enumerate(payloads)]
+    stop_event = asyncio.Event()
+    driver_lag_samples = []
+    deadline = time.monotonic() + args.duration
+    sent = 0
+
+    async def worker(client):
+        nonlocal sent
+        while time.monotonic() < deadline and (args.requests is None or sent < args.requests):
+            sent += 1
+            path, body, headers = random.choice(encoded_payloads)
+            start = time.perf_counter()
+            try:
+                response = await client.post(f"{url}{path}", content=body, headers=headers)
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.request_timeout, limits=limits) as client:
+        metrics_before = (await client.get(f"{url}/metrics")).text
+        lag_task = asyncio.create_task(measure_driver_lag(driver_lag_samples, stop_event))
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - start
+        stop_event.set()
+        await lag_task
+        metrics_after = (await client.get(f"{url}/metrics")).text
+        stub_stats = None
+        if not args.target:
+            stub_stats = (await client.get(f"http://127.0.0.1:{args.stub_port}/stats")).json()
+
+    latencies.sort()
+    successful = statuses.get("200", 0)
+    return {
+        "concurrency": args.concurrency,
+        "duration_seconds": round(elapsed, 3),
+        "requests": len(latencies),
+        "statuses": statuses,
+        "ingest": args.ingest,
+        "compress": args.compress,
+        "mean_upload_bytes": round(statistics.mean(len(body) for _, body, _ in encoded_payloads), 1) if encoded_payloads else None,
+        "throughput_rps": round(len(latencies) / elapsed, 3) if elapsed else None,
+        "success_rps": round(successful / elapsed, 3) if elapsed else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50), "p90": percentile(latencies, 0.90), "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99), "max": latencies[-1] if latencies else None,
+            "mean": round(statistics.mean(latencies), 3) if latencies else None
+        },
+        "app_event_loop_lag": summarise_lag(metrics_before, metrics_after),
+        "driver_event_loop_lag_ms": {"p99": round(percentile(sorted(driver_lag_samples), 0.99) * 1000, 3) if driver_lag_samples else None},
+        "stubs": stub_stats
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /invoke with stubbed dependencies")
+    parser.add_argument("--target", help="URL of an already running app; when omitted the app and stubs are started locally")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent in-flight /invoke requests")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to drive load")
+    parser.add_argument("--requests", type=int, default=None, help="Stop after this many requests")
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--app-port", type=int, default=8100)
+    parser.add_argument("--app-workers", type=int, default=1)
+    parser.add_argument("--app-log", default="loadtest_app.log", help="File the app's output is written to")
+    parser.add_argument("--stub-port", type=int, default=9100)
+    parser.add_argument("--with-image", action="store_true", help="Send a synthetic screenshot with every request")
+    parser.add_argument("--synthetic-sizes", type=int, nargs="*", default=[], help="Add synthetic screens of these node counts")
+    parser.add_argument("--phase", default="explore-user-journeys")
+    parser.add_argument("--ingest", choices=["json", "multipart"], default="json", help="Send JSON with a base64 image to /invoke, or raw parts to /invoke/multipart")
+    parser.add_argument("--compress", choices=["none", "gzip", "zstd"], default="none", help="Content-Encoding of the request body")
+    parser.add_argument("--llm-cache", action="store_true", help="Keep the persistent LLM cache enabled in the app")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    app_process = None
+    if args.target:
+        url = args.target.rstrip("/")
+    else:
+        start_stub_server(args)
+        app_process = start_app(args)
+        url = f"http://127.0.0.1:{args.app_port}"
+        try:
+            wait_until_ready(url)
+            httpx.get(f"http://127.0.0.1:{args.stub_port}/stats", timeout=5).raise_for_status()
+        except Exception:
+            app_process.terminate()
+            raise
+    try:
+        report = asyncio.run(drive(args, url, build_payloads(args)))
+    finally:
+        if app_process:
+            app_process.terminate()
+            app_process.wait(timeout=30)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Local stand-ins for the services /invoke depends on, for load tests and CI.
+
+One FastAPI app serves:
+- POST /v1/chat/completions: OpenAI compatible chat endpoint returning valid ranked_actions JSON for the
+  node_ids found in the prompt
+- POST /popup: popup handler agent (Valetudo) response
+- POST /datagen: test data generator agent (Euporie) response
+
+Each stub has its own latency distribution and error rate, e.g.
+
+    python -m loadtest.stubs --port 9100 --llm-latency lognormal:900:0.5 --llm-error-rate 0.01 --popup-latency uniform:20:60
+
+Individual models can be given their own latency and a rate at which they swap neighbouring elements of
+the ranking, to stand in for a smaller, less consistent model:
+
+    python -m loadtest.stubs --llm-model-latency gpt-4o-mini=lognormal:300:0.3 --llm-model-disagreement gpt-4o-mini=0.2
+
+Images can add latency, and rankings made without one can disagree more, to stand in for the cost and the
+value of the screenshot:
+
+    python -m loadtest.stubs --llm-image-latency lognormal:400:0.3 --llm-blind-disagreement 0.1
+
+Latency specs: fixed:<ms>, uniform:<min_ms>:<max_ms>, exponential:<mean_ms>, lognormal:<median_ms>:<sigma>
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import uuid
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import uvicorn
+
+NODE_ID_PATTERN = re.compile(r"'node_id': (\d+)")
+KNOWN_NODE_ID_PATTERN = re.compile(r"'node_id': (\d+), 'known_action'")
+
+
+class LatencyDistribution:
+    def __init__(self, spec):
+        parts = spec.split(":")
+        self.kind = parts[0]
+        self.parameters = [float(value) for value in parts[1:]]
+        if self.kind not in ["fixed", "uniform", "exponential", "lognormal"]:
+            raise ValueError(f"Unknown latency distribution - {spec}")
+
+    def sample_seconds(self):
+        if self.kind == "fixed":
+            milliseconds = self.parameters[0]
+        elif self.kind == "uniform":
+            milliseconds = random.uniform(self.parameters[0], self.parameters[1])
+        elif self.kind == "exponential":
+            milliseconds = random.expovariate(1 / self.parameters[0]) if self.parameters[0] > 0 else 0
+        else:
+            milliseconds = random.lognormvariate(math.log(self.parameters[0]), self.parameters[1]) if self.parameters[0] > 0 else 0
+        return max(milliseconds, 0) / 1000
+
+
+class StubBehaviour:
+    def __init__(self, latency="fixed:0", error_rate=0.0):
+        self.latency = LatencyDistribution(latency)
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+
+    async def delay_or_fail(self):
+        """Sleep for a sampled latency; returns True when this call should fail."""
+        self.calls += 1
+        await asyncio.sleep(self.latency.sample_seconds())
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+
+def count_images(messages):
+    return sum(1 for message in messages if isinstance(message.get("content"), list)
+               for part in message["content"] if isinstance(part, dict) and part.get("type") == "image_url")
+
+def get_prompt_text(messages):
+    texts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            texts.extend(part.get("text", "") for part in content if isinstance(part, dict))
+    return "\n".join(texts)
+
+def build_ranking_content(prompt_text, model, disagreement_rate=0.0):
+    node_ids = list(dict.fromkeys(int(node_id) for node_id in NODE_ID_PATTERN.findall(prompt_text)))
+    # Seeded by the prompt so that a model gives the same ranking for the same screen
+    rng = random.Random(f"{model}:{prompt_text}")
+    for position in range(len(node_ids) - 1):
+        if rng.random() < disagreement_rate:
+            node_ids[position], node_ids[position + 1] = node_ids[position + 1], node_ids[position]
+    # Elements given with their known action are ranked without a description, as the prompt asks
+    known_node_ids = set(int(node_id) for node_id in KNOWN_NODE_ID_PATTERN.findall(prompt_text))
+    return json.dumps({
+        "ranked_actions": [{"node_id": node_id} if node_id in known_node_ids else {"node_id": node_id, "action_description": f"Click the element with node_id {node_id}"} for node_id in node_ids],
+        "explanation": f"Stub ranking from {model}, elements kept in screen order.",
+        "journey_completed": False
+    })
+
+def create_stub_app(llm=None, popup=None, datagen=None, popup_rate=0.0, datagen_rate=0.5, model_behaviours=None, model_disagreement=None, image_latency=None, blind_disagreement=0.0):
+    """
+    Args:
+        llm, popup, datagen: StubBehaviour for each endpoint
+        popup_rate: Fraction of popup calls that report a popup
+        datagen_rate: Fraction of datagen calls that report data generation is required
+        model_behaviours: StubBehaviour by model name, used instead of llm for that model
+        model_disagreement: Rate at which a model swaps neighbouring elements of the ranking, by model name
+        image_latency: LatencyDistribution added for each image in the prompt
+        blind_disagreement: Rate of swaps added when the prompt has no image
+    """
+    app = FastAPI()
+    app.state.behaviours = {"llm": llm or StubBehaviour(), "popup": popup or StubBehaviour(), "datagen": datagen or StubBehaviour()}
+    for model, behaviour in (model_behaviours or {}).items():
+        app.state.behaviours[f"llm:{model}"] = behaviour
+    model_disagreement = model_disagreement or {}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        behaviour = app.state.behaviours.get(f"llm:{body.get('model')}", app.state.behaviours["llm"])
+        if await behaviour.delay_or_fail():
+            return JSONResponse(status_code=500, content={"error": {"message": "Stub LLM error", "type": "server_error"}})
+        images = count_images(body.get("messages", []))
+        if image_latency:
+            await asyncio.sleep(sum(image_latency.sample_seconds() for _ in range(images)))
+        prompt_text = get_prompt_text(body.get("messages", []))
+        disagreement_rate = model_disagreement.get(body.get("model"), 0.0) + (0.0 if images else blind_disagreement)
+        content = build_ranking_content(prompt_text, body.get("model"), disagreement_rate)
+        prompt_tokens = len(prompt_text) // 4
+        completion_tokens = len(content) // 4
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        }
+
+    @app.post("/popup")
+    async def popup_handler(request: Request):
+        await request.body()
+        if await app.state.behaviours["popup"].delay_or_fail():
+            return JSONResponse(status_code=500, content={"status": "error"})
+        return {"status": "success", "agent_response": {"popup_detection": random.random() < popup_rate}}
+
+    @app.post("/datagen")
+    async def test_data_generator(request: Request):
+        await request.body()
+        if await app.state.behaviours["datagen"].delay_or_fail():
+            return JSONResponse(status_code=500, content={"status": "error"})
+        if random.random() < datagen_rate:
+            return {"status": "success", "agent_response": {"data_generation_required": True, "fields": []}}
+        return {"status": "success", "agent_response": {"data_generation_required": False}}
+
+    @app.get("/stats")
+    async def stats():
+        return {name: {"calls": behaviour.calls, "errors": behaviour.errors} for name, behaviour in app.state.behaviours.items()}
+
+    return app
+
+def add_stub_arguments(parser):
+    parser.add_argument("--llm-latency", default="lognormal:800:0.4", help="Latency spec of the chat completions stub")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--popup-latency", default="uniform:30:80", help="Latency spec of the popup handler stub")
+    parser.add_argument("--popup-error-rate", type=float, default=0.0)
+    parser.add_argument("--popup-rate", type=float, default=0.0, help="Fraction of screens reported as having a popup")
+    parser.add_argument("--datagen-latency", default="uniform:100:300", help="Latency spec of the test data generator stub")
+    parser.add_argument("--datagen-error-rate", type=float, default=0.0)
+    parser.add_argument("--datagen-rate", type=float, default=0.5, help="Fraction of screens reported as needing data")
+    parser.add_argument("--llm-model-latency", action="append", default=[], metavar="MODEL=SPEC", help="Latency spec of the chat completions stub for one model")
+    parser.add_argument("--llm-model-disagreement", action="append", default=[], metavar="MODEL=RATE", help="Rate at which one model swaps neighbouring ranked elements")
+    parser.add_argument("--llm-image-latency", help="Latency spec added to the chat completions stub for each image in the prompt")
+    parser.add_argument("--llm-blind-disagreement", type=float, default=0.0, help="Rate of swaps added to rankings made without an image")
+
+def parse_model_options(options):
+    return dict(option.split("=", 1) for option in options)
+
+def create_stub_app_from_arguments(args):
+    return create_stub_app(
+        llm=StubBehaviour(args.llm_latency, args.llm_error_rate),
+        popup=StubBehaviour(args.popup_latency, args.popup_error_rate),
+        datagen=StubBehaviour(args.datagen_latency, args.datagen_error_rate),
+        popup_rate=args.popup_rate,
+        datagen_rate=args.datagen_rate,
+        model_behaviours={model: StubBehaviour(spec, args.llm_error_rate) for model, spec in parse_model_options(args.llm_model_latency).items()},
+        model_disagreement={model: float(rate) for model, rate in parse_model_options(args.llm_model_disagreement).items()},
+        image_latency=LatencyDistribution(args.llm_image_latency) if args.llm_image_latency else None,
+        blind_disagreement=args.llm_blind_disagreement
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub LLM, popup handler and test data generator services")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_stub_app_from_arguments(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import reprlib
+import sys
+import time
+import traceback
+from metrics import LOG_RECORDS_DROPPED_TOTAL
+
+# Request the current code runs for; set at the start of a request and added to every record logged under it.
+# Tasks and asyncio.to_thread calls copy the context; code in the executor pools passes extra={"request_id": ...}.
+log_request_id = contextvars.ContextVar("log_request_id", default=None)
+
+# Attributes every LogRecord has; anything else on a record came from extra= and is logged as a field
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", logging.INFO, "", 0, "", (), None))) | {"message", "asctime", "taskName", "color_message"}
+
+settings = {
+    "max_field_length": 1000,
+    "max_traceback_length": 8000
+}
+field_repr = reprlib.Repr()
+queue_listener = None
+
+
+def set_log_request_id(request_id):
+    log_request_id.set(request_id)
+
+def cap_field(value):
+    """Log-safe copy of a value: scalars as they are, strings truncated, anything else as a bounded repr."""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if not isinstance(value, str):
+        value = field_repr.repr(value)
+    max_length = settings["max_field_length"]
+    if len(value) <= max_length:
+        return value
+    return value[:max_length] + f"... [{len(value) - max_length} more characters]"
+
+def cap_traceback(text):
+    max_length = settings["max_traceback_length"]
+    if len(text) <= max_length:
+        return text
+    # The end of a traceback names the failing call and the exception, so that part is kept
+    return f"[{len(text) - max_length} characters cut] ..." + text[-max_length:]
+
+def get_extra_fields(record):
+    return {name: value for name, value in vars(record).items() if name not in RECORD_ATTRIBUTES and name != "request_id"}
+
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        if getattr(record, "request_id", None) is None:
+            record.request_id = log_request_id.get()
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread, which formats and writes them. When the queue is full the record is
+    dropped and counted rather than making the request wait for the log output.
+    """
+    def prepare(self, record):
+        # The message is formatted later, in the listener thread. Arguments and fields are bounded here, while
+        # they still hold the values they were logged with, and the traceback is rendered while its frames exist.
+        record = copy.copy(record)
+        if isinstance(record.args, tuple):
+            record.args = tuple(cap_field(arg) for arg in record.args)
+        elif isinstance(record.args, dict):
+            record.args = {key: cap_field(arg) for key, arg in record.args.items()}
+        for name, value in get_extra_fields(record).items():
+            setattr(record, name, cap_field(value))
+        if record.exc_info:
+            record.exc_text = cap_traceback("".join(traceback.format_exception(*record.exc_info)).rstrip())
+            record.exc_info = None
+        record.stack_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED_TOTAL.inc(level=record.levelname)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": cap_field(record.getMessage())
+        }
+        if getattr(record, "request_id", None) is not None:
+            entry["request_id"] = record.request_id
+        entry.update(get_extra_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = cap_traceback(self.formatException(record.exc_info))
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        parts = [cap_field(record.getMessage())]
+        if getattr(record, "request_id", None) is not None:
+            parts.insert(0, f"requestid :: {record.request_id}")
+        parts.extend(f"{name} - {value}" for name, value in get_extra_fields(record).items())
+        line = f"{self.formatTime(record)} - {record.levelname} - " + " :: ".join(parts)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = cap_traceback(self.formatException(record.exc_info))
+        if record.exc_text:
+            line = line + "\n" + record.exc_text
+        return line
+
+
+def use_direct_handler():
+    """
+    In a forked process pool worker the listener thread does not exist, so records queued there would never be
+    written; workers log rarely and write their records directly instead. Also used once the listener stopped.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, NonBlockingQueueHandler):
+            root.removeHandler(handler)
+            for output_handler in queue_listener.handlers:
+                root.addHandler(output_handler)
+
+def stop_logging():
+    """Write out the records still queued; called at exit."""
+    if queue_listener is not None and queue_listener._thread is not None:
+        # The sentinel that stops the listener needs a free slot in the queue
+        queue_listener.queue.put(queue_listener._sentinel)
+        queue_listener._thread.join()
+        queue_listener._thread = None
+        use_direct_handler()
+
+def build_output_handler():
+    settings["max_field_length"] = int(os.getenv("LOG_MAX_FIELD_LENGTH", "1000"))
+    settings["max_traceback_length"] = int(os.getenv("LOG_MAX_TRACEBACK_LENGTH", "8000"))
+    field_repr.maxstring = field_repr.maxother = settings["max_field_length"]
+    field_repr.maxlist = field_repr.maxtuple = field_repr.maxdict = field_repr.maxset = 20
+
+    output_handler = logging.StreamHandler(sys.stderr)
+    output_handler.setFormatter(TextFormatter() if os.getenv("LOG_FORMAT", "json").lower() == "text" else JsonFormatter())
+    output_handler.addFilter(RequestContextFilter())
+    return output_handler
+
+def configure_worker_logging():
+    """
+    Logging of a process pool worker. Workers are not forked from the service, so nothing is inherited; they log
+    rarely and write their records directly, in the service's format.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    root.addHandler(build_output_handler())
+
+def configure_logging():
+    """
+    Root logging for the service: records are queued by the logging call and formatted and written by a
+    listener thread, as JSON lines (LOG_FORMAT=json, the default) or text (LOG_FORMAT=text), each carrying
+    the request_id of the request it was logged under. Safe to call more than once.
+    """
+    global queue_listener
+    if queue_listener is not None:
+        return
+    output_handler = build_output_handler()
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000"))))
+    queue_handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    root.addHandler(queue_handler)
+    # uvicorn's CLI installs its own synchronous handlers before the app is imported; its records are sent
+    # through the queue instead
+    for name in ["uvicorn", "uvicorn.access"]:
+        uvicorn_logger = logging.getLogger(name)
+        for handler in list(uvicorn_logger.handlers):
+            uvicorn_logger.removeHandler(handler)
+        uvicorn_logger.propagate = True
+
+    queue_listener = logging.handlers.QueueListener(queue_handler.queue, output_handler, respect_handler_level=True)
+    queue_listener.start()
+    atexit.register(stop_logging)
+    os.register_at_fork(after_in_child=use_direct_handler)
@@ -1,13 +1,34 @@
-from datetime import datetime
-from llm import initialize_llm
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Optional, Any, Dict
-from ui_tree import UITree
-from utils import get_file_content, prioritize_actions, map_data_fields_to_ranked_actions, transform_popup_to_ranked_action
+import time
+# Cold start is measured from here: module imports, then the warm-up, then the first response
+IMPORT_START_TIME = time.perf_counter()
+import contextlib
+import copy
+import json
+from llm import get_llm
+from fastapi import FastAPI, HTTPException, Request, WebSocket
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, PlainTextResponse, ORJSONResponse
+from pydantic import BaseModel, ValidationError
+from typing import Optional, Any
+from ui_tree import StreamedUITree, check_screen_limits, parse_uitree, get_uitree_xml
+from utils import get_file_content, prioritize_actions, map_data_fields_to_ranked_actions, transform_popup_to_ranked_action, filter_elements, sort_elements_top_to_bottom
 from xml_utils import parse_layout
 from tools import check_for_popup, generate_test_data
-from langsmith import traceable
+from popup_detector import detect_popup, is_popup_predetector_enabled, NO_POPUP, UNSURE
+from executors import run_in_thread, shutdown_executors
+from metrics import stage_timer, request_timings, render_prometheus, monitor_event_loop_lag, REQUESTS_TOTAL, REQUEST_ERRORS_TOTAL, REQUEST_DURATION, DEGRADED_RESPONSES_TOTAL, POPUP_PREDETECTIONS_TOTAL, INCREMENTAL_UPDATES_TOTAL, COALESCED_REQUESTS_TOTAL, ELEMENTS_PER_SCREEN, PAYLOAD_BYTES, REQUEST_PEAK_MEMORY, PROCESS_MEMORY, LARGE_SCREENS_TOTAL
+from memory import start_request_memory, get_request_peak_memory, get_process_memory
+from ingest import DecodedRoute, read_multipart, encode_image, compress_response, project_ranked_actions, serialize_response
+from incremental import get_session_tree_cache, parse_session_tree, load_xml_tree, apply_patch, PatchError
+from singleflight import get_singleflight, get_request_key
+from deadline import start_deadline, mark_degraded, get_degraded_stages, get_remaining_seconds
+from resilience import get_dependency_status
+from llm_scheduler import get_llm_scheduler_status
+from warmup import warm_up, is_warmup_enabled, mark_ready, record_imports_done, record_first_response, startup_state
+from screen_graph import get_screen_graph, find_element_for_action, HOME_SEARCH_PHASE
+from session_channel import SessionChannel
+from tracing import traceable, flush_traces
+from log_config import configure_logging, set_log_request_id
 from dotenv import load_dotenv
 import os
 import base64
@@ -16,12 +37,16 @@ import traceback
 import asyncio
 import uvicorn
 import logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 load_dotenv()
+configure_logging()
 
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+# Request bodies may arrive gzip or zstd compressed
+app.router.route_class = DecodedRoute
+record_imports_done(IMPORT_START_TIME)
 
 class APIRequest(BaseModel):
     request_id: Optional[str] = uuid.uuid4().hex
@@ -33,6 +58,11 @@ class APIRequest(BaseModel):
     image_url: Optional[str] = None
     config_data: Optional[dict] = {}
     phase : Optional[str] = "2"
+    session_id: Optional[str] = None
+    latency_budget_ms: Optional[float] = None
+    xml_patch: Optional[list[dict]] = None
+    base_xml_version: Optional[str] = None
+    response_fields: Optional[list[str]] = None
 
 def validate_base64(base64_string: str) -> bool:
     try:
@@ -41,110 +71,426 @@ def validate_base64(base64_string: str) -> bool:
     except Exception:
         return False
 
-@traceable
-async def seek_guidance(request_id, xml, image, xml_url, image_url, config_data, user_prompt, history, phase, llm):
-    logging.info(f"requestid :: {request_id} :: Parsing XML to extract UI elements")
-    # ui_elements_as_list = parse_layout(xml)
-    uitree = UITree(request_id=request_id, xml=xml)
-    logging.info(f"requestid :: {request_id} :: Number of elements found - {len(list(uitree.ui_element_dict_processed.values()))}")
+async def resolve_from_screen_graph(request_id, uitree, screen_graph):
+    """
+    Answer the find-home-node phase from the screen graph when a path to the home screen is already known.
+    Returns (ranked_actions, explanation, journey_completed), or None when the LLM has to be asked.
+    """
+    if not uitree.is_fingerprint_distinctive():
+        logger.info("Screen has no clickable element with a resource id; its fingerprint is not trusted, falling back to LLM")
+        return None
+    next_hop = await run_in_thread(request_id, "screen_graph", screen_graph.get_next_hop_to_home, uitree.get_fingerprint())
+    if next_hop is None:
+        return None
+    path_length, action = next_hop
+    if path_length == 0:
+        logger.info("Screen graph identifies the current screen as the home screen")
+        return [], "Current screen is a known home screen from the screen transition graph.", True
+    ui_element = find_element_for_action(uitree, action)
+    if not ui_element:
+        logger.info("Screen graph next hop element not found on the screen; falling back to LLM")
+        return None
+    logger.info("Screen graph resolved next hop to home screen", extra={"node_id": ui_element.get("node_id"), "steps_to_home": path_length})
+    return [{
+        "node_id": ui_element.get("node_id"),
+        "llm_rank": 1,
+        "action_description": action.get("action_description", ""),
+        "description": ui_element.get("description"),
+        "heuristic_score": ui_element.get("heuristic_score"),
+        "attributes": ui_element.get("attributes")
+    }], f"Next step towards the home screen resolved from the screen transition graph; home screen is {path_length} step(s) away.", False
+
+async def load_session_tree(request, xml, session_trees):
+    """
+    Parse the full XML of a session step and keep it for the next step, or apply the request's patch to the
+    session's previous screen. Returns the SessionTree.
+    """
+    if request.xml_patch is None:
+        # The lxml tree for patches is only kept for sessions that have sent one
+        previous_tree = session_trees.get(request.session_id)
+        session_tree = await parse_session_tree(request.request_id, xml, patching=previous_tree is not None and previous_tree.patching)
+        session_trees.put(request.session_id, session_tree)
+        INCREMENTAL_UPDATES_TOTAL.inc(result="full")
+        return session_tree
+
+    session_tree = session_trees.get(request.session_id)
+    if session_tree is None or session_tree.xml_version != request.base_xml_version:
+        INCREMENTAL_UPDATES_TOTAL.inc(result="conflict")
+        logger.error("Patch does not apply to the session's last screen", extra={"session_known": session_tree is not None})
+        raise HTTPException(status_code=409, detail=f"requestid :: {request.request_id} :: base_xml_version does not match the session's last screen; send the full XML")
+    PAYLOAD_BYTES.observe(len(json.dumps(request.xml_patch)), kind="xml_patch")
+    await load_xml_tree(request.request_id, session_tree)
+    try:
+        await run_in_thread(request.request_id, "patch", apply_patch, request.request_id, session_tree, request.xml_patch)
+    except PatchError as e:
+        # Earlier operations of the patch may already be applied, so the session's tree is no longer trusted
+        session_trees.drop(request.session_id)
+        INCREMENTAL_UPDATES_TOTAL.inc(result="invalid")
+        logger.error("Invalid patch - %s", e)
+        raise HTTPException(status_code=400, detail=f"requestid :: {request.request_id} :: Invalid patch - {str(e)}; send the full XML")
+    except Exception:
+        # Whatever failed, the tree may be half patched
+        session_trees.drop(request.session_id)
+        raise
+    INCREMENTAL_UPDATES_TOTAL.inc(result="patched")
+    return session_tree
+
+async def parse_screen(request_id, xml):
+    """Parse the screen into a UITree, or into a StreamedUITree when it is above the node or memory ceiling."""
+    limit_reason = check_screen_limits(xml)
+    if limit_reason is None:
+        return await parse_uitree(request_id, xml)
+    LARGE_SCREENS_TOTAL.inc(reason=limit_reason)
+    mark_degraded("parse")
+    logger.warning("Screen above the %s ceiling; keeping only its actionable and labeled elements", limit_reason, extra={"xml_bytes": len(xml)})
+    return await parse_uitree(request_id, xml, StreamedUITree)
+
+async def publish_event(on_event, event_type, payload):
+    if on_event is not None:
+        await on_event(event_type, payload)
+
+def get_provisional_ranking(request_id, uitree):
+    """The candidates in screen order, top to bottom; what the LLM's ranking falls back to."""
+    candidates = sort_elements_top_to_bottom(filter_elements(request_id, uitree, list(uitree.ui_element_dict_processed.values())))
+    return [{"node_id": element.get("node_id"), "llm_rank": rank, "description": element.get("description"), "attributes": element.get("attributes")}
+            for rank, element in enumerate(candidates, start=1)]
+
+async def compute_guidance(request_id, xml, image, xml_url, image_url, config_data, user_prompt, history, phase, llm, uitree=None, session_id=None, on_event=None):
+    """
+    Parse the screen, unless the UITree of an incremental session is passed in, and produce the ranked actions for it.
+    Returns (ranked_actions, explanation, journey_completed, details); details holds the screen fingerprint and
+    whether it is distinctive, the stages that degraded and the model that ranked the actions. on_event is awaited
+    with a "popup" event for a detected popup, a "provisional_ranking" before the LLM is asked and "generated_data"
+    once the test data generator answered.
+    """
+    if uitree is None:
+        logger.debug("Parsing XML to extract UI elements")
+        # ui_elements_as_list = parse_layout(xml)
+        uitree = await parse_screen(request_id, xml)
+    logger.debug("UI elements found", extra={"elements": len(uitree.ui_element_dict_processed)})
+    ELEMENTS_PER_SCREEN.observe(len(uitree.ui_element_dict_processed), kind="all")
     # screen_context = llm_generate_screen_context(xml, llm)
     screen_context = ""
 
-    # check if the page has a pop up
-    popup_check_start_time = datetime.now()
-    popup_detected, pop_up_element = check_for_popup(request_id, xml, xml_url, image, image_url)
-    logging.info(f"requestid :: {request_id} :: Time taken to check for popup :: {(datetime.now() - popup_check_start_time).total_seconds() * 1000} milliseconds")
+    # check if the page has a pop up; screens that clearly have none are not sent to the popup handler
+    with stage_timer("popup") as popup_timer:
+        popup_verdict = UNSURE
+        if is_popup_predetector_enabled():
+            popup_verdict, popup_reasons = await run_in_thread(request_id, "popup_detect", detect_popup, uitree)
+            POPUP_PREDETECTIONS_TOTAL.inc(verdict=popup_verdict)
+            logger.debug("Local popup pre-detection - %s", popup_verdict, extra={"reasons": popup_reasons})
+        if popup_verdict == NO_POPUP:
+            popup_detected, pop_up_element = False, {}
+        else:
+            popup_detected, pop_up_element = await check_for_popup(request_id, xml if xml is not None else await get_uitree_xml(request_id, uitree), xml_url, image, image_url)
+    logger.debug("Popup check done", extra={"elapsed_ms": round(popup_timer.elapsed_ms, 3)})
     if popup_detected:
-        return [transform_popup_to_ranked_action(request_id, pop_up_element)], "Pop up is identified, so need to close the popup to perform any further actions.", False
-    else:
-        # Run prioritize_actions and generate_test_data concurrently
+        await publish_event(on_event, "popup", {"popup_element": pop_up_element})
+        return [transform_popup_to_ranked_action(request_id, pop_up_element)], "Pop up is identified, so need to close the popup to perform any further actions.", False, {
+            "fingerprint": uitree.get_fingerprint(), "fingerprint_distinctive": uitree.is_fingerprint_distinctive(), "degraded_stages": get_degraded_stages(), "model": None
+        }
+
+    graph_guidance = None
+    screen_graph = get_screen_graph()
+    if screen_graph and phase == HOME_SEARCH_PHASE:
+        graph_guidance = await resolve_from_screen_graph(request_id, uitree, screen_graph)
+
+    # Run prioritize_actions and generate_test_data concurrently
+    if graph_guidance is None:
+        if on_event is not None:
+            await publish_event(on_event, "provisional_ranking", {"ranked_actions": await run_in_thread(request_id, "provisional", get_provisional_ranking, request_id, uitree)})
         prioritize_task = asyncio.create_task(prioritize_actions(
             request_id=request_id, uitree=uitree, screen_context=screen_context, 
             image=image, actions=list(uitree.ui_element_dict_processed.values()), history=history,
-            user_prompt=user_prompt, phase=phase, llm=llm
-        ))
-        
-        generate_data_task = asyncio.create_task(generate_test_data(
-            request_id, xml, xml_url, image, image_url, config_data
+            user_prompt=user_prompt, phase=phase, llm=llm, session_id=session_id
         ))
+    
+    async def generate_and_publish_test_data():
+        data_gen_required, data_fields = await generate_test_data(request_id, xml, xml_url, image, image_url, config_data, uitree=uitree)
+        # Copied, since mapping the fields to the ranked actions removes them from the list
+        await publish_event(on_event, "generated_data", {"data_generation_required": data_gen_required, "fields": copy.copy(data_fields)})
+        return data_gen_required, data_fields
 
-        # Wait for both tasks to complete
-        ranked_actions, explanation,journey_completed = await prioritize_task
-        data_gen_required, data_fields = await generate_data_task
+    generate_data_task = asyncio.create_task(generate_and_publish_test_data())
 
-        if data_gen_required:
-            updated_ranked_actions = map_data_fields_to_ranked_actions(request_id=request_id, ranked_actions=ranked_actions, data_fields=data_fields)
-            return updated_ranked_actions, explanation,journey_completed
-        else:
-            return ranked_actions, explanation,journey_completed
+    # Wait for both tasks to complete
+    if graph_guidance is None:
+        ranked_actions, explanation,journey_completed, model = await prioritize_task
+    else:
+        ranked_actions, explanation, journey_completed = graph_guidance
+        model = None
+    data_gen_required, data_fields = await generate_data_task
+
+    if data_gen_required:
+        with stage_timer("map_data"):
+            ranked_actions = map_data_fields_to_ranked_actions(request_id=request_id, ranked_actions=ranked_actions, data_fields=data_fields)
+    return ranked_actions, explanation, journey_completed, {
+        "fingerprint": uitree.get_fingerprint(), "fingerprint_distinctive": uitree.is_fingerprint_distinctive(), "degraded_stages": get_degraded_stages(), "model": model
+    }
 
 @traceable
-@app.post("/invoke")
-async def run_service(request: APIRequest) -> Dict[str, Any]:
+async def seek_guidance(request_id, xml, image, xml_url, image_url, config_data, user_prompt, history, phase, llm, session_id=None, uitree=None, on_event=None, xml_version=None):
+    set_log_request_id(request_id)
+
+    async def compute():
+        ranked_actions, explanation, journey_completed, details = await compute_guidance(request_id, xml, image, xml_url, image_url, config_data, user_prompt, history, phase, llm, uitree=uitree, session_id=session_id, on_event=on_event)
+        # The stage timings of the computation, for the requests that waited on it
+        return ranked_actions, explanation, journey_completed, dict(details, timings=dict(request_timings.get() or {}))
+
+    singleflight = get_singleflight()
+    if singleflight:
+        # Emulators running the same plan often send the same screen at the same moment; compute it once.
+        # A request waits no longer than its own latency budget allows
+        with stage_timer("coalesce_wait") as coalesce_timer:
+            guidance, leader_request_id = await singleflight.do(get_request_key(xml if xml is not None else xml_version, image, phase, user_prompt, history, config_data), request_id, compute,
+                                                                timeout_seconds=get_remaining_seconds())
+        if leader_request_id:
+            COALESCED_REQUESTS_TOTAL.inc()
+            logger.info("Served with the result of an identical in-flight request", extra={"leader_request_id": leader_request_id, "elapsed_ms": round(coalesce_timer.elapsed_ms, 3)})
+            timings = request_timings.get()
+            if timings is not None:
+                for stage, elapsed_ms in guidance[3]["timings"].items():
+                    timings.setdefault(stage, elapsed_ms)
+    else:
+        guidance = await compute()
+    ranked_actions, explanation, journey_completed, details = guidance
+    # A coalesced request shares the outcome, including the stages that degraded, of the request it waited on
+    for stage in details["degraded_stages"]:
+        mark_degraded(stage)
+
+    # Session bookkeeping runs for every request, including the ones served from a coalesced computation
+    screen_graph = get_screen_graph()
+    if screen_graph:
+        screen_graph.record_step(request_id=request_id, session_id=session_id, fingerprint=details["fingerprint"], history=history, phase=phase)
+        screen_graph.remember_step(session_id=session_id, fingerprint=details["fingerprint"], ranked_actions=ranked_actions, phase=phase, journey_completed=journey_completed,
+                                  distinctive=details["fingerprint_distinctive"])
+        if screen_graph.is_flush_due():
+            await run_in_thread(request_id, "screen_graph_flush", screen_graph.flush)
+    return ranked_actions, explanation, journey_completed, details
+
+async def get_guidance_payload(request: APIRequest, image_bytes=None, on_event=None, endpoint="invoke"):
+    """
+    Run a guidance request through every stage and return the response payload; shared by /invoke and the
+    session channel. image_bytes is a raw screenshot uploaded as a multipart part. on_event, when given, is
+    awaited with the popup, provisional ranking and generated data events of the request as they happen.
+    """
+    request_start_time = time.perf_counter()
+    request_timings.set(dict())
+    start_request_memory()
+    set_log_request_id(request.request_id)
+    deadline = start_deadline(request.latency_budget_ms)
     try:
-        logging.info(f"requestid :: {request.request_id} :: Request processing starts")
+        logger.debug("Request processing starts")
         if request.xml_url:
             try:
                 xml = get_file_content(request.xml_url, is_image=False)
             except Exception as e:
-                logging.error(f"requestid :: {request.request_id} :: Exception in fetching XML from URL - {request.xml_url} - Exception - {str(e)} -- Stacktrace - {traceback.format_exc()}")
+                logger.exception("Exception in fetching XML from URL - %s", request.xml_url)
                 raise(HTTPException(status_code=400, detail=f"requestid :: {request.request_id} :: Exception in fetching XML from URL - {request.xml_url}"))
         else:
             xml = request.xml
+        session_trees = get_session_tree_cache() if request.session_id else None
+        if request.xml_patch is not None and session_trees is None:
+            logger.error("xml_patch sent without a session_id or with incremental updates disabled")
+            raise HTTPException(status_code=400, detail="xml_patch needs a session_id and incremental updates enabled")
+        if session_trees and xml is not None and check_screen_limits(xml):
+            # A screen above the ceilings is parsed into a reduced tree that takes no patches; the next step sends the full XML
+            session_trees.drop(request.session_id)
+            session_trees = None
 
         if request.image_url:
             try:
                 base64_image = get_file_content(request.image_url, is_image=True)
             except Exception as e:
                 base64_image = None
-                logging.error(f"requestid :: {request.request_id} :: Exception in fetching image from URL - {request.image_url} - Exception - {str(e)} -- Stacktrace - {traceback.format_exc()}")
+                logger.exception("Exception in fetching image from URL - %s", request.image_url)
+        elif image_bytes:
+            # A raw upload needs no validation; it is encoded once for the agents and the LLM
+            base64_image = await run_in_thread(request.request_id, "encode_image", encode_image, image_bytes)
         elif request.image:
             if not validate_base64(request.image):
-                logging.error(f"requestid :: {request.request_id} :: Invalid base64 image data")
+                logger.error("Invalid base64 image data")
                 raise HTTPException(status_code=400, detail="requestid :: {request_id} :: Invalid base64 image data")
             base64_image = request.image
         else:
             base64_image = None
 
+        if xml is not None:
+            PAYLOAD_BYTES.observe(len(xml), kind="xml")
+        if base64_image:
+            PAYLOAD_BYTES.observe(len(base64_image), kind="image")
+
         if request.config_data:
             config_data = request.config_data
         else:
             config_data = {}
         
-        if xml is None:
-            logging.error(f"requestid :: {request.request_id} :: Atleast xml or xml_url must be provided for guidance. Returning.")    
+        if xml is None and request.xml_patch is None:
+            logger.error("Atleast xml or xml_url must be provided for guidance. Returning.")
             raise HTTPException(status_code=400, detail="Atleast xml or xml_url must be provided for guidance")
 
         llm_key = os.getenv("OPENAI_API_KEY")
         if not llm_key:
-            logging.error(f"requestid :: {request.request_id} :: LLM API key not found. Please check your environment variables")
+            logger.error("LLM API key not found. Please check your environment variables")
             raise HTTPException(status_code=500, detail="LLM API key not found. Please check your environment variables.")
-        llm = initialize_llm(llm_key)
-        logging.info(f"requestid :: {request.request_id} :: LLM initialized")
+        llm = get_llm(llm_key)
+        logger.debug("LLM initialized")
         
-        ranked_actions, explanation,journey_completed = await seek_guidance(request_id=request.request_id, xml=xml, image=base64_image, 
-                                                    xml_url=request.xml_url, image_url=request.image_url,
-                                                    config_data = config_data, user_prompt=request.user_prompt,
-                                                    history=request.history, phase = request.phase, llm=llm)
+        # Steps of a session are handled one at a time, so a patch never lands on a tree still in use
+        async with (session_trees.get_lock(request.session_id) if session_trees else contextlib.nullcontext()):
+            uitree, xml_version = None, None
+            if session_trees:
+                session_tree = await load_session_tree(request, xml, session_trees)
+                # A patched screen has no XML string; it is built only if the popup handler or data generator need it
+                uitree, xml_version = session_tree.uitree, session_tree.xml_version
+                xml = xml if request.xml_patch is None else None
+            ranked_actions, explanation,journey_completed, details = await seek_guidance(request_id=request.request_id, xml=xml, image=base64_image, 
+                                                        xml_url=request.xml_url if request.xml_patch is None else None, image_url=request.image_url,
+                                                        config_data = config_data, user_prompt=request.user_prompt,
+                                                        history=request.history, phase = request.phase, llm=llm,
+                                                        session_id=request.session_id, uitree=uitree, on_event=on_event, xml_version=xml_version)
         
         # Return the parsed output in the API response
-        logging.info(f"requestid :: {request.request_id} :: Request Processing done")
-        return {
+        for stage in deadline.degraded_stages:
+            DEGRADED_RESPONSES_TOTAL.inc(stage=stage)
+        timings = request_timings.get()
+        timings["total_ms"] = round((time.perf_counter() - request_start_time) * 1000, 3)
+        peak_memory = get_request_peak_memory()
+        if peak_memory is not None:
+            REQUEST_PEAK_MEMORY.observe(peak_memory, endpoint=endpoint)
+            PROCESS_MEMORY.set(get_process_memory())
+        logger.info("Request processing done", extra={"total_ms": timings["total_ms"], "peak_memory_bytes": peak_memory, "degraded_stages": sorted(deadline.degraded_stages)})
+        if request.response_fields:
+            ranked_actions = project_ranked_actions(ranked_actions, request.response_fields)
+        payload = {
             "request_id": request.request_id,
             "status": "success",
             "agent_response": {
                 "ranked_actions": ranked_actions,
                 "explanation": explanation,
-                  "journey_completed": journey_completed
-            }
+                  "journey_completed": journey_completed,
+                "degraded": bool(deadline.degraded_stages),
+                "degraded_stages": sorted(deadline.degraded_stages),
+                "model": details["model"]
+            },
+            "xml_version": xml_version,
+            "timings": timings
         }
+        REQUESTS_TOTAL.inc(endpoint=endpoint, status="200")
+        REQUEST_DURATION.observe(time.perf_counter() - request_start_time, endpoint=endpoint)
+        return payload
+    except HTTPException as e:
+        REQUESTS_TOTAL.inc(endpoint=endpoint, status=str(e.status_code))
+        raise
     except Exception as e:
-        logging.error(f"requestid :: {request.request_id} :: Exception in Prioritization agent - {str(e)} -- {traceback.format_exc()}")
+        REQUESTS_TOTAL.inc(endpoint=endpoint, status="500")
+        REQUEST_ERRORS_TOTAL.inc(stage="request")
+        logger.exception("Exception in Prioritization agent - %s", e)
         raise HTTPException(status_code=500, detail=f"requestid :: {request.request_id} :: Exception in Prioritization agent - {str(e)} -- {traceback.format_exc()}")
 
+async def handle_invoke(request: APIRequest, image_bytes=None, accept_encoding=None):
+    """Serve an /invoke request; image_bytes is a raw screenshot uploaded as a multipart part."""
+    payload = await get_guidance_payload(request, image_bytes=image_bytes)
+    with stage_timer("serialize"):
+        response_body = serialize_response(payload)
+    PAYLOAD_BYTES.observe(len(response_body), kind="response")
+    with stage_timer("compress"):
+        response_body, response_headers = compress_response(response_body, accept_encoding)
+    record_first_response()
+    return Response(content=response_body, media_type="application/json", headers=response_headers)
+
+@traceable
+@app.post("/invoke")
+async def run_service(request: APIRequest, http_request: Request) -> Response:
+    return await handle_invoke(request, accept_encoding=http_request.headers.get("accept-encoding"))
+
+async def run_session_step(fields, on_event):
+    """A screen sent on a session channel, served like /invoke; returns the response payload."""
+    try:
+        request = APIRequest.model_validate(fields)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+    if request.response_fields:
+        on_event = project_event_ranked_actions(on_event, request.response_fields)
+    payload = await get_guidance_payload(request, on_event=on_event, endpoint="session")
+    record_first_response()
+    return payload
+
+def project_event_ranked_actions(on_event, fields):
+    async def on_projected_event(event_type, payload):
+        if "ranked_actions" in payload:
+            payload = dict(payload, ranked_actions=project_ranked_actions(payload["ranked_actions"], fields))
+        await on_event(event_type, payload)
+    return on_projected_event
+
+@app.websocket("/session")
+async def session_channel(websocket: WebSocket):
+    """One connection per crawl session: screens in, popup, provisional ranking, generated data and ranking messages out."""
+    await SessionChannel(websocket, run_session_step).serve()
+
+@app.post("/invoke/multipart")
+async def run_service_multipart(http_request: Request):
+    """
+    Same as /invoke with a multipart/form-data body: an "xml" part with the raw XML, an "image" part with the
+    raw screenshot bytes and a "metadata" part with the other request fields as JSON.
+    """
+    parts = await read_multipart(http_request)
+    try:
+        request = APIRequest.model_validate_json(parts.get("metadata") or b"{}")
+        if parts.get("xml"):
+            # Popped, so the raw bytes are not held next to the decoded XML for the rest of the request
+            request.xml = parts.pop("xml").decode("utf-8")
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    except UnicodeDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"requestid :: {request.request_id} :: XML part is not valid UTF-8 - {str(e)}")
+    request.image = None
+    return await handle_invoke(request, image_bytes=parts.get("image"), accept_encoding=http_request.headers.get("accept-encoding"))
+
+@app.on_event("startup")
+async def start_warm_up():
+    # Runs in the background so /health answers at once; /ready reports when the worker is warm
+    if is_warmup_enabled():
+        app.state.warmup = asyncio.create_task(warm_up())
+    else:
+        mark_ready()
+
+@app.on_event("startup")
+async def load_screen_graph():
+    # Load in the background so the first request does not pay for reading the graph from disk
+    screen_graph = get_screen_graph()
+    if screen_graph:
+        asyncio.get_running_loop().run_in_executor(None, screen_graph.load)
+
+@app.on_event("startup")
+async def start_event_loop_lag_monitor():
+    interval_ms = float(os.getenv("EVENT_LOOP_LAG_INTERVAL_MS", "500"))
+    if interval_ms > 0:
+        app.state.event_loop_lag_monitor = asyncio.create_task(monitor_event_loop_lag(interval_ms / 1000))
+
+@app.on_event("shutdown")
+async def flush_screen_graph():
+    screen_graph = get_screen_graph()
+    if screen_graph:
+        screen_graph.flush(force=True)
+    shutdown_executors()
+    flush_traces()
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return {"status": "healthy", "dependencies": get_dependency_status(), "llm_schedulers": get_llm_scheduler_status()}
+
+@app.get("/ready")
+async def readiness_check():
+    return ORJSONResponse(status_code=200 if startup_state["ready"] else 503, content={
+        "status": "ready" if startup_state["ready"] else "warming_up",
+        **{name: startup_state[name] for name in ["import_seconds", "warmup_seconds", "first_response_seconds", "warmup_steps_ms"]}
+    })
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Logging is configured by configure_logging; uvicorn's own records go through it too
+    uvicorn.run(app, host="0.0.0.0", port=8000, log_config=None)
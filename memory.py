@@ -0,0 +1,150 @@
+import contextvars
+import os
+import sys
+import tracemalloc
+
+import logging
+logger = logging.getLogger(__name__)
+
+# MEMORY_ACCOUNTING decides how the memory of stages and requests is measured:
+#   rss         - resident set size of the worker process, read at stage boundaries (default)
+#   tracemalloc - Python allocations traced by tracemalloc; at DEBUG the largest allocations of each stage are
+#                 logged from snapshot diffs. Tracing slows every allocation down, so it is for debugging only
+#   off         - no accounting
+MEMORY_ACCOUNTING = os.getenv("MEMORY_ACCOUNTING", "rss").lower()
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "1"))
+# Lines of a stage's snapshot diff that are logged
+TRACEMALLOC_TOP_LINES = 5
+# tracemalloc's own bookkeeping is left out of the snapshot diffs
+TRACEMALLOC_FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__)]
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# Memory of the process at the start of the request being served, the highest seen at its stage boundaries and the
+# highest growth of its stages run in process pool workers, as {"start_bytes", "peak_bytes", "worker_peak_bytes"}.
+# Tasks and thread pool stages copy the context, so they update the same dict.
+request_memory = contextvars.ContextVar("request_memory", default=None)
+
+if MEMORY_ACCOUNTING == "tracemalloc":
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+
+
+def get_rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Without /proc the peak RSS is the closest figure; ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def reset_peak_rss():
+    """Reset the kernel's high-water mark of the process's RSS (Linux 4.0+); False where it cannot be reset."""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+def get_peak_rss_bytes():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def start_worker_peak():
+    """
+    Start measuring the peak memory of a stage run in a process pool worker, where the request's own
+    accounting cannot see it. Returns the state to pass to get_worker_peak, or None when accounting is off.
+    """
+    if MEMORY_ACCOUNTING == "tracemalloc" and tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        return {"start_bytes": tracemalloc.get_traced_memory()[0], "peak_reset": True}
+    if MEMORY_ACCOUNTING == "rss":
+        start_bytes = get_rss_bytes()
+        return {"start_bytes": start_bytes, "peak_reset": reset_peak_rss()} if start_bytes is not None else None
+    return None
+
+def get_worker_peak(state):
+    """Highest growth of the worker's memory since start_worker_peak in bytes, or None."""
+    if state is None:
+        return None
+    if MEMORY_ACCOUNTING == "tracemalloc":
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    else:
+        # Without a resettable high-water mark only the memory at the end of the stage is known
+        peak_bytes = (get_peak_rss_bytes() if state["peak_reset"] else None) or get_rss_bytes()
+    return max(0, peak_bytes - state["start_bytes"]) if peak_bytes is not None else None
+
+def get_process_memory():
+    """Memory the process uses in bytes, as MEMORY_ACCOUNTING measures it; None when accounting is off."""
+    if MEMORY_ACCOUNTING == "rss":
+        return get_rss_bytes()
+    if MEMORY_ACCOUNTING == "tracemalloc" and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return None
+
+def start_request_memory():
+    usage = get_process_memory()
+    request_memory.set({"start_bytes": usage, "peak_bytes": usage, "worker_peak_bytes": 0} if usage is not None else None)
+
+def record_memory(usage):
+    state = request_memory.get()
+    if state is not None and usage is not None and usage > state["peak_bytes"]:
+        state["peak_bytes"] = usage
+
+def record_worker_memory(peak_bytes):
+    state = request_memory.get()
+    if state is not None and peak_bytes is not None:
+        state["worker_peak_bytes"] = max(state["worker_peak_bytes"], peak_bytes)
+
+def get_request_peak_memory():
+    """
+    Growth of process memory from the start of the current request to the highest point seen at its stage
+    boundaries, plus the highest peak of its stages run in process pool workers, in bytes; None when
+    accounting is off. Other requests served at the same time count too.
+    """
+    state = request_memory.get()
+    if state is None:
+        return None
+    record_memory(get_process_memory())
+    return max(0, state["peak_bytes"] - state["start_bytes"]) + state["worker_peak_bytes"]
+
+
+class StageMemory:
+    def __init__(self, stage):
+        self.stage = stage
+        self.start_bytes = get_process_memory()
+        self.snapshot = None
+        self.worker_peak_bytes = 0
+        if MEMORY_ACCOUNTING == "tracemalloc" and tracemalloc.is_tracing() and logger.isEnabledFor(logging.DEBUG):
+            self.snapshot = tracemalloc.take_snapshot().filter_traces(TRACEMALLOC_FILTERS)
+
+    def record_worker_peak(self, peak_bytes):
+        """Peak memory of the part of the stage that ran in a process pool worker; it counts in the stage's growth."""
+        if peak_bytes is not None:
+            self.worker_peak_bytes = max(self.worker_peak_bytes, peak_bytes)
+            record_worker_memory(peak_bytes)
+
+    def finish(self):
+        """
+        Record the end of the stage in the request's peak; returns the memory the stage added in bytes, in this
+        process and at its peak in a process pool worker, or None.
+        """
+        end_bytes = get_process_memory()
+        if end_bytes is None or self.start_bytes is None:
+            return None
+        record_memory(end_bytes)
+        if self.snapshot is not None:
+            top_allocations = tracemalloc.take_snapshot().filter_traces(TRACEMALLOC_FILTERS).compare_to(self.snapshot, "lineno")[:TRACEMALLOC_TOP_LINES]
+            logger.debug("Largest allocations of stage %s", self.stage, extra={"allocations": [str(statistic) for statistic in top_allocations]})
+        return end_bytes - self.start_bytes + self.worker_peak_bytes
@@ -0,0 +1,187 @@
+import asyncio
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from memory import StageMemory
+
+# Per-request stage timings in milliseconds; set at the start of a request and returned in the response.
+# Tasks and asyncio.to_thread calls copy the context, so every stage of a request writes to the same dict.
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0]
+COUNT_BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000]
+SIZE_BUCKETS = [1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864]
+MEMORY_BUCKETS = [0, 1048576, 4194304, 16777216, 67108864, 268435456, 1073741824, 4294967296]
+
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values)) + (extra or [])
+    if not pairs:
+        return ""
+    escaped = [name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for name, value in pairs]
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = dict() # label values tuple -> float
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(tuple(str(labels.get(name, "")) for name in self.label_names), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self.lock:
+            self.values[key] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = list(buckets)
+        self.values = dict() # label values tuple -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = [0] * (len(self.buckets) + 2)
+                self.values[key] = series
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(self.label_names, key, [('le', bound)])} {cumulative}")
+                cumulative += series[len(self.buckets)]
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, key, [('le', '+Inf')])} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.label_names, key)} {series[-1]}")
+                lines.append(f"{self.name}_count{format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+registry = []
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+def render_prometheus():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUESTS_TOTAL = register(Counter("mneme_requests_total", "Requests handled by endpoint and status", ["endpoint", "status"]))
+REQUEST_ERRORS_TOTAL = register(Counter("mneme_request_errors_total", "Errors by stage", ["stage"]))
+REQUEST_DURATION = register(Histogram("mneme_request_duration_seconds", "End to end request latency", ["endpoint"]))
+STAGE_DURATION = register(Histogram("mneme_stage_duration_seconds", "Latency of each seek_guidance stage", ["stage"]))
+EXECUTOR_WAIT = register(Histogram("mneme_executor_wait_seconds", "Time a stage waited for a free executor worker", ["stage", "pool"]))
+STAGE_TIMEOUTS_TOTAL = register(Counter("mneme_stage_timeouts_total", "External calls that did not answer within their share of the latency budget", ["stage"]))
+HEDGED_ATTEMPTS_TOTAL = register(Counter("mneme_hedged_attempts_total", "Second attempts started for slow or failed external calls", ["stage"]))
+DEGRADED_RESPONSES_TOTAL = register(Counter("mneme_degraded_responses_total", "Responses returned without the result of a stage", ["stage"]))
+CIRCUIT_BREAKER_STATE = register(Gauge("mneme_circuit_breaker_state", "Circuit breaker state by dependency (0 closed, 1 half open, 2 open)", ["dependency"]))
+CONCURRENCY_LIMIT = register(Gauge("mneme_concurrency_limit", "Current adaptive concurrency limit by dependency", ["dependency"]))
+DEPENDENCY_IN_FLIGHT = register(Gauge("mneme_dependency_in_flight", "Calls in flight by dependency", ["dependency"]))
+DEPENDENCY_REJECTIONS_TOTAL = register(Counter("mneme_dependency_rejections_total", "Calls skipped by dependency and reason (circuit_open, concurrency_limit)", ["dependency", "reason"]))
+MODEL_ROUTES_TOTAL = register(Counter("mneme_model_routes_total", "LLM prioritizations by routed model tier", ["tier", "model"]))
+POPUP_PREDETECTIONS_TOTAL = register(Counter("mneme_popup_predetections_total", "Local popup pre-detector verdicts (no_popup verdicts skip the popup handler)", ["verdict"]))
+DATAGEN_DECISIONS_TOTAL = register(Counter("mneme_datagen_decisions_total", "Test data generation by decision (no_inputs, cached, called)", ["decision"]))
+INCREMENTAL_UPDATES_TOTAL = register(Counter("mneme_incremental_updates_total", "Session screens by how they were loaded (full, patched, conflict, invalid)", ["result"]))
+STARTUP_SECONDS = register(Gauge("mneme_startup_seconds", "Time the worker spent starting up by phase (import, warmup)", ["phase"]))
+TIME_TO_FIRST_RESPONSE = register(Gauge("mneme_time_to_first_response_seconds", "Time from the start of the worker to its first /invoke response"))
+LLM_QUEUE_DEPTH = register(Gauge("mneme_llm_queue_depth", "LLM calls waiting for the rate limit scheduler by model and priority class", ["model", "priority"]))
+LLM_QUEUE_WAIT = register(Histogram("mneme_llm_queue_wait_seconds", "Time LLM calls waited in the rate limit scheduler by model and priority class", ["model", "priority"], buckets=LATENCY_BUCKETS))
+LLM_SCHEDULER_REJECTIONS_TOTAL = register(Counter("mneme_llm_scheduler_rejections_total", "LLM calls answered with a 429 by model and reason (queue_full, over_budget, timed_out)", ["model", "reason"]))
+LLM_RATE_LIMITED_TOTAL = register(Counter("mneme_llm_rate_limited_total", "Provider 429 answers to LLM calls by model", ["model"]))
+LLM_TOKEN_BUDGET = register(Gauge("mneme_llm_token_budget_available", "Tokens left in the scheduler's budget by model, after the last call let through", ["model"]))
+SCREENSHOT_DECISIONS_TOTAL = register(Counter("mneme_screenshot_decisions_total", "LLM prioritizations by how much of the screenshot was sent (full, crops, skip, none when there was no image)", ["decision"]))
+LLM_CALL_DURATION = register(Histogram("mneme_llm_call_seconds", "Latency of LLM prioritization calls that reached the model, by screenshot decision", ["screenshot"]))
+SESSION_CHANNELS_OPEN = register(Gauge("mneme_session_channels_open", "Open WebSocket session channels"))
+SESSION_MESSAGES_TOTAL = register(Counter("mneme_session_messages_total", "WebSocket session channel messages by direction (in, out) and type", ["direction", "type"]))
+SESSION_MESSAGES_DROPPED_TOTAL = register(Counter("mneme_session_messages_dropped_total", "Provisional rankings and heartbeats not sent because the client read too slowly", ["type"]))
+STAGE_MEMORY_GROWTH = register(Histogram("mneme_stage_memory_growth_bytes", "Growth of process memory over each stage (see MEMORY_ACCOUNTING), plus the peak growth of the process pool worker it ran in; includes requests served at the same time", ["stage"], buckets=MEMORY_BUCKETS))
+REQUEST_PEAK_MEMORY = register(Histogram("mneme_request_peak_memory_bytes", "Peak growth of process memory during a request, sampled at stage boundaries, plus the highest peak of its process pool stages", ["endpoint"], buckets=MEMORY_BUCKETS))
+PROCESS_MEMORY = register(Gauge("mneme_process_memory_bytes", "Memory of the worker process at the end of the last request (see MEMORY_ACCOUNTING)"))
+LARGE_SCREENS_TOTAL = register(Counter("mneme_large_screens_total", "Screens parsed into a reduced tree because they were above a ceiling (nodes, memory)", ["reason"]))
+LOG_RECORDS_DROPPED_TOTAL = register(Counter("mneme_log_records_dropped_total", "Log records dropped because the log queue was full", ["level"]))
+COALESCED_REQUESTS_TOTAL = register(Counter("mneme_coalesced_requests_total", "Requests served from an identical in-flight computation (popup, datagen and LLM calls saved)"))
+LLM_TOKENS_TOTAL = register(Counter("mneme_llm_tokens_total", "LLM tokens by direction", ["direction"]))
+CACHE_REQUESTS_TOTAL = register(Counter("mneme_cache_requests_total", "Cache lookups by cache and result", ["cache", "result"]))
+ELEMENTS_PER_SCREEN = register(Histogram("mneme_elements_per_screen", "UI elements per screen by kind (all parsed nodes, LLM candidates, input fields)", ["kind"], buckets=COUNT_BUCKETS))
+EVENT_LOOP_LAG = register(Histogram("mneme_event_loop_lag_seconds", "Delay of a periodic event loop wake-up beyond its scheduled time", buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]))
+PAYLOAD_BYTES = register(Histogram("mneme_payload_bytes", "Size of request and response payloads", ["kind"], buckets=SIZE_BUCKETS))
+
+
+class StageTimer:
+    def __init__(self, stage):
+        self.stage = stage
+        # Sampled first, so a tracemalloc snapshot is not counted in the stage's time
+        self.memory = StageMemory(stage)
+        self.start = time.perf_counter()
+        self.elapsed_ms = 0.0
+
+def record_timing(name, elapsed_ms):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = round(timings.get(name, 0.0) + elapsed_ms, 3)
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Time a stage into the stage latency histogram and the current request's timings block, and record the
+    memory it added.
+    """
+    timer = StageTimer(stage)
+    try:
+        yield timer
+    finally:
+        elapsed = time.perf_counter() - timer.start
+        timer.elapsed_ms = elapsed * 1000
+        STAGE_DURATION.observe(elapsed, stage=stage)
+        record_timing(f"{stage}_ms", timer.elapsed_ms)
+        memory_growth = timer.memory.finish()
+        if memory_growth is not None:
+            STAGE_MEMORY_GROWTH.observe(max(0, memory_growth), stage=stage)
+
+async def monitor_event_loop_lag(interval_seconds):
+    """Sleep in a loop and record how late each wake-up is; blocking work on the loop shows up as lag."""
+    while True:
+        scheduled = time.perf_counter() + interval_seconds
+        await asyncio.sleep(interval_seconds)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - scheduled))
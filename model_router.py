@@ -0,0 +1,93 @@
+import json
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Model tiers and the rules picking one of them. Rules are checked in order and the first rule whose
+# conditions all hold decides; a rule without conditions matches every screen.
+DEFAULT_ROUTING_CONFIG = {
+    "tiers": {
+        "small": {"model": "gpt-4o-mini", "include_image": True},
+        "large": {"model": "gpt-4o", "include_image": True}
+    },
+    "rules": [
+        {"tier": "small", "max_candidates": 10, "max_history": 30},
+        {"tier": "large"}
+    ]
+}
+RULE_CONDITIONS = ["min_candidates", "max_candidates", "min_history", "max_history", "phases", "has_image"]
+
+
+class ModelRouter:
+    def __init__(self, config):
+        """
+        Picks the model tier, and whether the annotated screenshot is sent, from features of the screen
+        that are computed anyway: number of candidate elements, phase, history length and image presence.
+
+        Args:
+            config: {"tiers": {name: {"model", "include_image"}}, "rules": [{"tier", condition: value, ...}]}
+                    A rule may also set include_image to override its tier's setting.
+        """
+        self.tiers = config["tiers"]
+        self.rules = config["rules"]
+        for rule in self.rules:
+            if rule.get("tier") not in self.tiers:
+                raise ValueError(f"Model routing rule refers to unknown tier - {rule}")
+            unknown_conditions = set(rule) - set(RULE_CONDITIONS) - {"tier", "include_image"}
+            if unknown_conditions:
+                raise ValueError(f"Model routing rule has unknown conditions {sorted(unknown_conditions)} - {rule}")
+
+    @staticmethod
+    def matches(rule, features):
+        candidates, history_length = features["candidates"], features["history_length"]
+        return all([
+            rule.get("min_candidates") is None or candidates >= rule["min_candidates"],
+            rule.get("max_candidates") is None or candidates <= rule["max_candidates"],
+            rule.get("min_history") is None or history_length >= rule["min_history"],
+            rule.get("max_history") is None or history_length <= rule["max_history"],
+            rule.get("phases") is None or features["phase"] in rule["phases"],
+            rule.get("has_image") is None or features["has_image"] == rule["has_image"]
+        ])
+
+    def route(self, features):
+        """Returns {"tier", "model", "include_image"} for the screen features."""
+        for rule in self.rules:
+            if self.matches(rule, features):
+                tier = self.tiers[rule["tier"]]
+                return {"tier": rule["tier"], "model": tier["model"], "include_image": rule.get("include_image", tier.get("include_image", True))}
+        # No catch-all rule configured; the largest behaviour is the safe default
+        return None
+
+
+def get_screen_features(candidates, phase, history, image):
+    return {"candidates": len(candidates), "phase": phase, "history_length": len(history or []), "has_image": bool(image)}
+
+def get_llm_for_model(llm, model):
+    """Copy of the LLM client for another model; the copy shares the underlying HTTP client."""
+    if model is None or getattr(llm, 'model_name', None) == model or not hasattr(llm, 'model_copy'):
+        return llm
+    return llm.model_copy(update={"model_name": model})
+
+def load_routing_config():
+    config_path = os.getenv("MODEL_ROUTING_CONFIG")
+    if not config_path:
+        return DEFAULT_ROUTING_CONFIG
+    with open(config_path) as config_file:
+        return json.load(config_file)
+
+
+model_router = None
+
+def get_model_router():
+    """The router, or None when MODEL_ROUTING_ENABLED is not set; without it every screen uses the configured model."""
+    global model_router
+    if os.getenv("MODEL_ROUTING_ENABLED", "false").lower() != "true":
+        return None
+    if model_router is None:
+        try:
+            model_router = ModelRouter(load_routing_config())
+        except Exception as e:
+            logger.exception("Invalid model routing config; using the default rules - %s", e)
+            model_router = ModelRouter(DEFAULT_ROUTING_CONFIG)
+    return model_router
@@ -0,0 +1,125 @@
+import math
+import os
+from xml_utils import parse_bounds
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Regions named in a partition's prompt; partitions merged from more pieces name the first ones and count the rest
+MAX_NAMED_REGIONS = 3
+PARTITION_MERGE_LLM = "llm"
+PARTITION_MERGE_INTERLEAVE = "interleave"
+
+
+def is_partitioned_ranking_enabled():
+    return os.getenv("PARTITIONED_RANKING_ENABLED", "true").lower() == "true"
+
+def get_partition_limits():
+    """(candidates from which a screen is partitioned, candidates per partition, partitions per screen)"""
+    return (int(os.getenv("PARTITION_MIN_CANDIDATES", "80")), int(os.getenv("PARTITION_MAX_CANDIDATES", "40")),
+            int(os.getenv("PARTITION_MAX_CALLS", "4")))
+
+def get_partition_merge_mode():
+    return os.getenv("PARTITION_MERGE", PARTITION_MERGE_LLM).lower()
+
+def get_partition_merge_top():
+    return int(os.getenv("PARTITION_MERGE_TOP", "3"))
+
+def get_top(element):
+    left, top, right, bottom = parse_bounds(element.get("attributes", {}).get("bounds", "[0,0][0,0]"))
+    return top, left
+
+def get_scrollable_container(uitree, node_id):
+    # The raw XML attributes are read: processed elements inherit scrollable from their parent
+    parent_id = uitree.get_parent(node_id)
+    while parent_id is not None:
+        if uitree.graph.nodes[parent_id]['attributes'].get('scrollable') == 'true':
+            return parent_id
+        parent_id = uitree.get_parent(parent_id)
+    return None
+
+def describe_container(uitree, container_id):
+    if container_id is None:
+        return "outside the scrollable containers"
+    attributes = uitree.graph.nodes[container_id]['attributes']
+    name = " ".join(part for part in [attributes.get('class', '').split('.')[-1], attributes.get('resource-id', '').split('/')[-1]] if part)
+    return f"inside the scrollable {name or 'container'} at {attributes.get('bounds', '')}".rstrip()
+
+def describe_regions(regions):
+    if len(regions) <= MAX_NAMED_REGIONS:
+        return "; ".join(regions)
+    return "; ".join(regions[:MAX_NAMED_REGIONS]) + f"; and {len(regions) - MAX_NAMED_REGIONS} more regions below them"
+
+def merge_adjacent(pieces, max_size, max_partitions):
+    """Merge neighbouring pieces, top to bottom, while they fit in max_size, then until at most max_partitions remain."""
+    merged = []
+    for piece in pieces:
+        if merged and len(merged[-1]["elements"]) + len(piece["elements"]) <= max_size:
+            merged[-1] = {"regions": merged[-1]["regions"] + piece["regions"], "elements": merged[-1]["elements"] + piece["elements"]}
+        else:
+            merged.append(piece)
+    while len(merged) > max_partitions:
+        index = min(range(len(merged) - 1), key=lambda position: len(merged[position]["elements"]) + len(merged[position + 1]["elements"]))
+        merged[index:index + 2] = [{"regions": merged[index]["regions"] + merged[index + 1]["regions"], "elements": merged[index]["elements"] + merged[index + 1]["elements"]}]
+    return merged
+
+def partition_candidates(uitree, candidates):
+    """
+    Split the candidates of a large screen into partitions ranked by separate, concurrent LLM calls.
+
+    Candidates are grouped by their nearest scrollable ancestor (lists, carousels, tab pages; candidates outside
+    any form one group), and groups above PARTITION_MAX_CANDIDATES are cut into bands from top to bottom.
+    Neighbouring pieces are then merged while they fit in PARTITION_MAX_CANDIDATES, and further until at most
+    PARTITION_MAX_CALLS remain.
+
+    Returns a list of {"region": description for the prompt, "elements": candidates in screen order}; empty when
+    the screen has fewer than PARTITION_MIN_CANDIDATES candidates or does not split, and is ranked in one call.
+    """
+    min_candidates, max_size, max_partitions = get_partition_limits()
+    if len(candidates) < min_candidates or max_partitions < 2:
+        return []
+    groups = dict() # scrollable container node_id, None outside any -> candidates
+    for element in candidates:
+        groups.setdefault(get_scrollable_container(uitree, element.get("node_id")), []).append(element)
+
+    pieces = []
+    for container_id, elements in groups.items():
+        elements = sorted(elements, key=get_top)
+        band_count = math.ceil(len(elements) / max_size)
+        band_size = math.ceil(len(elements) / band_count)
+        region = describe_container(uitree, container_id)
+        for band in range(band_count):
+            band_region = region if band_count == 1 else f"{region}, part {band + 1} of {band_count} from the top"
+            pieces.append({"regions": [band_region], "elements": elements[band * band_size:(band + 1) * band_size]})
+    pieces.sort(key=lambda piece: get_top(piece["elements"][0]))
+    partitions = merge_adjacent(pieces, max_size, max_partitions)
+    if len(partitions) < 2:
+        return []
+    logger.debug("Candidates partitioned", extra={"partitions": [len(partition["elements"]) for partition in partitions], "scrollable_groups": len(groups)})
+    return [{"region": describe_regions(partition["regions"]), "elements": partition["elements"]} for partition in partitions]
+
+def interleave_rankings(rankings):
+    """Round robin over the rankings (lists of node ids), best first; each node id once."""
+    merged, seen = [], set()
+    for position in range(max((len(ranking) for ranking in rankings), default=0)):
+        for ranking in rankings:
+            if position < len(ranking) and ranking[position] not in seen:
+                merged.append(ranking[position])
+                seen.add(ranking[position])
+    return merged
+
+def merge_partition_rankings(rankings, ordered_top=None):
+    """
+    Final order of a partitioned ranking. rankings holds the node ids each partition's LLM call ranked, best
+    first; ordered_top is the order the merge call gave to their top candidates, or None without one.
+
+    The ordered top candidates come first. The rest follow round robin, starting with the partition whose
+    candidate came first in ordered_top.
+    """
+    if not ordered_top:
+        return interleave_rankings(rankings)
+    ordered_top = list(dict.fromkeys(ordered_top))
+    position_in_top = {node_id: position for position, node_id in enumerate(ordered_top)}
+    rankings = sorted(rankings, key=lambda ranking: min((position_in_top.get(node_id, len(ordered_top)) for node_id in ranking), default=len(ordered_top)))
+    placed = set(ordered_top)
+    return ordered_top + interleave_rankings([[node_id for node_id in ranking if node_id not in placed] for ranking in rankings])
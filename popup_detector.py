@@ -0,0 +1,86 @@
+import os
+import re
+from xml_utils import parse_bounds
+
+import logging
+logger = logging.getLogger(__name__)
+
+NO_POPUP = "no_popup"
+LIKELY_POPUP = "likely_popup"
+UNSURE = "unsure"
+
+DIALOG_CLASS_PATTERN = re.compile(r"dialog|alert|popup|bottomsheet|modal", re.IGNORECASE)
+DIALOG_RESOURCE_ID_PATTERN = re.compile(r"android:id/(alertTitle|parentPanel|buttonPanel|button[123]|message)$|dialog|alert|popup|bottom_?sheet|modal|interstitial", re.IGNORECASE)
+SCRIM_RESOURCE_ID_PATTERN = re.compile(r"scrim|dim|touch_outside|overlay|backdrop", re.IGNORECASE)
+DISMISS_PATTERN = re.compile(r"^\s*(close|dismiss|cancel|not now|no,? thanks|no thank you|skip|later|maybe later|remind me later|got it|deny|don'?t allow|x|×|✕|✖)\s*$|close|dismiss", re.IGNORECASE)
+# A window or container smaller than this fraction of the screen, drawn over other content, looks like a dialog
+DIALOG_MAX_AREA_FRACTION = 0.85
+# Anything at or above this fraction counts as covering the whole screen
+FULL_SCREEN_AREA_FRACTION = 0.95
+
+
+def get_area(bounds):
+    left, top, right, bottom = bounds
+    return max(0, right - left) * max(0, bottom - top)
+
+def get_screen_bounds(uitree, window_ids):
+    bounds = [parse_bounds(uitree.graph.nodes[node_id]['attributes'].get('bounds', '[0,0][0,0]')) for node_id in window_ids]
+    if not bounds:
+        return (0, 0, 0, 0)
+    return (min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+def detect_popup(uitree):
+    """
+    Classify the screen as NO_POPUP, LIKELY_POPUP or UNSURE from the UI hierarchy alone.
+
+    Signals:
+    - strong: dialog/alert/bottom sheet classes or resource ids, a top-level window smaller than the screen
+      drawn over another window, a dimmed background (scrim) container covering the screen
+    - weak: a clickable close/dismiss element, a full screen window drawn over another window
+
+    Returns (verdict, reasons).
+    """
+    graph = uitree.graph
+    root_ids = [node_id for node_id in graph.nodes if graph.in_degree(node_id) == 0]
+    # uiautomator dumps have a <hierarchy> root whose children are the windows on screen
+    window_ids = [child for root_id in root_ids for child in graph.successors(root_id)] if root_ids and graph.nodes[root_ids[0]].get('tag') == 'hierarchy' else root_ids
+    screen_bounds = get_screen_bounds(uitree, window_ids)
+    screen_area = get_area(screen_bounds)
+    if screen_area == 0:
+        return UNSURE, ["screen bounds unknown"]
+
+    strong_reasons, weak_reasons = [], []
+    if len(window_ids) > 1:
+        for window_id in window_ids[1:]:
+            window_area = get_area(parse_bounds(graph.nodes[window_id]['attributes'].get('bounds', '[0,0][0,0]')))
+            if 0 < window_area < DIALOG_MAX_AREA_FRACTION * screen_area:
+                strong_reasons.append(f"window {window_id} covers {round(window_area / screen_area, 2)} of the screen over another window")
+            elif window_area >= FULL_SCREEN_AREA_FRACTION * screen_area:
+                weak_reasons.append(f"full screen window {window_id} over another window")
+
+    for node_id, node_data in graph.nodes(data=True):
+        attributes = node_data.get('attributes', {})
+        element_class = attributes.get('class', '')
+        resource_id = attributes.get('resource-id', '')
+        if DIALOG_CLASS_PATTERN.search(element_class):
+            strong_reasons.append(f"dialog class {element_class}")
+        elif resource_id and DIALOG_RESOURCE_ID_PATTERN.search(resource_id):
+            strong_reasons.append(f"dialog resource id {resource_id}")
+        elif resource_id and SCRIM_RESOURCE_ID_PATTERN.search(resource_id):
+            if get_area(parse_bounds(attributes.get('bounds', '[0,0][0,0]'))) >= FULL_SCREEN_AREA_FRACTION * screen_area:
+                strong_reasons.append(f"dimmed background {resource_id}")
+        if attributes.get('clickable') == 'true':
+            label = " ".join([attributes.get('text', ''), attributes.get('content-desc', ''), resource_id.split('/')[-1]]).strip()
+            if label and DISMISS_PATTERN.search(label):
+                weak_reasons.append(f"dismiss element '{label}'")
+        if len(strong_reasons) >= 3:
+            break
+
+    if strong_reasons:
+        return LIKELY_POPUP, strong_reasons + weak_reasons
+    if weak_reasons:
+        return UNSURE, weak_reasons
+    return NO_POPUP, []
+
+def is_popup_predetector_enabled():
+    return os.getenv("POPUP_PREDETECTOR_ENABLED", "true").lower() == "true"
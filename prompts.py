@@ -40,6 +40,24 @@ action_prioritization_template_v1 = """
     Generate the output in JSON only, without any additional text.
 """
 
+# Appended to the prioritization prompt when some elements are given by their known action only
+known_elements_instruction = """
+Known elements:
+Some actionable elements are given as node_id and known_action only: elements of the app seen on earlier screens whose action is already described. Rank them like the other elements, but give only their node_id in ranked_actions, without an action_description.
+"""
+
+# Appended to the prioritization prompt of one partition of a large screen; {region} tells where its elements are
+partition_instruction = """
+Screen region:
+The screen has too many actionable elements for one ranking, so it is ranked in regions. The elements above are the ones {region}; the other regions are ranked separately. Rank these elements only, as they contribute to the objective on the whole screen.
+"""
+
+# Appended to the prioritization prompt that orders the best elements of every region of a large screen
+partition_merge_instruction = """
+Screen regions:
+The elements above are the highest ranked elements of each region of a screen with too many actionable elements for one ranking. Rank them across the whole screen.
+"""
+
 action_prioritization_template = """
   Following screen context describes the mobile app screen in short:
 {screen_context}
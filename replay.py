@@ -0,0 +1,200 @@
+"""
+Offline bulk replay of recorded screens through the seek_guidance pipeline.
+
+Re-ranks recorded XML/screenshot pairs after prompt or heuristic changes without going through HTTP.
+Recordings are streamed from either
+- a directory of <name>.xml files, each with an optional <name>.png/.jpg/.jpeg screenshot and an optional
+  <name>.json holding phase, history, user_prompt and config_data, or
+- a JSONL manifest, one recording per line: {"id", "xml" | "xml_path", "image" | "image_path", "phase", "history", "user_prompt", "config_data"}
+
+Results are appended to a JSONL file as each recording completes. The output doubles as the checkpoint:
+re-running with the same --output skips recordings that already succeeded.
+
+    python replay.py --input recordings/ --output reranked.jsonl --concurrency 16 --skip-popup --skip-datagen
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+from dotenv import load_dotenv
+from log_config import configure_logging
+
+import logging
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg"]
+
+
+def iterate_directory(input_directory):
+    for file_name in sorted(os.listdir(input_directory)):
+        stem, extension = os.path.splitext(file_name)
+        if extension.lower() != ".xml":
+            continue
+        recording = {"id": stem, "xml_path": os.path.join(input_directory, file_name)}
+        for image_extension in IMAGE_EXTENSIONS:
+            image_path = os.path.join(input_directory, stem + image_extension)
+            if os.path.exists(image_path):
+                recording["image_path"] = image_path
+                break
+        metadata_path = os.path.join(input_directory, stem + ".json")
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as metadata_file:
+                recording.update({key: value for key, value in json.load(metadata_file).items() if key not in ["id", "xml_path", "image_path"]})
+        yield recording
+
+def iterate_manifest(manifest_path):
+    manifest_directory = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path) as manifest_file:
+        for line_number, line in enumerate(manifest_file):
+            if not line.strip():
+                continue
+            recording = json.loads(line)
+            recording.setdefault("id", str(line_number))
+            # Relative paths in the manifest are relative to the manifest itself
+            for path_field in ["xml_path", "image_path"]:
+                if recording.get(path_field) and not os.path.isabs(recording[path_field]):
+                    recording[path_field] = os.path.join(manifest_directory, recording[path_field])
+            yield recording
+
+def iterate_recordings(input_path):
+    return iterate_directory(input_path) if os.path.isdir(input_path) else iterate_manifest(input_path)
+
+def load_completed_ids(output_path, retry_failed):
+    completed_ids = set()
+    if not os.path.exists(output_path):
+        return completed_ids
+    with open(output_path) as output_file:
+        for line in output_file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue # A line cut short by an interrupted run
+            if result.get("status") == "success" or not retry_failed:
+                completed_ids.add(str(result.get("id")))
+    return completed_ids
+
+def read_recording_inputs(recording):
+    xml = recording.get("xml")
+    if xml is None:
+        with open(recording["xml_path"], "r", encoding="utf-8") as xml_file:
+            xml = xml_file.read()
+    image = recording.get("image")
+    if image is None and recording.get("image_path"):
+        with open(recording["image_path"], "rb") as image_file:
+            image = base64.b64encode(image_file.read()).decode()
+    return xml, image
+
+async def replay_recording(recording, llm, semaphore):
+    from main import seek_guidance
+    from metrics import request_timings
+
+    request_id = f"replay-{recording['id']}"
+    async with semaphore:
+        request_timings.set(dict())
+        start_time = time.perf_counter()
+        try:
+            xml, image = await asyncio.to_thread(read_recording_inputs, recording)
+            ranked_actions, explanation, journey_completed, details = await seek_guidance(
+                request_id=request_id, xml=xml, image=image, xml_url=None, image_url=None,
+                config_data=recording.get("config_data") or {}, user_prompt=recording.get("user_prompt") or "",
+                history=recording.get("history") or [], phase=recording.get("phase") or "2", llm=llm
+            )
+            return {
+                "id": recording["id"], "status": "success", "ranked_actions": ranked_actions,
+                "explanation": explanation, "journey_completed": journey_completed, "model": details["model"],
+                "timings": dict(request_timings.get(), total_ms=round((time.perf_counter() - start_time) * 1000, 3))
+            }
+        except Exception as e:
+            logger.exception("Replay failed - %s", e, extra={"request_id": request_id})
+            return {"id": recording["id"], "status": "error", "error": str(e)}
+
+async def replay(args):
+    from llm import initialize_llm
+
+    completed_ids = load_completed_ids(args.output, args.retry_failed)
+    if completed_ids:
+        logger.info("Resuming; %s recordings already in %s will be skipped", len(completed_ids), args.output)
+    llm = initialize_llm(os.getenv("OPENAI_API_KEY"))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    pending = set()
+    counts = {"success": 0, "error": 0, "skipped": 0}
+    start_time = time.perf_counter()
+
+    with open(args.output, "a") as output_file:
+        def write_result(task):
+            result = task.result()
+            counts[result["status"]] += 1
+            output_file.write(json.dumps(result, default=str) + "\n")
+            if (counts["success"] + counts["error"]) % args.checkpoint_every == 0:
+                output_file.flush()
+                os.fsync(output_file.fileno())
+                processed = counts["success"] + counts["error"]
+                logger.info("Replay progress", extra={"processed": processed, "errors": counts["error"], "recordings_per_second": round(processed / (time.perf_counter() - start_time), 2)})
+
+        for recording in iterate_recordings(args.input):
+            if str(recording["id"]) in completed_ids:
+                counts["skipped"] += 1
+                continue
+            if args.limit is not None and counts["success"] + counts["error"] + len(pending) >= args.limit:
+                break
+            # Keep at most twice the concurrency scheduled so huge inputs are streamed, not loaded up front
+            while len(pending) >= args.concurrency * 2:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    write_result(task)
+            pending.add(asyncio.create_task(replay_recording(recording, llm, semaphore)))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                write_result(task)
+        output_file.flush()
+        os.fsync(output_file.fileno())
+
+    elapsed = time.perf_counter() - start_time
+    logger.info("Replay done", extra={"succeeded": counts["success"], "failed": counts["error"], "skipped": counts["skipped"], "elapsed_seconds": round(elapsed, 1)})
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded screens through the guidance pipeline")
+    parser.add_argument("--input", required=True, help="Directory of recordings or a JSONL manifest")
+    parser.add_argument("--output", required=True, help="JSONL file results are appended to; also the resume checkpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="Recordings processed at the same time (bounds concurrent LLM calls)")
+    parser.add_argument("--process-workers", type=int, default=None, help="Worker processes for parsing and annotation (default: number of CPUs)")
+    parser.add_argument("--checkpoint-every", type=int, default=50, help="Flush the output to disk every N results")
+    parser.add_argument("--limit", type=int, default=None, help="Process at most N recordings")
+    parser.add_argument("--retry-failed", action="store_true", help="Re-run recordings whose previous result is an error")
+    parser.add_argument("--skip-popup", action="store_true", help="Do not call the popup handler agent")
+    parser.add_argument("--skip-datagen", action="store_true", help="Do not call the test data generator agent")
+    args = parser.parse_args()
+
+    load_dotenv()
+    configure_logging()
+    if args.process_workers:
+        os.environ["PROCESS_POOL_WORKERS"] = str(args.process_workers)
+    if args.skip_popup:
+        os.environ.pop("POPUP_HANDLER_URL", None)
+    if args.skip_datagen:
+        os.environ.pop("TEST_DATA_GENERATOR_URL", None)
+    # Allow every in-flight recording to have its parse and annotate stages queued at once
+    os.environ.setdefault("EXECUTOR_MAX_QUEUE_DEPTH", str(max(64, args.concurrency * 2)))
+    if not os.getenv("OPENAI_API_KEY"):
+        logger.error("LLM API key not found. Please check your environment variables")
+        sys.exit(1)
+
+    from executors import shutdown_executors
+    from screen_graph import get_screen_graph
+    try:
+        counts = asyncio.run(replay(args))
+    finally:
+        screen_graph = get_screen_graph()
+        if screen_graph:
+            screen_graph.flush(force=True)
+        shutdown_executors()
+    sys.exit(1 if counts["error"] else 0)
+
+
+if __name__ == "__main__":
+    main()
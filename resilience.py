@@ -0,0 +1,189 @@
+import asyncio
+import os
+import time
+from metrics import CIRCUIT_BREAKER_STATE, CONCURRENCY_LIMIT, DEPENDENCY_IN_FLIGHT, DEPENDENCY_REJECTIONS_TOTAL
+
+import logging
+logger = logging.getLogger(__name__)
+
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", "5"))
+CIRCUIT_BREAKER_RECOVERY_SECONDS = float(os.getenv("CIRCUIT_BREAKER_RECOVERY_SECONDS", "30"))
+ADAPTIVE_CONCURRENCY_ENABLED = os.getenv("ADAPTIVE_CONCURRENCY_ENABLED", "true").lower() == "true"
+CONCURRENCY_LIMIT_INITIAL = int(os.getenv("CONCURRENCY_LIMIT_INITIAL", "16"))
+CONCURRENCY_LIMIT_MIN = int(os.getenv("CONCURRENCY_LIMIT_MIN", "1"))
+CONCURRENCY_LIMIT_MAX = int(os.getenv("CONCURRENCY_LIMIT_MAX", "128"))
+DEPENDENCIES = ["popup", "datagen", "llm"]
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, recovery_seconds=30):
+        """
+        Stops calls to a dependency after failure_threshold consecutive failures. After recovery_seconds one
+        trial call is let through (half open); its success closes the breaker, its failure opens it again.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        CIRCUIT_BREAKER_STATE.set(STATE_VALUES[CLOSED], dependency=name)
+
+    def set_state(self, state):
+        if state != self.state:
+            logger.warning("Circuit breaker %s :: %s -> %s", self.name, self.state, state)
+        self.state = state
+        CIRCUIT_BREAKER_STATE.set(STATE_VALUES[state], dependency=self.name)
+
+    def allow(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.recovery_seconds:
+            self.set_state(HALF_OPEN)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.trial_in_flight = False
+        self.set_state(CLOSED)
+
+    def record_skipped(self):
+        # An attempt that says nothing about the dependency frees the trial slot and leaves the state as it is
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self.trial_in_flight = False
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self.set_state(OPEN)
+
+    def status(self):
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures,
+                "retry_in_seconds": round(max(0.0, self.opened_at + self.recovery_seconds - time.monotonic()), 3) if self.state == OPEN else None}
+
+
+class AdaptiveConcurrencyLimiter:
+    def __init__(self, name, initial_limit=16, min_limit=1, max_limit=128):
+        """
+        AIMD limit on concurrent calls to a dependency: every successful call raises the limit by 1/limit
+        (about +1 per round of calls), every failure or timeout halves it.
+        """
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.waiters = []
+        self.update_gauges()
+
+    def update_gauges(self):
+        CONCURRENCY_LIMIT.set(int(self.limit), dependency=self.name)
+        DEPENDENCY_IN_FLIGHT.set(self.in_flight, dependency=self.name)
+
+    def try_acquire(self):
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            self.update_gauges()
+            return True
+        return False
+
+    async def acquire(self, timeout_seconds):
+        """Wait up to timeout_seconds for a free slot; returns False when none freed up in time."""
+        if self.try_acquire():
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            # release() hands its slot over to the waiter, so in_flight is already counted
+            await asyncio.wait_for(waiter, timeout_seconds)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    def release(self, success):
+        """success None frees the slot and leaves the limit unchanged."""
+        if success:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        elif success is not None:
+            self.limit = max(self.min_limit, self.limit / 2)
+        while self.waiters and self.in_flight <= int(self.limit):
+            waiter = self.waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(True)
+                self.update_gauges()
+                return
+        self.in_flight -= 1
+        self.update_gauges()
+
+    def status(self):
+        return {"limit": int(self.limit), "in_flight": self.in_flight, "waiting": len(self.waiters)}
+
+
+class DependencyGuard:
+    def __init__(self, name):
+        self.name = name
+        self.breaker = CircuitBreaker(name, CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RECOVERY_SECONDS)
+        self.limiter = AdaptiveConcurrencyLimiter(name, CONCURRENCY_LIMIT_INITIAL, CONCURRENCY_LIMIT_MIN, CONCURRENCY_LIMIT_MAX) if ADAPTIVE_CONCURRENCY_ENABLED else None
+
+    async def acquire(self, request_id, timeout_seconds):
+        """Returns True when a call may be made; False when the breaker is open or no slot freed up in time."""
+        if not self.breaker.allow():
+            DEPENDENCY_REJECTIONS_TOTAL.inc(dependency=self.name, reason="circuit_open")
+            logger.info("Circuit breaker for %s is open; skipping", self.name, extra={"request_id": request_id})
+            return False
+        if self.limiter and not await self.limiter.acquire(timeout_seconds):
+            if self.breaker.state == HALF_OPEN:
+                self.breaker.trial_in_flight = False
+            DEPENDENCY_REJECTIONS_TOTAL.inc(dependency=self.name, reason="concurrency_limit")
+            logger.info("Concurrency limit for %s reached; skipping", self.name, extra={"request_id": request_id, "limiter": self.limiter.status()})
+            return False
+        return True
+
+    def try_acquire(self):
+        """Non-blocking acquire for hedged attempts."""
+        if self.breaker.state != CLOSED:
+            return False
+        return self.limiter.try_acquire() if self.limiter else True
+
+    def release(self, success):
+        """
+        success is True for an answer, False for a provider error or a timeout on the dependency's own timeout,
+        and None for an attempt that was not made or that ran out of the caller's latency budget; those neither
+        count towards the breaker nor change the concurrency limit.
+        """
+        if success:
+            self.breaker.record_success()
+        elif success is None:
+            self.breaker.record_skipped()
+        else:
+            self.breaker.record_failure()
+        if self.limiter:
+            self.limiter.release(success)
+
+    def status(self):
+        status = {"circuit_breaker": self.breaker.status()}
+        if self.limiter:
+            status["concurrency"] = self.limiter.status()
+        return status
+
+
+dependency_guards = dict()
+
+def get_dependency_guard(name):
+    if name not in dependency_guards:
+        dependency_guards[name] = DependencyGuard(name)
+    return dependency_guards[name]
+
+def get_dependency_status():
+    return {name: get_dependency_guard(name).status() for name in DEPENDENCIES}
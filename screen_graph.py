@@ -0,0 +1,330 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import networkx as nx
+from networkx.readwrite import json_graph
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Phase in which the next hop to the home screen can be answered from the graph
+HOME_SEARCH_PHASE = "find-home-node"
+# Attributes persisted on an edge to re-identify the acted element on a later visit
+ACTION_ATTRIBUTES = ["xpath", "resource_id", "class", "text", "content_desc", "bounds"]
+
+
+class ScreenGraph:
+    def __init__(self, path, flush_interval_seconds=5.0, max_sessions=1024, session_ttl_seconds=600.0, max_screens=10000):
+        """
+        Persistent screen transition graph shared by all requests of a worker.
+
+        Nodes are screen fingerprints (see UITree.get_fingerprint) and an edge u -> v records
+        the action taken on screen u that led to screen v. The graph is loaded from disk on
+        first use and written back at most once every flush_interval_seconds.
+
+        Workers of one host share the file: a flush takes a lock on it, reads what the other workers
+        wrote, adds the visits, hits and transitions recorded here since the last flush and replaces
+        the file atomically. The merged graph then becomes this worker's graph.
+
+        The graph keeps at most max_screens screens; each flush drops the ones seen least recently beyond that,
+        so searching it stays bounded.
+
+        Args:
+            path: JSON file the graph is persisted to
+            flush_interval_seconds: Minimum gap between two writes of the graph to disk
+            max_sessions: Sessions whose last step is kept; the least recently used one is dropped beyond this
+            session_ttl_seconds: Sessions without a step for this long are dropped
+            max_screens: Screens kept in the graph; the least recently seen are dropped when it is flushed
+        """
+        self.path = path
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_sessions = max_sessions
+        self.session_ttl_seconds = session_ttl_seconds
+        self.max_screens = max_screens
+        self.graph = None
+        self.last_step_by_session = OrderedDict() # session_id -> {"fingerprint": ..., "ranked_actions": [...], "time": ...}
+        self.changes = new_changes() # what this worker recorded since the last flush
+        self.last_flush_time = 0.0
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.graph is not None:
+                return self.graph
+            self.graph = self.read_graph()
+            logger.info("Screen graph loaded from %s", self.path, extra={"screens": self.graph.number_of_nodes(), "transitions": self.graph.number_of_edges()})
+            return self.graph
+
+    def read_graph(self):
+        if not self.path or not os.path.exists(self.path):
+            return nx.DiGraph()
+        try:
+            with open(self.path, 'r') as graph_file:
+                return json_graph.node_link_graph(json.load(graph_file), directed=True, multigraph=False, edges="edges")
+        except Exception as e:
+            logger.exception("Screen graph could not be loaded from %s; starting with an empty graph - %s", self.path, e)
+            return nx.DiGraph()
+
+    def is_flush_due(self):
+        return self.graph is not None and not is_empty(self.changes) and time.monotonic() - self.last_flush_time >= self.flush_interval_seconds
+
+    def flush(self, force=False):
+        """
+        Merge the changes of this worker into the file and prune the graph to max_screens; blocking, so it runs in
+        a thread (or at shutdown). Without a path only the graph in memory is pruned.
+        """
+        if not force and not self.is_flush_due():
+            return
+        with self.flush_lock:
+            with self.lock:
+                if self.graph is None or is_empty(self.changes):
+                    return
+                changes, self.changes = self.changes, new_changes()
+                self.last_flush_time = time.monotonic()
+                if not self.path:
+                    prune_screens(self.graph, self.max_screens)
+                    return
+            try:
+                with locked_file(f"{self.path}.lock"):
+                    graph = self.read_graph()
+                    apply_changes(graph, changes)
+                    prune_screens(graph, self.max_screens)
+                    tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                    with open(tmp_path, 'w') as graph_file:
+                        json.dump(json_graph.node_link_data(graph, edges="edges"), graph_file)
+                    os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.exception("Screen graph could not be written to %s - %s", self.path, e)
+                with self.lock:
+                    # Kept for the next flush, together with what was recorded meanwhile
+                    self.changes = merge_changes(changes, self.changes)
+                return
+            with self.lock:
+                # What was recorded while the file was written is on the old graph only
+                apply_changes(graph, self.changes)
+                self.graph = graph
+
+    def evict_sessions(self):
+        expiry = time.monotonic() - self.session_ttl_seconds
+        while self.last_step_by_session:
+            session_id, step = next(iter(self.last_step_by_session.items()))
+            if step["time"] >= expiry and len(self.last_step_by_session) <= self.max_sessions:
+                break
+            self.last_step_by_session.pop(session_id)
+
+    def add_screen(self, fingerprint, is_home=False, visits=1):
+        graph = self.load()
+        with self.lock:
+            screen_change = {"visits": visits, "is_home": is_home, "last_seen": time.time()}
+            apply_screen_change(graph, fingerprint, screen_change)
+            self.changes["screens"][fingerprint] = merge_screen_change(self.changes["screens"].get(fingerprint), screen_change)
+
+    def mark_home(self, fingerprint):
+        # The visit itself was counted by record_step
+        self.add_screen(fingerprint, is_home=True, visits=0)
+
+    def add_transition(self, from_fingerprint, to_fingerprint, action):
+        graph = self.load()
+        with self.lock:
+            if from_fingerprint == to_fingerprint:
+                return
+            transition_change = {"hits": 1, "action": action, "last_seen": time.time()}
+            apply_transition_change(graph, from_fingerprint, to_fingerprint, transition_change)
+            key = (from_fingerprint, to_fingerprint)
+            self.changes["transitions"][key] = merge_transition_change(self.changes["transitions"].get(key), transition_change)
+
+    def get_next_hop_to_home(self, fingerprint):
+        """
+        Returns (path_length, action) for the shortest known path from the screen to any home screen.
+        path_length is 0 with no action when the screen itself is a home screen, and None is
+        returned when no path is known. Blocking (it may load the graph), so it runs in a thread.
+        """
+        graph = self.load()
+        with self.lock:
+            if fingerprint not in graph:
+                return None
+            if graph.nodes[fingerprint].get('is_home'):
+                return 0, None
+            # Breadth first, so the first home screen reached is the closest; the search stops there
+            first_hops = {fingerprint: None}
+            frontier, path_length = [fingerprint], 0
+            while frontier:
+                path_length += 1
+                next_frontier = []
+                for node in frontier:
+                    for successor in graph.successors(node):
+                        if successor in first_hops:
+                            continue
+                        first_hops[successor] = first_hops[node] or successor
+                        if graph.nodes[successor].get('is_home'):
+                            return path_length, graph.edges[fingerprint, first_hops[successor]].get('action')
+                        next_frontier.append(successor)
+                frontier = next_frontier
+            return None
+
+    def record_step(self, request_id, session_id, fingerprint, history, phase):
+        """
+        Add the current screen to the graph and, when the previous step of the session is known,
+        the transition from the previous screen through the last action in the history. The phase alone never
+        marks a screen home; only a find-home-node step that completed its journey does (see remember_step).
+        """
+        self.add_screen(fingerprint)
+        if not session_id:
+            return
+        with self.lock:
+            previous_step = self.last_step_by_session.get(session_id)
+        if previous_step and history:
+            action = find_action_taken(previous_step.get("ranked_actions", []), history[-1])
+            if action:
+                self.add_transition(previous_step.get("fingerprint"), fingerprint, action)
+                logger.debug("Screen graph transition recorded", extra={"request_id": request_id, "from_fingerprint": previous_step.get("fingerprint"), "to_fingerprint": fingerprint})
+            else:
+                logger.debug("Last action in history could not be matched to the previous screen; transition not recorded", extra={"request_id": request_id})
+
+    def remember_step(self, session_id, fingerprint, ranked_actions, phase, journey_completed, distinctive=True):
+        """
+        Keep the session's step for its next one; writing the graph is left to flush(), called from a thread.
+        A screen whose fingerprint is not distinctive (see UITree.is_fingerprint_distinctive) is never marked home.
+        """
+        if phase == HOME_SEARCH_PHASE and journey_completed is True and distinctive:
+            self.mark_home(fingerprint)
+        if session_id:
+            with self.lock:
+                self.last_step_by_session[session_id] = {
+                    "fingerprint": fingerprint,
+                    "ranked_actions": [compact_action(action) for action in ranked_actions or []],
+                    "time": time.monotonic()
+                }
+                self.last_step_by_session.move_to_end(session_id)
+                self.evict_sessions()
+
+
+def new_changes():
+    return {"screens": dict(), "transitions": dict()} # fingerprint -> screen change, (from, to) -> transition change
+
+def is_empty(changes):
+    return not changes["screens"] and not changes["transitions"]
+
+def merge_screen_change(change, other):
+    if change is None:
+        return dict(other)
+    return {"visits": change["visits"] + other["visits"], "is_home": change["is_home"] or other["is_home"], "last_seen": max(change["last_seen"], other["last_seen"])}
+
+def merge_transition_change(change, other):
+    # The latest action taken is the one kept on the edge
+    if change is None:
+        return dict(other)
+    return {"hits": change["hits"] + other["hits"], "action": other["action"], "last_seen": max(change["last_seen"], other["last_seen"])}
+
+def merge_changes(changes, later_changes):
+    merged = new_changes()
+    for fingerprint, change in list(changes["screens"].items()) + list(later_changes["screens"].items()):
+        merged["screens"][fingerprint] = merge_screen_change(merged["screens"].get(fingerprint), change)
+    for key, change in list(changes["transitions"].items()) + list(later_changes["transitions"].items()):
+        merged["transitions"][key] = merge_transition_change(merged["transitions"].get(key), change)
+    return merged
+
+def apply_screen_change(graph, fingerprint, change):
+    if fingerprint not in graph:
+        graph.add_node(fingerprint, is_home=False, visits=0)
+    graph.nodes[fingerprint]['visits'] = graph.nodes[fingerprint].get('visits', 0) + change["visits"]
+    graph.nodes[fingerprint]['last_seen'] = max(graph.nodes[fingerprint].get('last_seen', 0), change["last_seen"])
+    if change["is_home"]:
+        graph.nodes[fingerprint]['is_home'] = True
+
+def apply_transition_change(graph, from_fingerprint, to_fingerprint, change):
+    for fingerprint in [from_fingerprint, to_fingerprint]:
+        if fingerprint not in graph:
+            graph.add_node(fingerprint, is_home=False, visits=0)
+        # A transition counts as a sighting of both of its screens
+        graph.nodes[fingerprint]['last_seen'] = max(graph.nodes[fingerprint].get('last_seen', 0), change["last_seen"])
+    hits = graph.edges[from_fingerprint, to_fingerprint].get('hits', 0) if graph.has_edge(from_fingerprint, to_fingerprint) else 0
+    graph.add_edge(from_fingerprint, to_fingerprint, action=change["action"], hits=hits + change["hits"])
+
+def apply_changes(graph, changes):
+    for fingerprint, change in changes["screens"].items():
+        apply_screen_change(graph, fingerprint, change)
+    for (from_fingerprint, to_fingerprint), change in changes["transitions"].items():
+        apply_transition_change(graph, from_fingerprint, to_fingerprint, change)
+
+def prune_screens(graph, max_screens):
+    """Drop the screens seen least recently beyond max_screens, with their transitions; screens of older files count as oldest."""
+    excess = graph.number_of_nodes() - max_screens
+    if excess <= 0:
+        return
+    stale_screens = sorted(graph.nodes, key=lambda fingerprint: graph.nodes[fingerprint].get('last_seen', 0))[:excess]
+    graph.remove_nodes_from(stale_screens)
+    logger.info("Screen graph pruned", extra={"dropped_screens": len(stale_screens), "screens": graph.number_of_nodes()})
+
+@contextmanager
+def locked_file(lock_path):
+    """Exclusive lock between the worker processes of a host; without fcntl (Windows) the write is only atomic."""
+    with open(lock_path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def compact_action(ranked_action):
+    attributes = ranked_action.get("attributes") or {}
+    action = {field: attributes.get(field) for field in ACTION_ATTRIBUTES}
+    action["action_description"] = ranked_action.get("action_description", "")
+    return action
+
+def find_action_taken(previous_actions, last_history_entry):
+    """
+    Match the last history entry against the actions ranked on the previous screen.
+    History entries are either the action_description string or a dict carrying one.
+    """
+    if isinstance(last_history_entry, dict):
+        for action in previous_actions:
+            if last_history_entry.get("xpath") and last_history_entry.get("xpath") == action.get("xpath"):
+                return action
+        last_history_entry = last_history_entry.get("action_description", "")
+    if not isinstance(last_history_entry, str) or not last_history_entry.strip():
+        return None
+    for action in previous_actions:
+        if action.get("action_description") and action.get("action_description").strip() == last_history_entry.strip():
+            return action
+    return None
+
+def find_element_for_action(uitree, action):
+    """Locate the element an edge action refers to on the current screen; xpath first, then identity attributes."""
+    if not action:
+        return None
+    for ui_element in uitree.ui_element_dict_processed.values():
+        if action.get("xpath") and ui_element.get("attributes", {}).get("xpath") == action.get("xpath"):
+            return ui_element
+    for ui_element in uitree.ui_element_dict_processed.values():
+        attributes = ui_element.get("attributes", {})
+        if action.get("resource_id") and all(attributes.get(field) == action.get(field) for field in ["resource_id", "class", "text"]):
+            return ui_element
+    return None
+
+
+screen_graph = None
+
+def get_screen_graph():
+    global screen_graph
+    if os.getenv("SCREEN_GRAPH_ENABLED", "true").lower() != "true":
+        return None
+    if screen_graph is None:
+        screen_graph = ScreenGraph(path=os.getenv("SCREEN_GRAPH_PATH", "screen_graph.json"),
+                                   flush_interval_seconds=float(os.getenv("SCREEN_GRAPH_FLUSH_INTERVAL_SECONDS", "5")),
+                                   max_sessions=int(os.getenv("SCREEN_GRAPH_MAX_SESSIONS", "1024")),
+                                   session_ttl_seconds=float(os.getenv("SCREEN_GRAPH_SESSION_TTL_SECONDS", "600")),
+                                   max_screens=int(os.getenv("SCREEN_GRAPH_MAX_SCREENS", "10000")))
+    return screen_graph
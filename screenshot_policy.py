@@ -0,0 +1,91 @@
+import os
+import re
+import networkx as nx
+from xml_utils import parse_bounds
+
+import logging
+logger = logging.getLogger(__name__)
+
+FULL_SCREENSHOT = "full"
+CROPPED_SCREENSHOT = "crops"
+NO_SCREENSHOT = "skip"
+# Sent with one partition of a partitioned ranking: the annotated part of the screenshot holding its elements
+REGION_SCREENSHOT = "region"
+
+# Surfaces that draw their content instead of describing it in the hierarchy
+DRAWN_SURFACE_CLASS_PATTERN = re.compile(r"WebView|SurfaceView|TextureView|Canvas|MapView|VideoView|PlayerView", re.IGNORECASE)
+ICON_CLASS_PATTERN = re.compile(r"Image(View|Button)|FloatingActionButton|Icon", re.IGNORECASE)
+# Widget classes of the platform and the common libraries; anything else is an app's own custom view
+STANDARD_CLASS_PREFIXES = ("android.", "androidx.", "com.google.android.material.")
+# Labels that do not say what an element does
+GENERIC_LABEL_PATTERN = re.compile(r"^\W*(image|img|icon|button|btn|view|imageview|imagebutton|null|none|\d+)?\W*$", re.IGNORECASE)
+
+
+def is_screenshot_policy_enabled():
+    return os.getenv("SCREENSHOT_POLICY_ENABLED", "true").lower() == "true"
+
+def get_label(element):
+    attributes = element.get("attributes", {})
+    return (attributes.get("text", "") + " " + attributes.get("content_desc", "")).strip()
+
+def get_missing_label_reason(element):
+    """Why the hierarchy does not tell what the element is, or None when its text or content-desc does."""
+    label = get_label(element)
+    element_class = element.get("attributes", {}).get("class", "")
+    if label and not GENERIC_LABEL_PATTERN.match(label):
+        return None
+    if ICON_CLASS_PATTERN.search(element_class):
+        return "unlabeled icon"
+    if element_class and not element_class.startswith(STANDARD_CLASS_PREFIXES):
+        return "unlabeled custom view"
+    return "unlabeled element"
+
+def get_drawn_surfaces(uitree):
+    """WebView, canvas and video surfaces on screen that expose no labeled content in the hierarchy."""
+    graph = uitree.graph
+    surfaces = []
+    for node_id, node_data in graph.nodes(data=True):
+        attributes = node_data.get('attributes', {})
+        element_class = attributes.get('class', '')
+        if not DRAWN_SURFACE_CLASS_PATTERN.search(element_class):
+            continue
+        left, top, right, bottom = parse_bounds(attributes.get('bounds', '[0,0][0,0]'))
+        if right <= left or bottom <= top:
+            continue
+        # A WebView with accessibility on describes its page as child nodes; only one that does not is opaque
+        described = any((graph.nodes[child_id]['attributes'].get('text', '') + graph.nodes[child_id]['attributes'].get('content-desc', '')).strip()
+                        for child_id in nx.descendants(graph, node_id))
+        if not described:
+            surfaces.append(f"{element_class.split('.')[-1]} {node_id}")
+    return surfaces
+
+def decide_screenshot(uitree, candidates):
+    """
+    Decide how much of the screenshot the prioritization LLM needs, from how well the hierarchy describes
+    the candidates.
+
+    - FULL_SCREENSHOT: the screen has WebView, canvas or video content the hierarchy does not describe, or
+      more unlabeled candidates than are worth cropping
+    - CROPPED_SCREENSHOT: a few candidates are unlabeled icons or custom views; only their regions are sent
+    - NO_SCREENSHOT: the share of labeled candidates is at least SCREENSHOT_MIN_COMPLETENESS
+
+    Returns (decision, completeness, unlabeled candidates, reasons); completeness is the share of
+    candidates with a meaningful text or content-desc.
+    """
+    unlabeled, reasons = [], []
+    for element in candidates:
+        reason = get_missing_label_reason(element)
+        if reason:
+            unlabeled.append(element)
+            if len(reasons) < 5:
+                reasons.append(f"{reason} {element.get('node_id')} ({element.get('attributes', {}).get('class', '')})")
+    completeness = round(1 - len(unlabeled) / len(candidates), 3) if candidates else 1.0
+
+    drawn_surfaces = get_drawn_surfaces(uitree)
+    if drawn_surfaces:
+        return FULL_SCREENSHOT, completeness, unlabeled, [f"drawn content {surface}" for surface in drawn_surfaces[:5]] + reasons
+    if completeness >= float(os.getenv("SCREENSHOT_MIN_COMPLETENESS", "1.0")):
+        return NO_SCREENSHOT, completeness, unlabeled, reasons or [f"all {len(candidates)} candidates labeled"]
+    if len(unlabeled) <= int(os.getenv("SCREENSHOT_MAX_CROPS", "4")):
+        return CROPPED_SCREENSHOT, completeness, unlabeled, reasons
+    return FULL_SCREENSHOT, completeness, unlabeled, [f"{len(unlabeled)} of {len(candidates)} candidates unlabeled"] + reasons
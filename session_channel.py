@@ -0,0 +1,166 @@
+import asyncio
+import os
+import time
+import uuid
+import orjson
+from fastapi import HTTPException, WebSocket
+from starlette.websockets import WebSocketState
+from ingest import serialize_response
+from metrics import SESSION_CHANNELS_OPEN, SESSION_MESSAGES_TOTAL, SESSION_MESSAGES_DROPPED_TOTAL
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Fields a client sets once for the session, with "start" or on any "screen"; later screens reuse them
+SESSION_FIELDS = ["session_id", "config_data", "user_prompt", "phase", "history", "latency_budget_ms", "response_fields"]
+# Messages a slow client may miss: a final ranking follows every provisional one, and heartbeats repeat
+DROPPABLE_MESSAGE_TYPES = {"provisional_ranking", "ping", "pong"}
+
+
+class SessionChannel:
+    def __init__(self, websocket: WebSocket, run_step):
+        """
+        One device agent's WebSocket connection for a crawl session.
+
+        Client messages (JSON, text or binary frames):
+            {"type": "start", <session fields>}: session_id, config_data, user_prompt, phase, history,
+                latency_budget_ms and response_fields for the following screens
+            {"type": "screen", "request_id", "xml" | "xml_url" | "xml_patch" + "base_xml_version", "image" | "image_url",
+                "history_append", <session fields>}: a step; session fields given here are kept for later steps,
+                history_append extends the session's history
+            {"type": "ping"} / {"type": "pong"}
+        Server messages: "session", "popup", "provisional_ranking", "generated_data", "ranking" (the /invoke
+        response body), "error" (status_code and detail of a step that failed), "ping" and "pong".
+
+        Screens are handled one at a time in the order received. At most SESSION_MAX_PENDING_SCREENS wait
+        behind the one in progress; more are answered with a 429 error. Outgoing messages go through a queue
+        of SESSION_MAX_OUTGOING_MESSAGES: when the client reads too slowly, provisional rankings and heartbeats
+        are dropped and the other messages wait, which holds back the next screen. A connection that sends
+        nothing for SESSION_IDLE_TIMEOUT_SECONDS, heartbeat replies included, is closed.
+
+        Args:
+            run_step: Coroutine function (request fields, on_event) returning the payload of a "ranking"
+                message; raises HTTPException for a step that cannot be served
+        """
+        self.websocket = websocket
+        self.run_step = run_step
+        self.heartbeat_seconds = float(os.getenv("SESSION_HEARTBEAT_SECONDS", "20"))
+        self.idle_timeout_seconds = float(os.getenv("SESSION_IDLE_TIMEOUT_SECONDS", "60"))
+        self.pending_screens = asyncio.Queue(maxsize=int(os.getenv("SESSION_MAX_PENDING_SCREENS", "2")))
+        self.outgoing = asyncio.Queue(maxsize=int(os.getenv("SESSION_MAX_OUTGOING_MESSAGES", "32")))
+        self.context = {"session_id": uuid.uuid4().hex, "history": []}
+        self.last_received = time.monotonic()
+        self.closed = False
+
+    async def send(self, message):
+        if self.closed:
+            # A computation outlives the channel when coalesced requests wait on it; its events go nowhere
+            SESSION_MESSAGES_DROPPED_TOTAL.inc(type=message["type"])
+            return
+        if message["type"] in DROPPABLE_MESSAGE_TYPES:
+            try:
+                self.outgoing.put_nowait(message)
+            except asyncio.QueueFull:
+                SESSION_MESSAGES_DROPPED_TOTAL.inc(type=message["type"])
+            return
+        await self.outgoing.put(message)
+
+    async def send_error(self, request_id, status_code, detail):
+        await self.send({"type": "error", "request_id": request_id, "status_code": status_code, "detail": detail})
+
+    def update_context(self, message):
+        for field in SESSION_FIELDS:
+            if field in message:
+                self.context[field] = message[field]
+        if message.get("history_append"):
+            self.context["history"] = list(self.context.get("history") or []) + list(message["history_append"])
+
+    async def receive(self):
+        while True:
+            frame = await self.websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                return
+            self.last_received = time.monotonic()
+            try:
+                message = orjson.loads(frame.get("text") or frame.get("bytes") or b"")
+                message_type = message["type"]
+            except (orjson.JSONDecodeError, TypeError, KeyError) as e:
+                SESSION_MESSAGES_TOTAL.inc(direction="in", type="invalid")
+                await self.send_error(None, 400, f"Message is not a JSON object with a type - {str(e)}")
+                continue
+            SESSION_MESSAGES_TOTAL.inc(direction="in", type=message_type)
+            if message_type == "ping":
+                await self.send({"type": "pong"})
+            elif message_type == "start":
+                self.update_context(message)
+                await self.send({"type": "session", "session_id": self.context["session_id"], "heartbeat_seconds": self.heartbeat_seconds})
+            elif message_type == "screen":
+                self.update_context(message)
+                fields = {name: value for name, value in message.items() if name not in ("type", "history_append")}
+                fields.update(self.context)
+                fields["request_id"] = message.get("request_id") or uuid.uuid4().hex
+                try:
+                    self.pending_screens.put_nowait(fields)
+                except asyncio.QueueFull:
+                    logger.warning("Screen rejected; too many screens waiting in the session", extra={"request_id": fields["request_id"], "session_id": self.context["session_id"]})
+                    await self.send_error(fields["request_id"], 429, "Too many screens waiting in this session; wait for the pending rankings")
+            elif message_type != "pong":
+                await self.send_error(message.get("request_id"), 400, f"Unknown message type {message_type}")
+
+    async def process_screens(self):
+        while True:
+            fields = await self.pending_screens.get()
+            # Each step runs in its own task, so its timings, deadline and log context start fresh
+            await asyncio.create_task(self.process_screen(fields))
+
+    async def process_screen(self, fields):
+        request_id = fields["request_id"]
+
+        async def on_event(event_type, payload):
+            await self.send({"type": event_type, "request_id": request_id, **payload})
+
+        try:
+            payload = await self.run_step(fields, on_event)
+        except HTTPException as e:
+            await self.send_error(request_id, e.status_code, e.detail)
+            return
+        await self.send({"type": "ranking", **payload})
+
+    async def write(self):
+        while True:
+            message = await self.outgoing.get()
+            await self.websocket.send_text(serialize_response(message).decode("utf-8"))
+            SESSION_MESSAGES_TOTAL.inc(direction="out", type=message["type"])
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_seconds)
+            if time.monotonic() - self.last_received > self.idle_timeout_seconds:
+                logger.info("Closing idle session channel", extra={"session_id": self.context["session_id"]})
+                return
+            await self.send({"type": "ping"})
+
+    def close(self):
+        self.closed = True
+        # Sends blocked on the full queue (a computation's events, with no writer left) are let through
+        while not self.outgoing.empty():
+            self.outgoing.get_nowait()
+
+    async def serve(self):
+        await self.websocket.accept()
+        SESSION_CHANNELS_OPEN.inc()
+        tasks = [asyncio.create_task(coroutine) for coroutine in [self.receive(), self.write(), self.process_screens(), self.heartbeat()]]
+        try:
+            # The connection ends when the client disconnects, a send fails or the client goes quiet
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    logger.warning("Session channel closed - %s", task.exception(), extra={"session_id": self.context["session_id"]})
+        finally:
+            self.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            SESSION_CHANNELS_OPEN.inc(-1)
+            if self.websocket.client_state != WebSocketState.DISCONNECTED:
+                await self.websocket.close()
@@ -0,0 +1,79 @@
+import asyncio
+import copy
+import hashlib
+import json
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    def __init__(self, max_waiters_per_key=32):
+        """
+        Coalesce concurrent calls that share a key: the first caller runs the computation and callers
+        arriving while it is in flight wait for its result (or exception) instead of repeating it.
+
+        Args:
+            max_waiters_per_key: Callers allowed to wait on one in-flight computation; callers beyond
+                                 the limit run their own computation
+        """
+        self.max_waiters_per_key = max_waiters_per_key
+        self.in_flight = dict() # key -> {"task": asyncio.Task, "leader": request id, "waiters": int}
+        self.saved_calls = 0
+
+    async def do(self, key, request_id, coroutine_factory, timeout_seconds=None):
+        """
+        Returns (result, leader_request_id); leader_request_id is None when this call ran the computation.
+        A caller waits for an in-flight computation at most timeout_seconds (None: as long as it takes) and then
+        runs its own, which its nearly spent budget keeps short.
+        """
+        call = self.in_flight.get(key)
+        if call is not None and call["waiters"] < self.max_waiters_per_key:
+            call["waiters"] += 1
+            logger.debug("Identical request in flight; waiting for it", extra={"request_id": request_id, "leader_request_id": call["leader"]})
+            try:
+                # shield: a waiter going away must not cancel the computation the others are waiting on
+                result = await asyncio.wait_for(asyncio.shield(call["task"]), timeout_seconds)
+            except asyncio.TimeoutError:
+                call["waiters"] -= 1
+                logger.warning("Identical in-flight request not done within the latency budget; computing separately", extra={"request_id": request_id, "leader_request_id": call["leader"]})
+                return await coroutine_factory(), None
+            self.saved_calls += 1
+            return copy.deepcopy(result), call["leader"]
+        if call is not None:
+            logger.info("Waiter limit reached for identical in-flight request; computing separately", extra={"request_id": request_id})
+            return await coroutine_factory(), None
+
+        # The computation runs as its own task so that it survives the cancellation of the first caller
+        task = asyncio.create_task(coroutine_factory())
+        self.in_flight[key] = {"task": task, "leader": request_id, "waiters": 0}
+        task.add_done_callback(lambda finished_task: self.forget(key, finished_task))
+        return await asyncio.shield(task), None
+
+    def forget(self, key, task):
+        if self.in_flight.get(key, {}).get("task") is task:
+            self.in_flight.pop(key, None)
+        # Mark the exception as retrieved when every caller has gone away before the task finished
+        if not task.cancelled():
+            task.exception()
+
+
+def get_request_key(xml, image, phase, user_prompt, history, config_data):
+    """Hash of everything that changes the guidance for a screen."""
+    key_hash = hashlib.sha256()
+    for part in [xml or "", image or "", phase or "", user_prompt or "", json.dumps(history or [], sort_keys=True, default=str), json.dumps(config_data or {}, sort_keys=True, default=str)]:
+        key_hash.update(part.encode("utf-8"))
+        key_hash.update(b"\x00")
+    return key_hash.hexdigest()
+
+
+singleflight = None
+
+def get_singleflight():
+    global singleflight
+    if os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() != "true":
+        return None
+    if singleflight is None:
+        singleflight = SingleFlight(max_waiters_per_key=int(os.getenv("SINGLEFLIGHT_MAX_WAITERS", "32")))
+    return singleflight
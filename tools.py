@@ -1,16 +1,24 @@
-from datetime import datetime
-from langsmith import traceable
-import requests
+from tracing import traceable
+import json
+from metrics import stage_timer, REQUEST_ERRORS_TOTAL, CACHE_REQUESTS_TOTAL, ELEMENTS_PER_SCREEN, DATAGEN_DECISIONS_TOTAL
+from executors import run_in_thread
+from input_fields import prepare_datagen_input, get_test_data_cache, get_test_data_cache_key, is_input_detection_enabled
+from llm_cache import TEST_DATA_NAMESPACE
+from deadline import call_with_deadline, mark_degraded, record_attempt_error, AGENT_REQUEST_TIMEOUT_SECONDS
+from utils import get_http_session
+from ui_tree import get_uitree_xml
 import os
-import traceback
 import logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 @traceable
-def check_for_popup(request_id, xml, xml_url, image=None, image_url=None, test_case_description="Close the pop up"):
+async def check_for_popup(request_id, xml, xml_url, image=None, image_url=None, test_case_description="Close the pop up"):
 
+    if not os.getenv("POPUP_HANDLER_URL"):
+        logger.debug("Pop Up Handler Agent not configured; skipping popup check")
+        return False, {}
     try:
-        logging.info(f"requestid :: {request_id} :: Checking for Pop Up")
+        logger.debug("Checking for Pop Up")
         payload = {
             "xml_url": xml_url,
             "xml": xml,
@@ -19,37 +27,70 @@ def check_for_popup(request_id, xml, xml_url, image=None, image_url=None, test_c
             "testcase_dec": test_case_description
         }
         # API request to popup-handler
-        logging.info(f"requestid :: {request_id} :: Calling for Pop Up Handler Agent - {os.getenv('POPUP_HANDLER_URL')}")
-        api_response = make_api_request(request_id=request_id, request_url=os.getenv("POPUP_HANDLER_URL"), payload=payload)
+        logger.debug("Calling for Pop Up Handler Agent - %s", os.getenv("POPUP_HANDLER_URL"))
+        api_response = await call_with_deadline(request_id, "popup", make_api_request, request_id=request_id, request_url=os.getenv("POPUP_HANDLER_URL"), payload=payload)
 
         if api_response and api_response.get("status", "").lower() == 'success':
             agent_response = api_response.get("agent_response", {})
             popup_detected = agent_response.get("popup_detection")
             if isinstance(popup_detected, bool) and popup_detected:
-                logging.info(f"requestid :: {request_id} :: Pop Up detected - {api_response}")
+                logger.info("Pop Up detected", extra={"api_response": api_response})
                 primary_method = agent_response.get("primary_method, {}")
                 if primary_method and "element_metadata" in primary_method:
                     element_metadata = agent_response.get("element_metadata", {})
-                    logging.info(f"requestid :: {request_id} :: Pop Up primary method found - {element_metadata}")
+                    logger.debug("Pop Up primary method found", extra={"element_metadata": element_metadata})
                     return True, element_metadata
                 else:
-                    logging.info(f"requestid :: {request_id} :: Pop Up primary method/element metadata not found; returning false")
+                    logger.info("Pop Up primary method/element metadata not found; returning false")
                     return False, {}
             else:
-                logging.info(f"requestid :: {request_id} :: Pop Up not detected - {api_response}")
+                logger.debug("Pop Up not detected")
                 return False, {}
         else:
-            logging.info(f"requestid :: {request_id} :: Pop Up Detection failed; API response - {str(api_response)}")
+            logger.warning("Pop Up Detection failed", extra={"api_response": api_response})
+            REQUEST_ERRORS_TOTAL.inc(stage="popup")
+            mark_degraded("popup")
             return False, {}
     except Exception as e:
-        logging.error(f"requestid :: {request_id} :: Pop Up detection failed with an exception - {str(e)} -- {traceback.format_exc()}")
+        logger.exception("Pop Up detection failed with an exception - %s", e)
+        REQUEST_ERRORS_TOTAL.inc(stage="popup")
+        mark_degraded("popup")
         return False, {}
 
 @traceable
-async def generate_test_data(request_id, xml, xml_url, image=None, image_url=None, config_data={}):
+async def generate_test_data(request_id, xml, xml_url, image=None, image_url=None, config_data={}, uitree=None):
 
+    if not os.getenv("TEST_DATA_GENERATOR_URL"):
+        logger.debug("Test Data Generator Agent not configured; skipping test data generation")
+        return False, []
     try:
-        logging.info(f"requestid :: {request_id} :: Generating test data")
+        test_data_cache, cache_key = None, None
+        if uitree is not None and is_input_detection_enabled():
+            input_node_ids, field_signature, subtree_xml = await run_in_thread(request_id, "input_detect", prepare_datagen_input, uitree)
+            ELEMENTS_PER_SCREEN.observe(len(input_node_ids), kind="inputs")
+            if not input_node_ids:
+                logger.debug("No input fields on the screen; skipping test data generation")
+                DATAGEN_DECISIONS_TOTAL.inc(decision="no_inputs")
+                return False, []
+            test_data_cache = get_test_data_cache()
+            if test_data_cache:
+                cache_key = get_test_data_cache_key(field_signature, config_data)
+                # The store is SQLite; reads and writes block, so they run in a thread like the LLM cache's
+                cached_test_data = await run_in_thread(request_id, "llm_cache", test_data_cache.get, TEST_DATA_NAMESPACE, cache_key)
+                if cached_test_data is not None:
+                    CACHE_REQUESTS_TOTAL.inc(cache=TEST_DATA_NAMESPACE, result="hit")
+                    DATAGEN_DECISIONS_TOTAL.inc(decision="cached")
+                    logger.debug("Test data served from cache", extra={"input_fields": len(input_node_ids)})
+                    cached_test_data = json.loads(cached_test_data)
+                    return cached_test_data["data_generation_required"], cached_test_data["fields"]
+                CACHE_REQUESTS_TOTAL.inc(cache=TEST_DATA_NAMESPACE, result="miss")
+            # Only the input fields with their labels are sent; the agent must not fetch the full screen either
+            xml, xml_url = subtree_xml, None
+        if xml is None and uitree is not None:
+            # A patched session screen is serialised only when it is sent in full
+            xml = await get_uitree_xml(request_id, uitree)
+        DATAGEN_DECISIONS_TOTAL.inc(decision="called")
+        logger.debug("Generating test data")
         payload = {
             "xml": xml,
             "xml_url": xml_url,
@@ -58,32 +99,49 @@ async def generate_test_data(request_id, xml, xml_url, image=None, image_url=Non
             "config_data": config_data
         }
         # API request to datagenerator
-        logging.info(f"requestid :: {request_id} :: Calling for Test Data Generator Agent - {os.getenv('TEST_DATA_GENERATOR_URL')}")
-        datagen_start_time = datetime.now()
-        api_response = make_api_request(request_id=request_id, request_url=os.getenv("TEST_DATA_GENERATOR_URL"), payload=payload)
-        logging.info(f"requestid :: {request_id} :: Time taken to generate test data :: {(datetime.now() - datagen_start_time).total_seconds() * 1000} milliseconds")
+        logger.debug("Calling for Test Data Generator Agent - %s", os.getenv("TEST_DATA_GENERATOR_URL"))
+        with stage_timer("datagen") as datagen_timer:
+            api_response = await call_with_deadline(request_id, "datagen", make_api_request, request_id=request_id, request_url=os.getenv("TEST_DATA_GENERATOR_URL"), payload=payload)
+        logger.debug("Test data generator answered", extra={"elapsed_ms": round(datagen_timer.elapsed_ms, 3)})
         if api_response and api_response.get("status", "").lower() == 'success':
             agent_response = api_response.get("agent_response", {})
             datagen_required = agent_response.get("data_generation_required")
-            logging.info(f"requestid :: {request_id} :: Test Data generation response received; API response - {api_response}")
+            logger.debug("Test Data generation response received", extra={"data_generation_required": datagen_required, "fields": len(agent_response.get("fields") or [])})
             if isinstance(datagen_required, bool) and agent_response.get("data_generation_required"):
                 fields = agent_response.get("fields", {})
+                if test_data_cache:
+                    await cache_test_data(request_id, test_data_cache, cache_key, True, fields)
                 return True, fields
             else:
+                if test_data_cache:
+                    await cache_test_data(request_id, test_data_cache, cache_key, False, [])
                 return False, []
         else:
-            logging.info(f"requestid :: {request_id} :: Test Data generation failed; API response - {str(api_response)}")
+            logger.warning("Test Data generation failed", extra={"api_response": api_response})
+            REQUEST_ERRORS_TOTAL.inc(stage="datagen")
+            mark_degraded("datagen")
             return False, []
     except Exception as e:
-        logging.error(f"requestid :: {request_id} :: Test Data generation failed with an exception - {str(e)} -- {traceback.format_exc()}")
+        logger.exception("Test Data generation failed with an exception - %s", e)
+        REQUEST_ERRORS_TOTAL.inc(stage="datagen")
+        mark_degraded("datagen")
         return False, []
 
+async def cache_test_data(request_id, test_data_cache, cache_key, data_generation_required, fields):
+    """Store the agent's answer; a failure to store it (e.g. a full thread pool) does not fail the answer."""
+    try:
+        await run_in_thread(request_id, "llm_cache", test_data_cache.put, TEST_DATA_NAMESPACE, cache_key, json.dumps({"data_generation_required": data_generation_required, "fields": fields}))
+    except Exception as e:
+        logger.warning("Test data could not be cached - %s", e, extra={"request_id": request_id})
+
 @traceable
-def make_api_request(request_id, request_url, payload):
+def make_api_request(request_id, request_url, payload, timeout=None):
+    import requests
     try:
-        response = requests.post(request_url, json=payload)
+        response = get_http_session().post(request_url, json=payload, timeout=timeout or AGENT_REQUEST_TIMEOUT_SECONDS)
         response.raise_for_status()  # Raises an error for bad responses
         return response.json()  # Returns the response as a JSON object
     except requests.exceptions.RequestException as e:
-        logging.error(f"requestid :: {request_id} :: Exception while making API request to - {request_url} -- Stacktrace - {traceback.format_exc()}")
+        record_attempt_error(e)
+        logger.exception("Exception while making API request to - %s", request_url, extra={"request_id": request_id})
         return None
\ No newline at end of file
@@ -0,0 +1,154 @@
+import asyncio
+import contextvars
+import functools
+import hashlib
+import os
+import random
+import re
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Share of requests traced to LangSmith when tracing is on (LANGSMITH_TRACING=true)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+# Strings longer than this are truncated in traces; XML and images are replaced by a summary whatever their size
+TRACE_MAX_STRING_LENGTH = int(os.getenv("TRACE_MAX_STRING_LENGTH", "2000"))
+# Lists longer than this keep their first items only
+TRACE_MAX_LIST_ITEMS = int(os.getenv("TRACE_MAX_LIST_ITEMS", "25"))
+TRACING_ENV_VARS = ["LANGSMITH_TRACING_V2", "LANGCHAIN_TRACING_V2", "LANGSMITH_TRACING", "LANGCHAIN_TRACING"]
+# Long runs of base64 characters, optionally as a data URL, are taken to be images
+BASE64_PATTERN = re.compile(r"(data:image/[a-z]+;base64,)?[A-Za-z0-9+/=]+")
+XML_PREFIXES = ("<?xml", "<hierarchy", "<node")
+
+# None until the outermost traced call of a request decides; the nested calls follow that decision
+trace_sampled = contextvars.ContextVar("trace_sampled", default=None)
+
+tracing_enabled = None
+tracing_client = None
+tracing_client_lock = threading.Lock()
+
+
+def is_tracing_enabled():
+    # Read once, on the first traced call, so that .env has been loaded by then
+    global tracing_enabled
+    if tracing_enabled is None:
+        tracing_enabled = TRACE_SAMPLE_RATE > 0 and any(os.getenv(name, "").lower() == "true" for name in TRACING_ENV_VARS)
+    return tracing_enabled
+
+def get_tracing_client():
+    """
+    LangSmith client for every traced run, including the LLM runs LangChain records under them. It exports
+    in batches from a background thread and redacts inputs and outputs before they are queued.
+    """
+    global tracing_client
+    with tracing_client_lock:
+        if tracing_client is None:
+            from langsmith import Client
+            tracing_client = Client(auto_batch_tracing=True, hide_inputs=redact_payload, hide_outputs=redact_payload)
+        return tracing_client
+
+def flush_traces():
+    if tracing_client is not None:
+        tracing_client.flush()
+
+def summarise_string(value):
+    if len(value) <= TRACE_MAX_STRING_LENGTH:
+        return value
+    head = value[:64].lstrip()
+    if head.startswith(XML_PREFIXES):
+        return {"xml_bytes": len(value), "sha1": hashlib.sha1(value.encode("utf-8")).hexdigest()}
+    if BASE64_PATTERN.fullmatch(value[:4096]):
+        return {"base64_bytes": len(value), "sha1": hashlib.sha1(value.encode("utf-8")).hexdigest()}
+    return value[:TRACE_MAX_STRING_LENGTH] + f"... [{len(value) - TRACE_MAX_STRING_LENGTH} more characters]"
+
+def redact_payload(value, depth=0):
+    """
+    Copy of a trace payload that is cheap to serialise: XML and base64 images become their size and hash,
+    long strings and lists are truncated, and objects (UITree, LLM clients) are summarised by type.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        return summarise_string(value)
+    if depth >= 8:
+        return f"<{type(value).__name__}>"
+    if isinstance(value, dict):
+        return {str(key): redact_payload(item, depth + 1) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [redact_payload(item, depth + 1) for item in value[:TRACE_MAX_LIST_ITEMS]]
+        if len(value) > TRACE_MAX_LIST_ITEMS:
+            items.append(f"... [{len(value) - TRACE_MAX_LIST_ITEMS} more items]")
+        return items
+    if hasattr(value, "ui_element_dict_processed"):
+        return {"type": type(value).__name__, "elements": len(value.ui_element_dict_processed), "fingerprint": value.get_fingerprint()}
+    if hasattr(value, "model_name"):
+        return {"type": type(value).__name__, "model": value.model_name}
+    if hasattr(value, "content"):
+        # LangChain messages
+        return {"type": type(value).__name__, "content": redact_payload(value.content, depth + 1)}
+    return f"<{type(value).__name__}>"
+
+def start_trace_decision():
+    """Returns (sampled, token); the token is None when an outer call already decided."""
+    sampled = trace_sampled.get()
+    if sampled is not None:
+        return sampled, None
+    sampled = random.random() < TRACE_SAMPLE_RATE
+    return sampled, trace_sampled.set(sampled)
+
+def traceable(func=None, **options):
+    """
+    Drop-in for langsmith.traceable. Without tracing the function is called directly, with no trace context
+    or payload capture, and langsmith is not imported for it. With tracing, each request is sampled once at its outermost traced call (TRACE_SAMPLE_RATE);
+    the calls of a request that is not sampled, including LangChain's own LLM runs, are not recorded.
+    """
+    if func is None:
+        return lambda decorated: traceable(decorated, **options)
+    traced = []
+
+    def get_traced():
+        if not traced:
+            from langsmith import traceable as langsmith_traceable
+            traced.append(langsmith_traceable(client=get_tracing_client(), process_inputs=redact_payload, process_outputs=redact_payload, **options)(func))
+        return traced[0]
+
+    def untraced_context():
+        from langsmith.run_helpers import tracing_context
+        return tracing_context(enabled=False)
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not is_tracing_enabled():
+                return await func(*args, **kwargs)
+            sampled, token = start_trace_decision()
+            try:
+                if sampled:
+                    return await get_traced()(*args, **kwargs)
+                if token is None:
+                    # An outer call of this request already turned tracing off
+                    return await func(*args, **kwargs)
+                with untraced_context():
+                    return await func(*args, **kwargs)
+            finally:
+                if token is not None:
+                    trace_sampled.reset(token)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_tracing_enabled():
+            return func(*args, **kwargs)
+        sampled, token = start_trace_decision()
+        try:
+            if sampled:
+                return get_traced()(*args, **kwargs)
+            if token is None:
+                return func(*args, **kwargs)
+            with untraced_context():
+                return func(*args, **kwargs)
+        finally:
+            if token is not None:
+                trace_sampled.reset(token)
+    return wrapper
@@ -1,24 +1,89 @@
+import hashlib
+import os
+import re
+from collections import Counter
 from platform import node
 import networkx as nx
 from lxml import etree
+from executors import run_in_process, run_in_thread
 from xml_utils import check_if_element_is_ad, check_if_element_is_external, calculate_heuristic_score
 import logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Cost of a full UITree while it is built, measured on uiautomator dumps: the lxml tree (about half of it),
+# the graph node and the element dict of each XML node, plus the attribute strings copied out of the XML
+UITREE_BYTES_PER_NODE = 10000
+UITREE_BYTES_PER_XML_BYTE = 4
+# A StreamedUITree keeps these attributes only; they are all the pipeline reads
+STREAMED_ATTRIBUTES = {"index", "text", "resource-id", "class", "package", "content-desc", "checkable", "checked", "clickable", "enabled",
+                       "focusable", "focused", "scrollable", "long-clickable", "password", "selected", "bounds", "displayed"}
+STREAMED_ACTIONABLE_ATTRIBUTES = ["clickable", "long-clickable", "checkable", "scrollable", "focusable"]
+# Kept whatever their attributes: the screenshot policy, the popup pre-detector and input detection look for them
+STREAMED_CLASS_PATTERN = re.compile(r"WebView|SurfaceView|TextureView|VideoView|Dialog|BottomSheet|EditText|TextInput|TextField", re.IGNORECASE)
+STREAM_CHUNK_CHARS = 1 << 20
+
+
+def get_screen_node_limit():
+    return int(os.getenv("SCREEN_MAX_NODES", "20000"))
+
+def get_request_memory_limit_bytes():
+    return float(os.getenv("REQUEST_MEMORY_LIMIT_MB", "256")) * 1024 * 1024
+
+def estimate_node_count(xml):
+    # Every "<" opens a tag; end tags, the XML declaration and comments are not nodes
+    return xml.count("<") - xml.count("</") - xml.count("<?") - xml.count("<!")
+
+def check_screen_limits(xml):
+    """
+    Why the screen is too large to build a full UITree for: "nodes" above SCREEN_MAX_NODES or "memory" when
+    the estimated size of the tree is above REQUEST_MEMORY_LIMIT_MB. None when it is not.
+    """
+    node_count = estimate_node_count(xml)
+    if node_count > get_screen_node_limit():
+        return "nodes"
+    if node_count * UITREE_BYTES_PER_NODE + len(xml) * UITREE_BYTES_PER_XML_BYTE > get_request_memory_limit_bytes():
+        return "memory"
+    return None
+
+def build_uitree(tree_class, request_id, xml, **kwargs):
+    # Runs in the worker process; the XML is left out of the result since the caller holds it already
+    uitree = tree_class(request_id, xml, **kwargs)
+    uitree.xml = None
+    return uitree
+
+async def parse_uitree(request_id, xml, tree_class=None, **kwargs):
+    """
+    Build a UITree (or tree_class) of the XML in the process pool. What comes back is the graph and the
+    element dicts, with the attribute strings they share pickled once; the XML is attached again here.
+    """
+    uitree = await run_in_process(request_id, "parse", build_uitree, tree_class or UITree, request_id, xml, **kwargs)
+    uitree.xml = xml
+    return uitree
+
+async def get_uitree_xml(request_id, uitree):
+    """The XML of the screen; a patched tree is serialised in a thread, and only by the stages that send it on."""
+    if uitree._xml is not None or uitree.root is None:
+        return uitree._xml
+    return await run_in_thread(request_id, "serialize_xml", getattr, uitree, "xml")
 
 class UITree:
-    def __init__(self, request_id, xml: str):
+    def __init__(self, request_id, xml: str, keep_xml_tree=False):
         """
         Initialize analyzer with screenshot and layout information
         
         Args:
             base64_screenshot: Base64 encoded screenshot image
             layout_xml: String containing the XML layout of the screen
+            keep_xml_tree: Keep the lxml tree in root once the graph is built; only patches need it
         """
         self.logger = logging.getLogger(__name__)
         self.request_id = request_id
         self.xml =  xml
         # Initialize a counter for node IDs
         self.node_counter = [0]  # Use a list to allow modification within the nested function
+        # One copy of each attribute name and value: uiautomator repeats most of them on every node, and a
+        # shared string is pickled once when the tree is sent back from a worker process
+        self.strings = dict()
         
         # Parse inputs
         self.root = etree.fromstring(xml.encode('utf-8'))
@@ -26,9 +91,39 @@ class UITree:
         self.ui_element_dict_processed = dict() # node_id -> metadata dict
         self.graph = nx.DiGraph()
         self.create_graph(self.root) # Start the recursive addition from the root
-        logging.info(f"requestid :: {self.request_id} :: Creation of graph done :: Number of nodes -- {len(list(self.graph.nodes))}")
+        if not keep_xml_tree:
+            # The lxml tree is as large as the graph and nothing else reads it
+            self.root = None
+        logger.debug("Creation of graph done", extra={"request_id": self.request_id, "nodes": self.graph.number_of_nodes()})
         self.update_processed_ui_element_dict()
 
+    @property
+    def xml(self):
+        # After a patch only the lxml tree is current; it is serialised when something first reads the XML
+        if self._xml is None and self.root is not None:
+            self._xml = etree.tostring(self.root, encoding='unicode')
+        return self._xml
+
+    @xml.setter
+    def xml(self, xml):
+        self._xml = xml
+
+    def __getstate__(self):
+        # The lxml tree cannot be pickled; everything downstream works off the graph and the element dicts,
+        # so the tree is left behind when the UITree is sent back from a worker process
+        state = self.__dict__.copy()
+        state['root'] = None
+        state['strings'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.strings = dict()
+
+    def share_strings(self, attributes):
+        strings = self.strings
+        return {strings.setdefault(name, name): strings.setdefault(value, value) for name, value in attributes.items()}
+
     def create_graph(self, node, parent_id=None):
 
         """
@@ -48,17 +143,27 @@ class UITree:
         self.node_counter[0] += 1
 
         # Add the node to the graph with its attributes
-        self.graph.add_node(node_id, tag=node.tag, attributes=node.attrib)
+        self.graph.add_node(node_id, tag=self.strings.setdefault(node.tag, node.tag), attributes=self.share_strings(node.attrib))
         
         # If there's a parent, add an edge from parent to this node
         if parent_id is not None:
             self.graph.add_edge(parent_id, node_id)
 
-        node_description = (node.attrib.get('text', '') + " " + node.attrib.get('content-desc', '')).strip()
+        self.build_ui_element(node_id)
+        
+        # Recursively add children
+        for child in node:
+            self.create_graph(child, parent_id=node_id)
+
+    def build_ui_element(self, node_id):
+        """Create the element dict of a graph node from its raw XML attributes."""
+        node_data = self.graph.nodes[node_id]
+        raw_attributes = node_data['attributes']
+        node_description = (raw_attributes.get('text', '') + " " + raw_attributes.get('content-desc', '')).strip()
         if not node_description:
-            node_description =  node.attrib.get('resource-id', '').strip()
-        attributes = dict(node.attrib)
-        attributes['tag'] = node.tag
+            node_description =  raw_attributes.get('resource-id', '').strip()
+        attributes = dict(raw_attributes)
+        attributes['tag'] = node_data['tag']
         # attributes['xpath'] = get_xpath(node)
         attributes['content_desc'] = attributes.get('content-desc', '')
         attributes['resource_id'] = attributes.get('resource-id', '')
@@ -76,30 +181,28 @@ class UITree:
 
         self.ui_element_dict_original[node_id] = ui_element
         self.ui_element_dict_processed[node_id] = ui_element
-        
-        # Recursively add children
-        for child in node:
-            self.create_graph(child, parent_id=node_id)
-
-        
 
     def update_processed_ui_element_dict(self):
+        for node_id in self.graph.nodes():
+            self.process_ui_element(node_id)
+
+    def process_ui_element(self, node_id):
+        """Inherit fields from the parent, then compute description, heuristic score and xpath of one element."""
         fields_to_check = ["content_desc", "resource_id", "text"]
         boolean_fields_to_check = ["clickable", "checkable", "checked", "enabled", "focusable", "focused", "long-clickable", "displayed", "scrollable", "selected"]
-        for node_id in self.graph.nodes():
-            self.update_field_using_parent(ui_element=self.ui_element_dict_processed.get(node_id), fields_to_check=fields_to_check)
-            self.update_boolean_field_using_parent(ui_element=self.ui_element_dict_processed.get(node_id), boolean_fields_to_check=boolean_fields_to_check)
-            ui_element_processed = self.ui_element_dict_processed.get(node_id)
-            if ui_element_processed:
-                # Recalculate heuristic score
-                ui_element_processed['description'] = (ui_element_processed.get('attributes').get('text', '') + " " + ui_element_processed.get('attributes').get('content_desc', '')).strip()
-                if not ui_element_processed['description']:
-                    ui_element_processed['description'] =  ui_element_processed.get('attributes').get('resource_id', '').strip()
-                ui_element_processed['heuristic_score'] = calculate_heuristic_score(node_id, ui_element_processed)
-                ui_element_processed.get('attributes')['xpath'] = self.get_xpath(node_id=ui_element_processed.get('node_id', None))
-                
-                # Add to ui_element_dict
-                self.ui_element_dict_processed[node_id] = ui_element_processed
+        self.update_field_using_parent(ui_element=self.ui_element_dict_processed.get(node_id), fields_to_check=fields_to_check)
+        self.update_boolean_field_using_parent(ui_element=self.ui_element_dict_processed.get(node_id), boolean_fields_to_check=boolean_fields_to_check)
+        ui_element_processed = self.ui_element_dict_processed.get(node_id)
+        if ui_element_processed:
+            # Recalculate heuristic score
+            ui_element_processed['description'] = (ui_element_processed.get('attributes').get('text', '') + " " + ui_element_processed.get('attributes').get('content_desc', '')).strip()
+            if not ui_element_processed['description']:
+                ui_element_processed['description'] =  ui_element_processed.get('attributes').get('resource_id', '').strip()
+            ui_element_processed['heuristic_score'] = calculate_heuristic_score(node_id, ui_element_processed)
+            ui_element_processed.get('attributes')['xpath'] = self.get_xpath(node_id=ui_element_processed.get('node_id', None))
+            
+            # Add to ui_element_dict
+            self.ui_element_dict_processed[node_id] = ui_element_processed
 
     def update_field_using_parent(self, ui_element, fields_to_check, max_levels=1):
         node_id = ui_element.get("node_id", None)
@@ -195,6 +298,116 @@ class UITree:
         # Get the list of successors (children)
         return list(self.graph.successors(node_id))
 
+    def get_fingerprint(self):
+        """
+        Structural fingerprint of the screen, stable across visits.
+        Built from the package and, for every clickable element, its resource id and the classes on its path
+        from the root, counted per element so that screens with more or fewer of the same controls differ.
+        Text is left out so that dynamic content (counters, feeds, filled fields) does not create new screens.
+        """
+        if getattr(self, 'fingerprint', None):
+            return self.fingerprint
+        packages = set()
+        signature = Counter()
+        for node_id, ui_element in self.ui_element_dict_processed.items():
+            attributes = ui_element.get('attributes', {})
+            if attributes.get('package'):
+                packages.add(attributes.get('package'))
+            if attributes.get('clickable') == 'true':
+                signature[(self.get_class_path(node_id), attributes.get('resource_id') or '')] += 1
+        self.has_clickable_resource_ids = any(resource_id for _, resource_id in signature)
+        raw_fingerprint = '|'.join(sorted(packages)) + '#' + ';'.join(f"{class_path}:{resource_id}*{count}" for (class_path, resource_id), count in sorted(signature.items()))
+        self.fingerprint = hashlib.sha1(raw_fingerprint.encode('utf-8')).hexdigest()
+        return self.fingerprint
+
+    def is_fingerprint_distinctive(self):
+        """
+        False when no clickable element has a resource id (Compose, Flutter, WebView screens); the fingerprint of
+        such a screen is only its layout, which unrelated screens easily share.
+        """
+        self.get_fingerprint()
+        return self.has_clickable_resource_ids
+
+    def get_class_path(self, node_id):
+        classes = []
+        while node_id is not None:
+            attributes = self.ui_element_dict_processed.get(node_id, {}).get('attributes', {})
+            classes.append(attributes.get('class') or self.graph.nodes[node_id].get('tag', ''))
+            node_id = self.get_parent(node_id)
+        return '/'.join(reversed(classes))
+
+    def get_node_at_path(self, path):
+        """
+        Node id at a path of child positions such as "0/2/1", counted from the root node ("" is the root).
+        Raises ValueError when the path does not exist.
+        """
+        node_id = next((node for node in self.graph.nodes if self.graph.in_degree(node) == 0), None)
+        for position in [part for part in str(path).split('/') if part != '']:
+            children = self.get_children(node_id) if node_id is not None else []
+            if not position.isdigit() or int(position) >= len(children):
+                raise ValueError(f"No node at path {path}")
+            node_id = children[int(position)]
+        if node_id is None:
+            raise ValueError(f"No node at path {path}")
+        return node_id
+
+    def set_children_order(self, parent_id, children):
+        # Successors keep the order their edges were added in, so re-adding the edges reorders them
+        for child_id in children:
+            self.graph.remove_edge(parent_id, child_id)
+        for child_id in children:
+            self.graph.add_edge(parent_id, child_id)
+
+    def insert_subtree(self, parent_id, index, node):
+        """Add the XML node and its descendants as child number index of parent_id; returns the new node id."""
+        children = self.get_children(parent_id)
+        new_node_id = self.node_counter[0]
+        self.create_graph(node, parent_id=parent_id)
+        children.insert(index, new_node_id)
+        self.set_children_order(parent_id, children)
+        return new_node_id
+
+    def remove_subtree(self, node_id):
+        removed_node_ids = [node_id] + list(nx.descendants(self.graph, node_id))
+        for removed_node_id in removed_node_ids:
+            self.ui_element_dict_original.pop(removed_node_id, None)
+            self.ui_element_dict_processed.pop(removed_node_id, None)
+        self.graph.remove_nodes_from(removed_node_ids)
+
+    def set_node_attributes(self, node_id, attributes):
+        """Update the raw XML attributes of a node; a value of None removes the attribute."""
+        raw_attributes = self.graph.nodes[node_id]['attributes']
+        for name, value in attributes.items():
+            if value is None:
+                raw_attributes.pop(name, None)
+            else:
+                raw_attributes[name] = str(value)
+
+    def refresh_subtrees(self, node_ids):
+        """
+        Rebuild the elements of the subtrees rooted at node_ids after their XML changed: inherited fields,
+        description, heuristic score and xpath. Parents are refreshed before their children, and the rest of
+        the tree is left untouched. Returns the number of refreshed elements.
+        """
+        def get_depth(node_id):
+            depth = 0
+            while node_id is not None:
+                node_id = self.get_parent(node_id)
+                depth += 1
+            return depth
+
+        refreshed = set()
+        for root_id in sorted([node_id for node_id in set(node_ids) if node_id in self.graph], key=get_depth):
+            if root_id in refreshed:
+                continue
+            for node_id in nx.dfs_preorder_nodes(self.graph, root_id):
+                if node_id not in refreshed:
+                    self.build_ui_element(node_id)
+                    self.process_ui_element(node_id)
+                    refreshed.add(node_id)
+        self.fingerprint = None
+        return len(refreshed)
+
     # Function to get node data by node ID
     def get_node_data(self, node_id):
         if node_id in self.graph:
@@ -203,3 +416,104 @@ class UITree:
             return None
 
 
+class StreamedUITree(UITree):
+    def __init__(self, request_id, xml: str):
+        """
+        Reduced UITree for screens above the node or memory ceiling. The XML is parsed as a stream, so the lxml
+        tree never holds more than the path to the current node, and only these nodes are kept:
+        - actionable ones (clickable, long-clickable, checkable, scrollable or focusable),
+        - WebView, canvas and video surfaces, dialogs and input fields,
+        - the root and the windows below it,
+        - the ancestors of all of those,
+        - nodes with a text or content-desc, while the tree has fewer than SCREEN_MAX_NODES nodes.
+        Kept nodes have the node ids and xpaths they would have in a full UITree, with STREAMED_ATTRIBUTES only.
+        The tree cannot take patches.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.request_id = request_id
+        self.xml = xml
+        self.node_counter = [0]
+        self.strings = dict()
+        self.root = None
+        self.ui_element_dict_original = dict() # node_id -> metadata dict
+        self.ui_element_dict_processed = dict() # node_id -> metadata dict
+        self.graph = nx.DiGraph()
+        self.xpaths = dict() # node_id -> xpath in the full XML
+        self.kept_nodes = 0
+        root_record = self.stream_records(xml, get_screen_node_limit())
+        if root_record is not None:
+            self.add_records(root_record)
+        logger.debug("Creation of streamed graph done", extra={"request_id": self.request_id, "nodes": self.graph.number_of_nodes(), "xml_nodes": self.node_counter[0]})
+        self.update_processed_ui_element_dict()
+
+    def is_kept(self, attributes, depth, max_nodes):
+        if depth < 2 or any(attributes.get(name) == "true" for name in STREAMED_ACTIONABLE_ATTRIBUTES):
+            return True
+        if STREAMED_CLASS_PATTERN.search(attributes.get("class", "")):
+            return True
+        return self.kept_nodes < max_nodes and bool(attributes.get("text") or attributes.get("content-desc"))
+
+    def stream_records(self, xml, max_nodes):
+        """
+        Parse the XML chunk by chunk into nested records (node_id, tag, attributes, xpath, child records) of
+        the kept nodes; returns the root record.
+        """
+        parser = etree.XMLPullParser(events=("start", "end"))
+        open_nodes = [] # path to the current node: {"record", "tag_counts", "keep"}
+        root_record = None
+
+        def handle_events():
+            nonlocal root_record
+            for event, element in parser.read_events():
+                if event == "start":
+                    node_id = self.node_counter[0]
+                    self.node_counter[0] += 1
+                    tag = element.tag
+                    if open_nodes:
+                        tag_counts = open_nodes[-1]["tag_counts"]
+                        tag_counts[tag] = tag_counts.get(tag, 0) + 1
+                        xpath = f"{open_nodes[-1]['record'][3]}/{tag}[{tag_counts[tag]}]"
+                    else:
+                        xpath = "/" + tag
+                    attributes = self.share_strings({name: value for name, value in element.attrib.items() if name in STREAMED_ATTRIBUTES})
+                    keep = self.is_kept(attributes, len(open_nodes), max_nodes)
+                    if keep:
+                        self.kept_nodes += 1
+                    open_nodes.append({"record": (node_id, tag, attributes, xpath, []), "tag_counts": dict(), "keep": keep})
+                else:
+                    open_node = open_nodes.pop()
+                    # Finished elements are dropped so the lxml tree only holds the open path
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+                    if not (open_node["keep"] or open_node["record"][4]):
+                        continue
+                    if not open_node["keep"]:
+                        self.kept_nodes += 1
+                    if open_nodes:
+                        open_nodes[-1]["record"][4].append(open_node["record"])
+                    else:
+                        root_record = open_node["record"]
+
+        for offset in range(0, len(xml), STREAM_CHUNK_CHARS):
+            parser.feed(xml[offset:offset + STREAM_CHUNK_CHARS].encode('utf-8'))
+            handle_events()
+        parser.close()
+        handle_events()
+        return root_record
+
+    def add_records(self, root_record):
+        # Depth first in document order, so the graph holds the nodes in the order create_graph adds them
+        pending = [(root_record, None)]
+        while pending:
+            (node_id, tag, attributes, xpath, children), parent_id = pending.pop()
+            self.graph.add_node(node_id, tag=tag, attributes=attributes)
+            if parent_id is not None:
+                self.graph.add_edge(parent_id, node_id)
+            self.xpaths[node_id] = xpath
+            self.build_ui_element(node_id)
+            pending.extend((child, node_id) for child in reversed(children))
+
+    def get_xpath(self, node_id):
+        # Siblings that were not kept still count in the xpath's positions
+        return self.xpaths.get(node_id) or super().get_xpath(node_id)
@@ -1,24 +1,32 @@
+import asyncio
 import copy
-import traceback
 import json
 import os
-import requests
+import time
 import base64
 from datetime import datetime
 import uuid
+import functools
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont
 from fastapi import HTTPException
-from langsmith import traceable
-from llm_utils import llm_prioritize_actions
+from tracing import traceable
+from llm_utils import build_prioritization_messages, get_cached_prioritization, invoke_prioritization_llm
+from llm_scheduler import get_llm_scheduler, estimate_tokens
 from xml_utils import parse_bounds
+from executors import run_in_process, run_in_thread
+from metrics import stage_timer, ELEMENTS_PER_SCREEN, MODEL_ROUTES_TOTAL, SCREENSHOT_DECISIONS_TOTAL, LLM_CALL_DURATION
+from deadline import call_with_deadline, mark_degraded, get_stage_timeout
+from model_router import get_model_router, get_screen_features, get_llm_for_model
+from screenshot_policy import decide_screenshot, is_screenshot_policy_enabled, FULL_SCREENSHOT, CROPPED_SCREENSHOT, REGION_SCREENSHOT
+from element_knowledge import get_element_knowledge_cache, lookup_elements, get_known_descriptions, learn_element_descriptions
+from partitioning import is_partitioned_ranking_enabled, partition_candidates, merge_partition_rankings, get_partition_merge_mode, get_partition_merge_top, PARTITION_MERGE_LLM
 
 import logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 @traceable
 # Prioritize actions with LangChain LLM
-async def prioritize_actions(request_id, uitree, screen_context, image, actions, history, user_prompt, phase, llm):
+async def prioritize_actions(request_id, uitree, screen_context, image, actions, history, user_prompt, phase, llm, session_id=None):
     """
     Prioritize actions using both heuristic and LLM reasoning.
     Args:
@@ -26,72 +34,253 @@ async def prioritize_actions(request_id, uitree, screen_context, image, actions,
     - actions: List of available actions (each is a dictionary with metadata).
     - history: Log of previous actions.
     - llm: LangChain LLM object.
+    - session_id: Session of the request; sessions take turns when LLM calls wait for the provider quota.
 
     Returns:
-    - Ranked list of actions with scores and explanations.
+    - Ranked list of actions with scores and explanations, journey completion and the model that ranked them.
     """
     # Heuristic scoring
     # for action in actions:
     #     action['heuristic_score'] = heuristic_score(action['description'], action['attributes'])
     
-    logging.info(f"requestid :: {request_id} :: Calling LLM to prioritize UI elments")
+    logger.debug("Calling LLM to prioritize UI elments")
     # LLM reasoning
-    elements_to_prioritize = filter_elements(request_id=request_id, uitree=uitree, ui_elements=actions)
-    logging.info(f"requestid :: {request_id} :: Number of clickable elements to prioritize - {len(elements_to_prioritize)}")
-    if image:
-        logging.info(f"requestid :: {request_id} :: Marking UI elments on the image")
-        annotated_image = annotate_image(image, elements_to_prioritize)
+    elements_to_prioritize = await run_in_thread(request_id, "filter", filter_elements, request_id, uitree, actions)
+    logger.debug("Clickable elements to prioritize", extra={"candidates": len(elements_to_prioritize)})
+    ELEMENTS_PER_SCREEN.observe(len(elements_to_prioritize), kind="candidates")
+    model_router = get_model_router()
+    if model_router:
+        route = model_router.route(get_screen_features(elements_to_prioritize, phase, history, image))
+        if route:
+            logger.debug("Routed to %s model tier", route["tier"], extra={"model": route["model"], "include_image": route["include_image"]})
+            MODEL_ROUTES_TOTAL.inc(tier=route["tier"], model=route["model"])
+            llm = get_llm_for_model(llm, route["model"])
+            image = image if route["include_image"] else None
+    image_kind, unlabeled_elements = FULL_SCREENSHOT if image else None, []
+    if image and is_screenshot_policy_enabled():
+        # The screenshot costs vision tokens and latency; it is sent only for what the hierarchy does not describe
+        image_kind, completeness, unlabeled_elements, reasons = await run_in_thread(request_id, "screenshot_policy", decide_screenshot, uitree, elements_to_prioritize)
+        logger.debug("Screenshot decision %s", image_kind, extra={"completeness": completeness, "unlabeled": len(unlabeled_elements), "reasons": reasons})
+    # Large screens are ranked in parts by concurrent LLM calls; each part gets its own image
+    partitions = await run_in_thread(request_id, "partition", partition_candidates, uitree, elements_to_prioritize) if is_partitioned_ranking_enabled() else []
+    annotated_image = None
+    if image_kind == CROPPED_SCREENSHOT and not partitions:
+        logger.debug("Cropping unlabeled UI elments from the image")
+        annotated_image = await run_in_process(request_id, "annotate", crop_image_regions, image, get_annotation_targets(unlabeled_elements))
+        image_kind = CROPPED_SCREENSHOT if annotated_image else FULL_SCREENSHOT
+    if image_kind == FULL_SCREENSHOT and not partitions:
+        logger.debug("Marking UI elments on the image")
+        annotated_image = await run_in_process(request_id, "annotate", annotate_image, image, get_annotation_targets(elements_to_prioritize))
+    SCREENSHOT_DECISIONS_TOTAL.inc(decision=image_kind or "none")
+    element_knowledge_cache = get_element_knowledge_cache()
+    if element_knowledge_cache:
+        # Recurring elements (tabs, toolbar buttons) already described on earlier screens are only ranked by the LLM
+        element_lookups = await run_in_thread(request_id, "element_knowledge", lookup_elements, request_id, element_knowledge_cache, elements_to_prioritize)
+        known_descriptions = get_known_descriptions(element_lookups)
+        logger.debug("Known elements on the screen", extra={"known": len(known_descriptions), "candidates": len(elements_to_prioritize)})
     else:
-        annotated_image = None
-    prioritization_start_time = datetime.now()
-    llm_response = llm_prioritize_actions(
-        request_id=request_id,
-        screen_context=screen_context,
-        base64_image=annotated_image,
-        actions=trim_element_jsons(request_id=request_id, elements_to_trim=elements_to_prioritize),
-        history=history,
-        user_prompt=user_prompt,
-        phase=phase,
-        llm=llm
-    )
-    logging.info(f"requestid :: {request_id} :: Time taken by LLM to prioritize elements :: {(datetime.now() - prioritization_start_time).total_seconds() * 1000} milliseconds")
+        element_lookups, known_descriptions = dict(), dict()
+    if partitions:
+        return await prioritize_partitions(request_id, uitree, partitions, screen_context, image, image_kind, unlabeled_elements, history, user_prompt, phase, llm,
+                                           session_id, element_knowledge_cache, element_lookups, known_descriptions)
+    trimmed_elements = await run_in_thread(request_id, "trim", trim_element_jsons, request_id, elements_to_prioritize, known_descriptions)
+    messages = await run_in_thread(request_id, "prompt", build_prioritization_messages, screen_context, annotated_image, trimmed_elements, history, user_prompt, phase, image_kind)
+    with stage_timer("llm") as llm_timer:
+        llm_response, llm_called = await invoke_ranking_llm(request_id, llm, messages, session_id, phase, image_kind)
+    logger.debug("LLM prioritization done", extra={"elapsed_ms": round(llm_timer.elapsed_ms, 3)})
     
     if llm_response:
         # print(f"LLM response: {llm_response}")
-        content = llm_response.content.replace('```json\n', '').replace('\n```', '').replace('\n', '')
-        # Parse the JSON response
-        response_dict = json.loads(content)
-        ranked_node_ids = response_dict.get("ranked_actions", [])
-        explanation = response_dict.get("explanation", "")
-        journey_completed = response_dict.get("journey_completed","")
+        ranked_node_ids, explanation, journey_completed = parse_ranking_response(llm_response)
+        if llm_called and element_knowledge_cache:
+            await run_in_thread(request_id, "element_knowledge", learn_element_descriptions, request_id, element_knowledge_cache, element_lookups, ranked_node_ids)
 
         # Rank actions
         # ranked_actions = sorted(ranked_actions, key=lambda x: x['llm_rank'], reverse=False)
-        ranked_actions = []
-        rank = 1
-        for element in ranked_node_ids:
-            ui_element = uitree.ui_element_dict_processed.get(element['node_id'])
-            if ui_element:
-                ranked_actions.append({
-                    "node_id": element['node_id'],
-                    "llm_rank": rank,
-                    "action_description" : element['action_description'],
-                    "description": ui_element.get("description"),
-                    "heuristic_score": ui_element.get("heuristic_score"),
-                    "attributes": ui_element.get("attributes")
-                })
-                rank += 1
-        logging.info(f"requestid :: {request_id} :: LLM prioritized; returning order based on llm rank. Number of ranked actions: {len(ranked_actions)}")
-        return ranked_actions, explanation,journey_completed
+        ranked_actions = build_ranked_actions(uitree, ranked_node_ids, known_descriptions)
+        logger.debug("LLM prioritized; returning order based on llm rank", extra={"ranked_actions": len(ranked_actions)})
+        return ranked_actions, explanation,journey_completed, getattr(llm, 'model_name', None)
     else:
-        # logging.error(f"requestid :: {request_id} :: LLM failed to prioritize; returning order based on heuristic score")
+        # logger.error("LLM failed to prioritize; returning order based on heuristic score")
         # ranked_clickable_elements = sorted(elements_to_prioritize, key=lambda x: x['heuristic_score'], reverse=True)
-        logging.error(f"requestid :: {request_id} :: LLM failed to prioritize; returning order based on cooridnates of the top-left of the element")
-        ranked_clickable_elements = sort_elements_top_to_bottom(elements_to_prioritize)
-        for i in range(0, len(ranked_clickable_elements)):
-            ranked_clickable_elements[i]["llm_rank"] = i + 1
-        
-        return ranked_clickable_elements, "LLM failed to prioritize; returning order based on heuristic score"
+        logger.error("LLM failed to prioritize; returning order based on cooridnates of the top-left of the element")
+        return rank_top_to_bottom(elements_to_prioritize)
+
+def rank_top_to_bottom(elements):
+    """The fallback when the LLM cannot rank: elements in screen order, with the llm stage marked degraded."""
+    # The elements belong to the UITree, which a session keeps for the next step; they are ranked as copies
+    ranked_clickable_elements = [dict(element) for element in sort_elements_top_to_bottom(elements)]
+    for i in range(0, len(ranked_clickable_elements)):
+        ranked_clickable_elements[i]["llm_rank"] = i + 1
+    mark_degraded("llm")
+    
+    return ranked_clickable_elements, "LLM failed to prioritize; returning order based on heuristic score", False, None
+
+async def invoke_ranking_llm(request_id, llm, messages, session_id, phase, image_kind):
+    """
+    Answer the prioritization messages from the persistent cache, or from the LLM through the rate limit
+    scheduler and within the request's latency budget. Returns (response or None, whether the LLM was called).
+    """
+    llm_response, cache_key = await run_in_thread(request_id, "llm_cache", get_cached_prioritization, request_id, llm, messages)
+    if llm_response is not None:
+        return llm_response, False
+    # Under a provider quota the call waits for its turn, or is answered with a 429 when it cannot get one in time
+    llm_scheduler = get_llm_scheduler(getattr(llm, 'model_name', None))
+    ticket = await llm_scheduler.acquire(request_id, session_id or request_id, phase, estimate_tokens(messages), get_stage_timeout("llm")) if llm_scheduler else None
+    # The LLM client call is blocking; it runs in a thread, bounded by the request's latency budget
+    llm_call_start_time = time.perf_counter()
+    llm_response = await call_with_deadline(
+        request_id,
+        "llm",
+        invoke_prioritization_llm,
+        request_id=request_id,
+        messages=messages,
+        llm=llm,
+        cache_key=cache_key,
+        ticket=ticket
+    )
+    LLM_CALL_DURATION.observe(time.perf_counter() - llm_call_start_time, screenshot=image_kind or "none")
+    return llm_response, True
+
+def parse_ranking_response(llm_response):
+    """(ranked elements as {"node_id", "action_description"}, explanation, journey_completed) of an LLM prioritization."""
+    content = llm_response.content.replace('```json\n', '').replace('\n```', '').replace('\n', '')
+    # Parse the JSON response
+    response_dict = json.loads(content)
+    return response_dict.get("ranked_actions", []), response_dict.get("explanation", ""), response_dict.get("journey_completed","")
+
+def build_ranked_actions(uitree, ranked_node_ids, known_descriptions):
+    ranked_actions = []
+    rank = 1
+    for element in ranked_node_ids:
+        ui_element = uitree.ui_element_dict_processed.get(element['node_id'])
+        if ui_element:
+            ranked_actions.append({
+                "node_id": element['node_id'],
+                "llm_rank": rank,
+                "action_description" : element.get('action_description') or known_descriptions.get(element['node_id']),
+                "description": ui_element.get("description"),
+                "heuristic_score": ui_element.get("heuristic_score"),
+                "attributes": ui_element.get("attributes")
+            })
+            rank += 1
+    return ranked_actions
+
+async def rank_partition(request_id, partition, screen_context, image, image_kind, unlabeled_node_ids, history, user_prompt, phase, llm, session_id, known_descriptions):
+    """
+    Rank one partition of a large screen with the part of the screenshot it needs. Returns (ranked elements,
+    explanation, journey_completed, whether the LLM was called), or None when the LLM gave no usable ranking.
+    """
+    elements = partition["elements"]
+    partition_image, partition_image_kind = None, None
+    if image_kind == FULL_SCREENSHOT:
+        partition_image = await run_in_process(request_id, "annotate", annotate_image_region, image, get_annotation_targets(elements))
+        partition_image_kind = REGION_SCREENSHOT if partition_image else None
+    elif image_kind == CROPPED_SCREENSHOT:
+        partition_unlabeled_elements = [element for element in elements if element.get("node_id") in unlabeled_node_ids]
+        if partition_unlabeled_elements:
+            partition_image = await run_in_process(request_id, "annotate", crop_image_regions, image, get_annotation_targets(partition_unlabeled_elements))
+            partition_image_kind = CROPPED_SCREENSHOT if partition_image else None
+    trimmed_elements = await run_in_thread(request_id, "trim", trim_element_jsons, request_id, elements, known_descriptions)
+    messages = await run_in_thread(request_id, "prompt", build_prioritization_messages, screen_context, partition_image, trimmed_elements, history, user_prompt, phase,
+                                   partition_image_kind, partition["region"])
+    llm_response, llm_called = await invoke_ranking_llm(request_id, llm, messages, session_id, phase, partition_image_kind)
+    if not llm_response:
+        return None
+    try:
+        ranked_node_ids, explanation, journey_completed = parse_ranking_response(llm_response)
+    except (ValueError, AttributeError) as e:
+        logger.error("LLM ranking of a partition is not valid JSON - %s", e, extra={"region": partition["region"]})
+        return None
+    # Only the partition's own elements count; the other partitions rank the rest
+    node_ids = {element.get("node_id") for element in elements}
+    ranked_node_ids = [element for element in ranked_node_ids if isinstance(element, dict) and element.get("node_id") in node_ids]
+    return ranked_node_ids, explanation, journey_completed, llm_called
+
+async def order_partition_tops(request_id, uitree, rankings, screen_context, history, user_prompt, phase, llm, session_id, known_descriptions):
+    """
+    Order the best candidates of every partition across the screen in one small LLM call, without an image.
+    Returns (node ids in order, explanation, journey_completed), or None when the call gave no usable answer.
+    """
+    top_node_ids = [node_id for ranking in rankings for node_id in ranking[:get_partition_merge_top()]]
+    if len(top_node_ids) < 2:
+        return None
+    top_elements = [uitree.ui_element_dict_processed[node_id] for node_id in top_node_ids]
+    model_router = get_model_router()
+    route = model_router.route(get_screen_features(top_elements, phase, history, None)) if model_router else None
+    if route:
+        llm = get_llm_for_model(llm, route["model"])
+    messages = build_prioritization_messages(screen_context, None, trim_element_jsons(request_id, top_elements, known_descriptions), history, user_prompt, phase,
+                                             None, partition_merge=True)
+    llm_response, _ = await invoke_ranking_llm(request_id, llm, messages, session_id, phase, None)
+    if not llm_response:
+        return None
+    try:
+        ranked_node_ids, explanation, journey_completed = parse_ranking_response(llm_response)
+    except (ValueError, AttributeError) as e:
+        logger.error("LLM ordering of the partitions' top candidates is not valid JSON - %s", e)
+        return None
+    top_node_ids = set(top_node_ids)
+    return [element.get("node_id") for element in ranked_node_ids if isinstance(element, dict) and element.get("node_id") in top_node_ids], explanation, journey_completed
+
+async def prioritize_partitions(request_id, uitree, partitions, screen_context, image, image_kind, unlabeled_elements, history, user_prompt, phase, llm,
+                                session_id, element_knowledge_cache, element_lookups, known_descriptions):
+    """
+    Rank a large screen partition by partition, with concurrent LLM calls over smaller prompts, so the latency
+    is that of the largest partition. The partitions' top candidates are then ordered across the screen by one
+    small call (PARTITION_MERGE=llm) and the rest interleaved, see merge_partition_rankings. A partition whose
+    call fails or raises keeps its elements in screen order and the llm stage is marked degraded.
+
+    Returns the same as prioritize_actions.
+    """
+    unlabeled_node_ids = {element.get("node_id") for element in unlabeled_elements}
+    with stage_timer("llm") as llm_timer:
+        # One partition raising must not leave the others running unobserved or lose the ones that answered
+        partition_results = await asyncio.gather(*[
+            rank_partition(request_id, partition, screen_context, image, image_kind, unlabeled_node_ids, history, user_prompt, phase, llm, session_id, known_descriptions)
+            for partition in partitions
+        ], return_exceptions=True)
+    partition_errors = [result for result in partition_results if isinstance(result, BaseException)]
+    for error in partition_errors:
+        logger.error("LLM ranking of a partition failed - %s", error, exc_info=error)
+    if partition_errors and len(partition_errors) == len(partition_results) and isinstance(partition_errors[0], HTTPException):
+        # As for a screen ranked in one call, a request that cannot be served now (e.g. 429 under the LLM quota) gets the error
+        raise partition_errors[0]
+    partition_results = [None if isinstance(result, BaseException) else result for result in partition_results]
+    logger.debug("LLM prioritization of partitions done", extra={"elapsed_ms": round(llm_timer.elapsed_ms, 3), "partitions": len(partitions),
+                                                                  "failed": sum(result is None for result in partition_results)})
+    if all(result is None for result in partition_results):
+        logger.error("LLM failed to prioritize; returning order based on cooridnates of the top-left of the element")
+        return rank_top_to_bottom([element for partition in partitions for element in partition["elements"]])
+
+    rankings, action_descriptions, explanations, learned_elements = [], dict(), [], []
+    for partition, result in zip(partitions, partition_results):
+        if result is None:
+            mark_degraded("llm")
+            rankings.append([element.get("node_id") for element in sort_elements_top_to_bottom(partition["elements"])])
+            continue
+        ranked_node_ids, explanation, journey_completed, llm_called = result
+        rankings.append([element["node_id"] for element in ranked_node_ids])
+        action_descriptions.update({element["node_id"]: element.get("action_description") for element in ranked_node_ids})
+        explanations.append(explanation)
+        if llm_called:
+            learned_elements.extend(ranked_node_ids)
+    if learned_elements and element_knowledge_cache:
+        await run_in_thread(request_id, "element_knowledge", learn_element_descriptions, request_id, element_knowledge_cache, element_lookups, learned_elements)
+
+    ordered_top = None
+    # Stopping is decided for the whole screen; every partition that was ranked has to see nothing left to do
+    journey_completed = all(result[2] is True for result in partition_results if result is not None)
+    explanation = " ".join(explanation for explanation in explanations if explanation)
+    if get_partition_merge_mode() == PARTITION_MERGE_LLM:
+        with stage_timer("llm_merge"):
+            merge_result = await order_partition_tops(request_id, uitree, rankings, screen_context, history, user_prompt, phase, llm, session_id, known_descriptions)
+        if merge_result is not None:
+            ordered_top, explanation, journey_completed = merge_result
+    ranked_node_ids = [{"node_id": node_id, "action_description": action_descriptions.get(node_id)} for node_id in merge_partition_rankings(rankings, ordered_top)]
+    ranked_actions = build_ranked_actions(uitree, ranked_node_ids, known_descriptions)
+    logger.debug("LLM prioritized partitions; returning merged order", extra={"ranked_actions": len(ranked_actions), "merged_by_llm": ordered_top is not None})
+    return ranked_actions, explanation, journey_completed, getattr(llm, 'model_name', None)
 
 def filter_elements(request_id, uitree, ui_elements):
 
@@ -112,13 +301,19 @@ def filter_elements(request_id, uitree, ui_elements):
     except Exception as e:
         return [element for element in ui_elements if element.get('heuristic_score') > 0 or all(field in element.get("attributes") and 'true' == element.get("attributes").get(field)  for field in fields_to_check)]
 
-def trim_element_jsons(request_id, elements_to_trim):
+def trim_element_jsons(request_id, elements_to_trim, known_descriptions=None):
     # attributes_to_trim = ["index", "package", "class", "checkable", "checked", "clickable", "enabled", "focusable", "focused", "long-clickable", "password", "resource_id", "scrollable", "selected", "bounds", "displayed", "xpath"]
     # fields_to_trim = ["is_external", "is_ad", "heuristic_score", "attributes"]
+    # Elements in known_descriptions (node_id -> action description) are given by their known action only
+    known_descriptions = known_descriptions or {}
     try:
         trimmed_elements = []
         for element in elements_to_trim:
             attributes = element.get("attributes")
+            known_action = known_descriptions.get(element.get("node_id"))
+            if known_action:
+                trimmed_elements.append({"node_id": element.get("node_id"), "known_action": known_action})
+                continue
             trimmed_elements.append({
                 "node_id": element.get("node_id"),
                 "description": element.get("description"),
@@ -129,7 +324,7 @@ def trim_element_jsons(request_id, elements_to_trim):
         return trimmed_elements
             
     except Exception as e:
-        logging.error(f"requestid :: {request_id} :: Exception in trimming tokens in filtered elements before prioritization; returning as is.")
+        logger.exception("Exception in trimming tokens in filtered elements before prioritization; returning as is.", extra={"request_id": request_id})
         return elements_to_trim
 
 def check_if_leaf_element(request_id, uitree, node_id):
@@ -161,6 +356,25 @@ def sort_elements_top_to_bottom(ui_elements):
 
     return sorted_elements
 
+def get_annotation_targets(ui_elements):
+    # Only node_id and bounds are needed to annotate; keeps the payload sent to the process pool small
+    return [{"node_id": element.get("node_id"), "attributes": {"bounds": element.get("attributes", {}).get("bounds")}} for element in ui_elements]
+
+@functools.lru_cache(maxsize=1)
+def get_font():
+    # Loaded once per process; the warm-up loads it before the process pool is forked
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype("Arial.ttf", 50)
+    except IOError:
+        return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=1)
+def get_http_session():
+    """HTTP session shared by the agent and file fetches, so connections are kept alive and reused."""
+    import requests
+    return requests.Session()
+
 def annotate_image(base64_image, ui_elements):
     """
     Annotate the image with bounding boxes and element IDs for all interactable elements.
@@ -177,6 +391,7 @@ def annotate_image(base64_image, ui_elements):
         return None
 
     # Decode base64 image
+    from PIL import Image, ImageDraw
     image_data = base64.b64decode(base64_image)
     image = Image.open(BytesIO(image_data))
 
@@ -184,11 +399,7 @@ def annotate_image(base64_image, ui_elements):
         image = image.convert('RGB')
     draw = ImageDraw.Draw(image)
     
-    # Try to load a font, use default if not available
-    try:
-        font = ImageFont.truetype("Arial.ttf", 50)
-    except IOError:
-        font = ImageFont.load_default()
+    font = get_font()
     
 
     # Draw bounding boxes and element IDs for all interactable elements
@@ -235,6 +446,87 @@ def annotate_image(base64_image, ui_elements):
 
     return annotated_base64
 
+def crop_image_regions(base64_image, ui_elements, padding=24, caption_height=60):
+    """
+    Cut the regions of the given elements out of the screenshot and stack them into one image, each under
+    a caption with its node_id. Sent instead of the whole screenshot when only a few elements are unlabeled.
+
+    Returns:
+        str: Base64 encoded image, or None when no element has usable bounds
+    """
+    if not base64_image:
+        return None
+    from PIL import Image, ImageDraw
+    image = Image.open(BytesIO(base64.b64decode(base64_image)))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    crops = []
+    for element in ui_elements:
+        bounds = element.get("attributes", {}).get("bounds")
+        if not isinstance(bounds, str):
+            continue
+        left, top, right, bottom = parse_bounds(bounds)
+        box = (max(0, left - padding), max(0, top - padding), min(image.width, right + padding), min(image.height, bottom + padding))
+        if box[2] > box[0] and box[3] > box[1]:
+            crops.append((element.get("node_id"), image.crop(box)))
+    if not crops:
+        return None
+
+    sheet = Image.new("RGB", (max(crop.width for _, crop in crops), sum(caption_height + crop.height for _, crop in crops)), "white")
+    draw = ImageDraw.Draw(sheet)
+    font = get_font()
+    offset = 0
+    for node_id, crop in crops:
+        draw.text((4, offset + 4), str(node_id), fill="red", font=font)
+        offset += caption_height
+        sheet.paste(crop, (0, offset))
+        offset += crop.height
+    buffered = BytesIO()
+    sheet.save(buffered, format="JPEG")
+    return base64.b64encode(buffered.getvalue()).decode()
+
+def annotate_image_region(base64_image, ui_elements, padding=60):
+    """
+    Annotate the elements like annotate_image, on the part of the screenshot that holds them. Sent with one
+    partition of a partitioned ranking instead of the whole screenshot.
+
+    Returns:
+        str: Base64 encoded image, or None when no element has usable bounds
+    """
+    if not base64_image:
+        return None
+    from PIL import Image, ImageDraw
+    image = Image.open(BytesIO(base64.b64decode(base64_image)))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    boxes = []
+    for element in ui_elements:
+        bounds = element.get("attributes", {}).get("bounds")
+        if not isinstance(bounds, str):
+            continue
+        left, top, right, bottom = parse_bounds(bounds)
+        if right > left and bottom > top:
+            boxes.append((element.get("node_id"), (left, top, right, bottom)))
+    if not boxes:
+        return None
+    # Node ids are drawn above and left of their box, so the padding keeps them inside the region
+    region = (max(0, min(box[0] for _, box in boxes) - padding), max(0, min(box[1] for _, box in boxes) - padding),
+              min(image.width, max(box[2] for _, box in boxes) + padding), min(image.height, max(box[3] for _, box in boxes) + padding))
+    if region[2] <= region[0] or region[3] <= region[1]:
+        return None
+    image = image.crop(region)
+    draw = ImageDraw.Draw(image)
+    font = get_font()
+    for node_id, (left, top, right, bottom) in boxes:
+        left, top, right, bottom = left - region[0], top - region[1], right - region[0], bottom - region[1]
+        draw.rectangle([(left, top), (right, bottom)], outline="red", width=3)
+        draw.text((left - 30, top - 30), str(node_id), fill="red", font=font)
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG")
+    return base64.b64encode(buffered.getvalue()).decode()
+
 def encode_image(input_source):
     """
     Encodes an image from a file path, file object, or URL into a base64 string.
@@ -249,7 +541,7 @@ def encode_image(input_source):
         if isinstance(input_source, str):
             # Check if it's a URL
             if input_source.startswith('http://') or input_source.startswith('https://'):
-                response = requests.get(input_source)
+                response = get_http_session().get(input_source)
                 response.raise_for_status()
                 image_data = response.content
             # Check if it's a file path
@@ -297,17 +589,18 @@ def transform_popup_to_ranked_action(request_id, pop_up_element):
             "attributes" : attributes,
             "llm_rank": 1
         }
-        logging.info(f"requestid :: {request_id} :: Pop Up detected; Returning - {transformed_action}")
+        logger.debug("Pop Up detected; returning it as the only action", extra={"action": transformed_action})
         return transformed_action
     except Exception as e:
-        logging.error(f"requestid :: {request_id} :: Exception in formatting the popup element found into prioritized action - {pop_up_element}")
-        logging.error(f"requestid :: {request_id} :: Exception in formatting the popup element found into prioritized action - Stacktrace - {traceback.format_exc()}")
+        logger.exception("Exception in formatting the popup element found into prioritized action", extra={"pop_up_element": pop_up_element})
         return {"description": "", "heuristic_score": 0, "attributes" : {}, "llm_rank": 1}
 
 @traceable
 def map_data_fields_to_ranked_actions(request_id, ranked_actions, data_fields):
+    # Generated data is added to copies, so nothing of this step stays on elements a session tree keeps
+    ranked_actions = [dict(action) for action in ranked_actions]
     try:
-        logging.info(f"requestid :: {request_id} :: Mapping generated data fields to prioritized actions")
+        logger.debug("Mapping generated data fields to prioritized actions")
         for action in ranked_actions:
             action_identifier = get_element_identifier(action.get("attributes", {}))
             if action_identifier:
@@ -325,7 +618,7 @@ def map_data_fields_to_ranked_actions(request_id, ranked_actions, data_fields):
                                 break # Assuming one-to-one mapping, break after finding a match 
         
     except Exception as e:
-        logging.error("requestid :: {request_id} :: Exception in mapping data fields to prioritized actions; returning ranked actions without generated data")
+        logger.exception("Exception in mapping data fields to prioritized actions; returning ranked actions without generated data")
     finally:
         return ranked_actions
 
@@ -348,9 +641,10 @@ def get_element_identifier(element_dict) -> str:
 
 def get_file_content(file_path_or_url: str, is_image: bool = False) -> str:
     if file_path_or_url.startswith(('http://', 'https://')):
+        import requests
         # It's a URL
         try:
-            response = requests.get(file_path_or_url)
+            response = get_http_session().get(file_path_or_url)
             response.raise_for_status()
             content = response.content
         except requests.exceptions.RequestException as e:
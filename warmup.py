@@ -0,0 +1,110 @@
+import base64
+import os
+import time
+from io import BytesIO
+from executors import run_in_process, run_in_thread
+from metrics import request_timings, STARTUP_SECONDS, TIME_TO_FIRST_RESPONSE
+from ui_tree import parse_uitree
+from popup_detector import detect_popup
+from input_fields import prepare_datagen_input
+from utils import filter_elements, trim_element_jsons, annotate_image, get_annotation_targets, get_font, get_http_session
+from llm_utils import get_prompt_template
+from prompts import action_prioritization_template, screen_context_generation_template, action_prioritization_template_objective_phase_2
+from llm import get_llm
+
+import logging
+logger = logging.getLogger(__name__)
+
+WARMUP_REQUEST_ID = "warmup"
+# A tiny login screen: enough to go through parsing, popup pre-detection, input detection, filtering,
+# trimming, annotation and prompt building once
+WARMUP_XML = (
+    '<hierarchy rotation="0">'
+    '<node index="0" text="" resource-id="" class="android.widget.FrameLayout" package="com.mneme.warmup" content-desc="" checkable="false" checked="false" clickable="false" enabled="true" focusable="false" focused="false" scrollable="false" long-clickable="false" password="false" selected="false" bounds="[0,0][100,200]">'
+    '<node index="0" text="" resource-id="com.mneme.warmup:id/email" class="android.widget.EditText" package="com.mneme.warmup" content-desc="Email" checkable="false" checked="false" clickable="true" enabled="true" focusable="true" focused="false" scrollable="false" long-clickable="true" password="false" selected="false" bounds="[10,20][90,50]" />'
+    '<node index="1" text="Continue" resource-id="com.mneme.warmup:id/next" class="android.widget.Button" package="com.mneme.warmup" content-desc="" checkable="false" checked="false" clickable="true" enabled="true" focusable="true" focused="false" scrollable="false" long-clickable="false" password="false" selected="false" bounds="[10,140][90,180]" />'
+    '</node>'
+    '</hierarchy>'
+)
+
+startup_state = {
+    "started_at": None, # perf_counter when main started importing
+    "ready": False,
+    "import_seconds": None,
+    "warmup_seconds": None,
+    "first_response_seconds": None,
+    "warmup_steps_ms": dict()
+}
+
+
+def is_warmup_enabled():
+    return os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+
+def record_imports_done(started_at):
+    startup_state["started_at"] = started_at
+    startup_state["import_seconds"] = round(time.perf_counter() - started_at, 3)
+    STARTUP_SECONDS.set(startup_state["import_seconds"], phase="import")
+    logger.info("Application modules imported in %s seconds", startup_state["import_seconds"])
+
+def record_first_response():
+    if startup_state["first_response_seconds"] is None and startup_state["started_at"] is not None:
+        startup_state["first_response_seconds"] = round(time.perf_counter() - startup_state["started_at"], 3)
+        TIME_TO_FIRST_RESPONSE.set(startup_state["first_response_seconds"])
+        logger.info("First response %s seconds after start", startup_state["first_response_seconds"])
+
+def mark_ready():
+    startup_state["ready"] = True
+
+def build_warmup_image():
+    from PIL import Image
+    buffer = BytesIO()
+    Image.new("RGB", (100, 200), "white").save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+def build_llm_client():
+    llm_key = os.getenv("OPENAI_API_KEY")
+    if llm_key:
+        get_llm(llm_key)
+
+def build_prompts(trimmed_elements):
+    get_prompt_template(screen_context_generation_template, ("xml",))
+    get_prompt_template(action_prioritization_template, ("screen_context", "actions", "history", "user_prompt", "objective")).format(
+        screen_context="", actions=trimmed_elements, history=[], user_prompt="", objective=action_prioritization_template_objective_phase_2
+    )
+
+async def run_synthetic_screen():
+    # The process pool and its workers are started here, before the first request pays for it
+    uitree = await parse_uitree(WARMUP_REQUEST_ID, WARMUP_XML)
+    await run_in_thread(WARMUP_REQUEST_ID, "popup_detect", detect_popup, uitree)
+    await run_in_thread(WARMUP_REQUEST_ID, "datagen_prepare", prepare_datagen_input, uitree)
+    candidates = await run_in_thread(WARMUP_REQUEST_ID, "filter", filter_elements, WARMUP_REQUEST_ID, uitree, list(uitree.ui_element_dict_processed.values()))
+    await run_in_process(WARMUP_REQUEST_ID, "annotate", annotate_image, build_warmup_image(), get_annotation_targets(candidates))
+    trimmed_elements = await run_in_thread(WARMUP_REQUEST_ID, "trim", trim_element_jsons, WARMUP_REQUEST_ID, candidates)
+    await run_in_thread(WARMUP_REQUEST_ID, "prompt", build_prompts, trimmed_elements)
+
+async def warm_up():
+    """
+    Build what the first request would otherwise pay for: the LLM client and HTTP session, the annotation
+    font and prompt templates, then a synthetic screen through the local stages (the LLM, popup handler and
+    test data generator are not called). A failing step is logged and skipped; the worker is ready afterwards.
+    """
+    request_timings.set(dict())
+    warmup_start_time = time.perf_counter()
+    steps = [
+        ("llm_client", lambda: run_in_thread(WARMUP_REQUEST_ID, "warmup_llm_client", build_llm_client)),
+        ("http_session", lambda: run_in_thread(WARMUP_REQUEST_ID, "warmup_http_session", get_http_session)),
+        ("font", lambda: run_in_thread(WARMUP_REQUEST_ID, "warmup_font", get_font)),
+        ("synthetic_screen", run_synthetic_screen)
+    ]
+    for step_name, step in steps:
+        step_start_time = time.perf_counter()
+        try:
+            await step()
+        except Exception as e:
+            logger.exception("Warm-up step %s failed - %s", step_name, e)
+        startup_state["warmup_steps_ms"][step_name] = round((time.perf_counter() - step_start_time) * 1000, 3)
+
+    startup_state["warmup_seconds"] = round(time.perf_counter() - warmup_start_time, 3)
+    STARTUP_SECONDS.set(startup_state["warmup_seconds"], phase="warmup")
+    mark_ready()
+    logger.info("Warm-up done in %s seconds", startup_state["warmup_seconds"], extra={"steps_ms": startup_state["warmup_steps_ms"]})
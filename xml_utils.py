@@ -1,10 +1,10 @@
 import xml.etree.ElementTree as ET
-from langsmith import traceable
+from tracing import traceable
 from lxml import etree
 import networkx as nx
 
 import logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # Heuristic scoring remains unchanged
 # def heuristic_score(action_description, attributes):